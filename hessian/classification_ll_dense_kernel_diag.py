@@ -27,11 +27,13 @@ from torch.utils.data import DataLoader
 
 # From the repository
 from models.wrapper import BaseNet
-from models.curvatures import BlockDiagonal, KFAC, EFB, INF
+from models.curvatures import BlockDiagonal, KFAC, EFB, INF, DenseCurvature
+from models.storage import HessianStore
 from models.utilities import calibration_curve
 from models import plot
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 path = parent + "/data"
 # load and normalize MNIST
@@ -66,27 +68,23 @@ print(f"MAP Accuracy: {100 * np.mean(np.argmax(sgd_predictions.cpu().numpy(), ax
 
 
 # update likelihood FIM
-H = None
+dense = DenseCurvature(net.model)
 for images, labels in tqdm(test_loader):
     logits = net.model(images.to(device))
     dist = torch.distributions.Categorical(logits=logits)
     # A rank-1 Kronecker factored FiM approximation.
     labels = dist.sample()
     loss = criterion(logits, labels)
-    net.model.zero_grad()
+    net.model.zero_grad(set_to_none=False)
     loss.backward()
             
-    grads = []
-    for layer in list(net.model.modules())[1:]:
-        for p in layer.parameters():    
-            J_p = torch.flatten(p.grad.view(-1)).unsqueeze(0)
-            grads.append(J_p)
-    J_loss = torch.cat(grads, dim=1)
-    H_loss = J_loss.t() @ J_loss
-    H_loss.requires_grad = False
-    H = H_loss if H == None else H + H_loss
+    dense.update(batch_size=1)
 
-H = H/len(test_loader)    
+# write H tile by tile to a memory-mapped store, the analysis then only reads the tiles it needs
+dense.flush()
+H = HessianStore.from_tensor(parent + '/results/Hessian/H_dense_15k.bin', dense.state['dense'], upper=True,
+                             scale=1 / len(test_loader))
+del dense
 
 utils.calculateDominance(H)
 torch.cuda.empty_cache()
\ No newline at end of file
@@ -1,18 +1,22 @@
 import torch
 from matplotlib import pyplot as plt
 
+from models.storage import abs_sum
+
 def calculateDominance(H, tau = 0.00001):
-    if H.numel() != 15080 ** 2:
+    # H is a tensor or a HessianStore, of which only the diagonal and kernel blocks are read at once
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * tau
     coords = generate_kernel_coords()
 
-    sum_diag = torch.diag(reg).abs().sum().item()
-    sum_all  = reg.abs().sum().item()
+    diag = H.diagonal()
+    sum_diag = (diag + tau).abs().sum().item()
+    sum_all  = abs_sum(H) - diag.abs().sum().item() + sum_diag
     sum_block=0
     for (a,b) in coords:
-        sum_block += reg[a:b,a:b].abs().sum().item()
+        block = H[a:b,a:b]
+        sum_block += block.abs().sum().item() - block.diagonal().abs().sum().item() \
+            + (block.diagonal() + tau).abs().sum().item()
 
     print(f"Sum of diagonal         : {sum_diag:.2f}")
     print(f"Sum of kernel diagonal  : {sum_block:.2f}")
@@ -23,16 +27,17 @@ def calculateDominance(H, tau = 0.00001):
     return sum_diag/sum_all, sum_block/sum_all
 
 def calculateEigval(H, regParam = 0.00001):
-    if H.numel() != 15080 ** 2:
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * regParam
+    # only the leading 1000 x 1000 block is read
+    reg = H[:1000,:1000].clone()
+    reg.diagonal().add_(regParam)
     # coords = generate_kernel_coords()
 
     try:
-        eig = torch.eig(reg[:1000,:1000])[0].cpu()
+        eig = torch.eig(reg)[0].cpu()
     except:
-        eig = torch.linalg.eigvals(reg[:1000,:1000])[0].cpu()
+        eig = torch.linalg.eigvals(reg)[0].cpu()
 
     if eig[:,1].abs().max() > 1e-30:
         raise ValueError('The eigenvalues of the matrix contain imaginary parts')
@@ -53,15 +58,29 @@ def calculateEigval(H, regParam = 0.00001):
     # for (a,b) in coords:
     #     H_kernel[a:b,a:b] = reg[a:b,a:b]
 
-def generate_kernel_diag(H, tau = 0):
-    if H.numel() != 15080 ** 2:
+def generate_kernel_diag(H, tau = 0, dense = True):
+    # H is a tensor or a HessianStore, of which only the kernel blocks are read. Blocks of equal size are stacked,
+    # the store maps each block size to the start indices and the (regularized) blocks of shape (k, size, size).
+    # With dense = False, only the store is returned, the dense (P, P) view does not fit in memory for large P
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    res = torch.zeros_like(H)
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    H += diag * tau
+    groups = {}
     for (a,b) in generate_kernel_coords():
-        res[a:b,a:b] = H[a:b,a:b]
-
+        groups.setdefault(b - a, []).append(a)
+    store = {}
+    for size, starts in groups.items():
+        blocks = torch.stack([H[a:a+size,a:a+size] for a in starts])
+        blocks.diagonal(dim1=-2, dim2=-1).add_(tau)
+        store[size] = (torch.tensor(starts, device=blocks.device), blocks)
+    if not dense:
+        return store
+
+    res = None
+    for size, (starts, blocks) in store.items():
+        if res is None:
+            res = blocks.new_zeros(H.shape[0], H.shape[0])
+        idx = starts.unsqueeze(1) + torch.arange(size, device=starts.device)
+        res[idx.unsqueeze(2), idx.unsqueeze(1)] = blocks
     return res
 
 def generate_kernel_coords():
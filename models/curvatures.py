@@ -1,17 +1,264 @@
 """Various Fisher information matrix approximations."""
 
 from abc import ABC, abstractmethod
-from typing import Union, List, Any, Dict
+from typing import Union, List, Any, Dict, Tuple, Iterable
 import copy
 
-from numpy.linalg import inv, cholesky
 import torch
 from torch import Tensor
 from torch.nn import Module, Sequential
 import torch.nn.functional as F
 from tqdm import tqdm
 
-from .utilities import get_eigenvectors, kron
+from .jacobians import flatten, unflatten, per_sample_gradients
+from .operators import GGN, randomized_eigh
+from .utilities import get_eigenvectors, packed_offset, packed_size, packed_diagonal, packed_rows, packed_syrk, unpack, \
+    kahan_add
+
+
+def damped_cholesky(matrix: Tensor,
+                    jitter: float = 1e-10,
+                    factor: float = 10.,
+                    retries: int = 10) -> Tensor:
+    """Computes the lower Cholesky factor of a (batch of) symmetric positive definite matrices.
+
+    If the factorization fails, e.g. because of rounding errors on a nearly singular matrix, damping proportional to the
+    mean of the diagonal is added, starting at `jitter` and increasing geometrically by `factor` on each retry. Only the
+    lower triangle of `matrix` is referenced, i.e. the matrix does not need to be symmetrized beforehand.
+
+    Args:
+        matrix: A tensor of shape (..., n, n).
+        jitter: Relative damping of the first retry.
+        factor: Increase of the damping per retry.
+        retries: Maximal number of retries before giving up.
+
+    Returns:
+        The lower Cholesky factor of shape (..., n, n).
+    """
+    chol, info = torch.linalg.cholesky_ex(matrix)
+    if not info.any():
+        return chol
+    eye = torch.eye(matrix.shape[-1], dtype=matrix.dtype, device=matrix.device)
+    scale = matrix.diagonal(dim1=-2, dim2=-1).abs().mean(dim=-1).clamp(min=torch.finfo(matrix.dtype).tiny)
+    damping = jitter
+    for _ in range(retries):
+        chol, info = torch.linalg.cholesky_ex(matrix + (damping * scale)[..., None, None] * eye)
+        if not info.any():
+            print(f"Matrix is not positive definite. Added {damping:.0e} times its mean diagonal.")
+            return chol
+        damping *= factor
+    raise RuntimeError(f"Cholesky decomposition failed with a relative damping of {damping / factor:.0e}.")
+
+
+class PackedCholesky:
+    r"""The upper Cholesky factor `R` of a symmetric positive definite matrix :math:`A=R^TR` in packed storage.
+
+    `A` is given by its upper triangle packed row by row (see `models.utilities.pack`) and factorized in-place by a
+    blocked, left-looking algorithm working on `tile_size` rows at a time, s.t. neither `A` nor `R` is ever unpacked
+    completely. `R` is stored in the same layout, i.e. the factor takes half the memory of a dense Cholesky factor. The
+    diagonal blocks are factorized by `damped_cholesky`.
+    """
+
+    def __init__(self,
+                 packed: Tensor,
+                 size: int = None,
+                 tile_size: int = 1024):
+        """PackedCholesky class initializer. Computes the factorization, overwriting `packed`.
+
+        Args:
+            packed: The packed upper triangle of `A` of shape (P * (P + 1) / 2).
+            size: The number of rows `P` of `A`. Inferred from `packed` if not given.
+            tile_size: The number of rows processed at once.
+        """
+        self.packed = packed
+        self.size = size or packed_size(packed.numel())
+        self.tile_size = tile_size
+        self.dtype = packed.dtype
+        for k, (start, end) in enumerate(self._tiles()):
+            rows = packed_rows(self.packed, self.size, start, end)
+            for prev_start, prev_end in self._tiles()[:k]:
+                prev = packed_rows(self.packed, self.size, prev_start, prev_end)[:, start - prev_start:]
+                rows -= prev[:, :end - start].t() @ prev
+            diag = rows[:, :end - start]
+            upper = damped_cholesky(diag.triu() + diag.triu(diagonal=1).t()).t()
+            rows[:, end - start:] = torch.triangular_solve(rows[:, end - start:], upper, upper=True, transpose=True)[0]
+            rows[:, :end - start] = upper
+            self._write(start, end, rows)
+
+    def _tiles(self) -> List[Tuple[int, int]]:
+        return [(start, min(start + self.tile_size, self.size)) for start in range(0, self.size, self.tile_size)]
+
+    def _write(self,
+               start: int,
+               end: int,
+               rows: Tensor):
+        mask = torch.ones_like(rows, dtype=torch.bool).triu()
+        self.packed[packed_offset(start, self.size):packed_offset(end, self.size)] = rows.masked_select(mask)
+
+    def _backward(self,
+                  rhs: Tensor) -> Tensor:
+        """Solves :math:`Rx=b` in-place for `rhs` of shape (P, k) by block back substitution."""
+        for start, end in reversed(self._tiles()):
+            rows = packed_rows(self.packed, self.size, start, end)
+            rhs[start:end] -= rows[:, end - start:] @ rhs[end:]
+            rhs[start:end] = torch.triangular_solve(rhs[start:end], rows[:, :end - start], upper=True)[0]
+        return rhs
+
+    def _forward(self,
+                 rhs: Tensor) -> Tensor:
+        """Solves :math:`R^Tx=b` in-place for `rhs` of shape (P, k) by block forward substitution."""
+        for start, end in self._tiles():
+            rows = packed_rows(self.packed, self.size, start, end)
+            rhs[start:end] = torch.triangular_solve(rhs[start:end], rows[:, :end - start], upper=True,
+                                                    transpose=True)[0]
+            rhs[end:] -= rows[:, end - start:].t() @ rhs[start:end]
+        return rhs
+
+    def solve(self,
+              rhs: Tensor) -> Tensor:
+        """Computes :math:`A^{-1}b` for `rhs` of shape (P, k)."""
+        return self._backward(self._forward(rhs.to(self.dtype, copy=True)))
+
+    def sample(self,
+               rhs: Tensor) -> Tensor:
+        """Computes :math:`R^{-1}z`, mapping standard normal `rhs` of shape (P, k) to samples with covariance
+        :math:`A^{-1}`."""
+        return self._backward(rhs.to(self.dtype, copy=True))
+
+
+def spd_solve(tensor: Tensor,
+              factor: Union[Tensor, Tuple[Tensor, Tensor], PackedCholesky]) -> Tensor:
+    r"""Multiplies the last dimension of `tensor` by the inverse of a symmetric positive definite matrix `A`.
+
+    Args:
+        tensor: A tensor of shape (..., n).
+        factor: Either the lower Cholesky factor `L` of :math:`A=LL^T`, a `PackedCholesky` or a tuple of the
+                eigenvalues and eigenvectors of `A`, as stored in `inv_state`. The inverse is never formed.
+
+    Returns:
+        The solution of shape (..., n).
+    """
+    if isinstance(factor, PackedCholesky):
+        rows = tensor.reshape(-1, tensor.shape[-1])
+        return factor.solve(rows.t()).t().reshape(tensor.shape).to(tensor.dtype)
+    if isinstance(factor, tuple):
+        eigvals, eigvecs = factor
+        return (((tensor.to(eigvecs.dtype) @ eigvecs) / eigvals) @ eigvecs.t()).to(tensor.dtype)
+    rows = tensor.reshape(-1, tensor.shape[-1]).to(factor.dtype)
+    return torch.cholesky_solve(rows.t(), factor).t().reshape(tensor.shape).to(tensor.dtype)
+
+
+def spd_sample(tensor: Tensor,
+               factor: Union[Tensor, Tuple[Tensor, Tensor], PackedCholesky]) -> Tensor:
+    r"""Maps standard normal samples in the first dimension of `tensor` to samples with covariance :math:`A^{-1}`.
+
+    For a Cholesky factor, :math:`L^Tx=z` is solved by back substitution. For an eigendecomposition
+    :math:`A=U\Lambda U^T`, :math:`x=U\Lambda^{-1/2}z`.
+
+    Args:
+        tensor: Standard normal samples of shape (n, ...).
+        factor: Either the lower Cholesky factor `L` of :math:`A=LL^T`, a `PackedCholesky` or a tuple of the
+                eigenvalues and eigenvectors of `A`, as stored in `inv_state`.
+
+    Returns:
+        The samples of shape (n, ...).
+    """
+    rows = tensor.reshape(tensor.shape[0], -1)
+    if isinstance(factor, PackedCholesky):
+        return factor.sample(rows).reshape(tensor.shape)
+    if isinstance(factor, tuple):
+        eigvals, eigvecs = factor
+        return (eigvecs @ (rows.to(eigvecs.dtype) * eigvals.rsqrt().unsqueeze(1))).reshape(tensor.shape)
+    return torch.triangular_solve(rows.to(factor.dtype), factor, upper=False, transpose=True)[0].reshape(tensor.shape)
+
+
+def eigendecomposition(matrix: Tensor,
+                       upper: bool = False) -> Tuple[Tensor, Tensor]:
+    """Computes the eigendecomposition of a symmetric positive semi-definite matrix.
+
+    Negative eigenvalues, caused by rounding errors, are clipped to zero.
+
+    Args:
+        matrix: A tensor of shape (n, n).
+        upper: Whether to read the upper instead of the lower triangle of `matrix`.
+
+    Returns:
+        The eigenvalues of shape (n,) and the eigenvectors of shape (n, n) as columns.
+    """
+    eigvals, eigvecs = torch.linalg.eigh(matrix, UPLO='U' if upper else 'L')
+    return eigvals.clamp(min=0), eigvecs
+
+
+class FlatGradient:
+    """A persistent, contiguous gradient buffer for a list of parameters.
+
+    The `.grad` attribute of each parameter is set to a view into a single preallocated tensor. As autograd accumulates
+    into existing gradients in-place, the concatenated gradient of all parameters can be read after each backward pass
+    without allocating or concatenating anything. Gradients replaced by other means are detected and copied into the
+    buffer on the next read. As `zero_grad()` sets gradients to None by default in recent PyTorch versions, which causes
+    such a copy on every read, callers should use `zero_grad(set_to_none=False)`.
+    """
+
+    def __init__(self,
+                 parameters: List[Tensor]):
+        """FlatGradient class initializer.
+
+        Args:
+            parameters: The parameters whose gradients are stored, in the order of the flat buffer.
+        """
+        self.parameters = list(parameters)
+        self.buffer = self.parameters[0].new_zeros(sum(param.numel() for param in self.parameters))
+        self.views = list()
+        start = 0
+        for param in self.parameters:
+            self.views.append(self.buffer[start:start + param.numel()].view_as(param))
+            start += param.numel()
+        self.attach()
+
+    def attach(self):
+        """Makes the `.grad` attribute of each parameter a view into the buffer, keeping the current gradient.
+
+        Parameters without gradient are left untouched, s.t. e.g. optimizers still skip them, and read as zero.
+        """
+        for param, view in zip(self.parameters, self.views):
+            if param.grad is None:
+                view.zero_()
+            elif param.grad.data_ptr() != view.data_ptr():
+                view.copy_(param.grad)
+                param.grad = view
+
+    def __call__(self) -> Tensor:
+        """Returns the flat gradient of all parameters, re-attaching stale views first.
+
+        Returns:
+            The gradient buffer of shape (P,). It is overwritten by subsequent backward passes.
+        """
+        self.attach()
+        return self.buffer
+
+
+def _copy_state(value: Any) -> Any:
+    """Copies an accumulated or inverted value, s.t. in-place updates of the copy do not alter the original."""
+    if isinstance(value, Tensor):
+        return value.clone()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_state(item) for item in value)
+    return copy.deepcopy(value)
+
+
+def _add_states(first: Union[Tensor, list, tuple, None],
+                second: Union[Tensor, list, tuple, None]) -> Union[Tensor, list, tuple, None]:
+    """Adds two accumulated values, which are either tensors or (nested) lists or tuples of tensors or None.
+
+    The result never shares memory with `second`, as it is updated in-place by subsequent calls to `update`.
+    """
+    if first is None:
+        return _copy_state(second)
+    if second is None:
+        return first
+    if isinstance(first, (list, tuple)):
+        return type(first)(_add_states(a, b) for a, b in zip(first, second))
+    return first + second
 
 
 class Curvature(ABC):
@@ -34,16 +281,22 @@ class Curvature(ABC):
     Source: `Optimizing Neural Networks with Kronecker-factored Approximate Curvature
     <https://arxiv.org/abs/1503.05671>`_
     """
+    # Attributes summed over batches by `update`, keyed by module
+    _accumulators = ['state']
 
     def __init__(self,
                  model: Union[Module, Sequential],
-                 layer_types: Union[List[str], str] = None):
+                 layer_types: Union[List[str], str] = None,
+                 layer_names: Union[List[str], str] = None):
         """Curvature class initializer.
 
         Args:
             model: Any (pre-trained) PyTorch model including all `torchvision` models.
             layer_types: Types of layers for which to compute src information. Supported are `Linear`, `Conv2d`
                          and `MultiheadAttention`. If `None`, all supported types are considered. Default: None.
+            layer_names: Names of the modules (as in `model.named_modules()`) for which to compute src information,
+                         e.g. only the last layer (see `models.utilities.last_layer`). All other layers stay at their
+                         MAP estimate. If `None`, all layers of `layer_types` are selected. Default: None.
         """
         self.model = model
         self.model_state = copy.deepcopy(model.state_dict())
@@ -61,8 +314,180 @@ class Curvature(ABC):
             raise TypeError
         for _type in self.layer_types:
             assert _type in ['Linear', 'Conv2d', 'MultiheadAttention']
+        modules = dict(model.named_modules())
+        if isinstance(layer_names, str):
+            layer_names = [layer_names]
+        for name in layer_names or list():
+            assert name in modules, f"The model has no module named {name}."
+            assert modules[name].__class__.__name__ in self.layer_types, f"{name} is not of a selected layer type."
+        self.selection = [module for name, module in modules.items() if module.__class__.__name__ in self.layer_types
+                          and (not layer_names or name in layer_names)]
         self.state = dict()
         self.inv_state = dict()
+        self.hooks = list()
+        self.record = dict()
+        self.eigen = dict()
+        self.samples = 0
+        self.compute_dtype = None
+        self.accumulation = None
+        self.compensation = dict()
+        self.reference = dict()
+
+    def _selects(self,
+                 layer: Module) -> bool:
+        """Whether src information is computed for `layer`, see `layer_types` and `layer_names`."""
+        return any(layer is module for module in self.selection)
+
+    def mixed_precision(self,
+                        compute_dtype: torch.dtype = torch.bfloat16,
+                        accumulation: str = 'kahan',
+                        reference: bool = False) -> 'Curvature':
+        """Computes the per-batch outer products in reduced precision while keeping an accurate running sum.
+
+        Only affects approximations accumulating outer products, i.e. `KFAC`, `BlockDiagonal` (through `_accumulate`)
+        and `DenseCurvature` (in `flush`).
+
+        Args:
+            compute_dtype: Data type of the per-batch outer products, e.g. `torch.bfloat16` or `torch.float16`.
+            accumulation: Either `kahan` for a compensated sum in the data type of the model (of the running sum for
+                          `DenseCurvature`) or `fp64` for a running sum in double precision.
+            reference: If True, additionally accumulates the outer products in double precision as reference for
+                       `drift`. This is slow and only meant to choose a setting.
+
+        Returns:
+            The curvature instance itself.
+        """
+        assert accumulation in ['kahan', 'fp64'], f"Unknown accumulation {accumulation}."
+        self.compute_dtype = compute_dtype
+        self.accumulation = accumulation
+        extra = ['compensation'] if accumulation == 'kahan' else []
+        extra += ['reference'] if reference else []
+        self._accumulators = type(self)._accumulators + extra
+        return self
+
+    def _accumulate(self,
+                    key: Any,
+                    factors: Union[Tensor, List[Tensor]],
+                    scales: Union[float, List[float]] = 1.,
+                    packed: bool = False):
+        r"""Adds the outer products :math:`sFF^T` of one or more factors `F` to `state[key]`.
+
+        The products are computed in `compute_dtype` and summed as configured by `mixed_precision`. Without it, this is
+        a plain sum in the data type of the factors.
+
+        Args:
+            key: The key in `state`, whose value is a tensor for a single factor or a list of tensors otherwise.
+            factors: One or more tensors of shape (n, k).
+            scales: The scale `s` of each factor.
+            packed: If True, only the upper triangle of each product is accumulated in packed form, see `packed_syrk`.
+        """
+        single = isinstance(factors, Tensor)
+        if single:
+            factors, scales = [factors], [scales]
+        values = list()
+        for factor, scale in zip(factors, scales):
+            low = factor if self.compute_dtype is None else factor.to(self.compute_dtype)
+            dtype = torch.float64 if self.accumulation == 'fp64' else factor.dtype
+            if packed:
+                value = factor.new_zeros(factor.shape[0] * (factor.shape[0] + 1) // 2, dtype=dtype)
+                packed_syrk(value, low.t())
+            else:
+                value = (low @ low.t()).to(dtype)
+            values.append(value.mul_(scale))
+
+        if key not in self.state:
+            self.state[key] = values[0] if single else values
+            if self.accumulation == 'kahan':
+                compensation = [torch.zeros_like(value) for value in values]
+                self.compensation[key] = compensation[0] if single else compensation
+        elif self.accumulation == 'kahan':
+            state = [self.state[key]] if single else self.state[key]
+            compensation = [self.compensation[key]] if single else self.compensation[key]
+            for value, total, error in zip(values, state, compensation):
+                kahan_add(total, value, error)
+        else:
+            for value, total in zip(values, [self.state[key]] if single else self.state[key]):
+                total.add_(value)
+
+        if 'reference' in self._accumulators:
+            reference = list()
+            for factor, scale in zip(factors, scales):
+                if packed:
+                    value = factor.new_zeros(factor.shape[0] * (factor.shape[0] + 1) // 2, dtype=torch.float64)
+                    packed_syrk(value, factor.double().t())
+                else:
+                    value = factor.double() @ factor.double().t()
+                reference.append(value.mul_(scale))
+            self.reference[key] = _add_states(self.reference.get(key), reference[0] if single else reference)
+
+    def drift(self) -> Dict[str, float]:
+        """Measures the relative error of the accumulated state against the double precision reference.
+
+        Requires `mixed_precision` with `reference=True`.
+
+        Returns:
+            A dict mapping module names (and factor indices, if any) to the relative Frobenius norm error.
+        """
+        assert self.reference, "No reference accumulated. Did you call 'mixed_precision' with 'reference=True'?"
+        names = {module: name for name, module in self.model.named_modules()}
+        drift = dict()
+        for key, reference in self.reference.items():
+            state = self.state[key]
+            if isinstance(reference, Tensor):
+                reference, state, suffix = [reference], [state], ['']
+            else:
+                suffix = [f'.{index}' for index in range(len(reference))]
+            for ref, value, index in zip(reference, state, suffix):
+                error = (value.double() - ref).norm() / ref.norm().clamp(min=torch.finfo(torch.float64).tiny)
+                drift[f'{names.get(key, key)}{index}'] = error.item()
+        return drift
+
+    def _register_hooks(self):
+        """Records the inputs and output gradients of all selected layers in `record`.
+
+        Forward and backward hook handles are stored in `hooks` for subsequent removal.
+        """
+        for layer in self.model.modules():
+            if self._selects(layer):
+                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
+                    self.record[layer] = [None, None]
+                    self.hooks.append(layer.register_forward_pre_hook(self._save_input))
+                    self.hooks.append(layer.register_backward_hook(self._save_output))
+                elif layer.__class__.__name__ == 'MultiheadAttention':
+                    raise NotImplementedError
+
+    def remove(self):
+        """Removes all forward and backward hooks from the model, e.g. once accumulation has finished.
+
+        The recorded inputs and output gradients are released as well. Inversion, sampling and predictions only need
+        the accumulated state and keep working.
+        """
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = list()
+        self.record = dict()
+
+    def _save_input(self, module, input):
+        self.record[module][0] = input[0]
+
+    def _save_output(self, module, grad_input, grad_output):
+        self.record[module][1] = grad_output[0] * grad_output[0].size(0)
+
+    def _per_sample_gradients(self,
+                              layer: Module) -> Tensor:
+        """Computes the per-example gradients of `layer` from its recorded inputs and output gradients.
+
+        As the output gradients are rescaled by the batch size, these are the gradients of the per-example losses
+        for losses averaged over the batch.
+
+        Args:
+            layer: A `Linear` or `Conv2d` layer instance from the current model.
+
+        Returns:
+            The per-example gradients of shape (batch, P) following the parameter order of `layer`.
+        """
+        forward, backward = self.record[layer]
+        return flatten({layer: per_sample_gradients(layer, forward.detach(), backward.detach())})
 
     @staticmethod
     def _replace(sample: Tensor,
@@ -86,6 +511,15 @@ class Curvature(ABC):
         """Abstract method to be implemented by each derived class individually."""
         raise NotImplementedError
 
+    @abstractmethod
+    def eigendecompose(self):
+        """Caches an eigendecomposition of each block or Kronecker factor of `state` in `eigen`.
+
+        Subsequent calls to `invert` only rescale the cached eigenvalues, s.t. sweeping `add` and `multiply` costs a
+        single factorization. The cache is cleared by `update`.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def invert(self,
                add: Union[float, list, tuple] = 0.,
@@ -103,22 +537,103 @@ class Curvature(ABC):
 
     @abstractmethod
     def sample(self,
-               layer: Module) -> Tensor:
+               layer: Module,
+               samples: int = None) -> Tensor:
         """Abstract method to be implemented by each derived class individually. Samples from inverted state.
 
         Args:
             layer: A layer instance from the current model.
+            samples: If given, the number of samples drawn at once. Default: None, i.e. a single sample.
+
+        Returns:
+            A tensor with newly sampled weights for the given layer of shape (out, in), bias as last column if present,
+            or a stack of shape (samples, out, in).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _sigma_product(self,
+                       layer: Union[Module, str],
+                       jacobian: Tensor) -> Tensor:
+        """Abstract method to be implemented by each derived class individually. Multiplies by the inverted state.
+
+        Args:
+            layer: A layer instance from the current model.
+            jacobian: Jacobians of shape (..., out, in) w.r.t. the weights of `layer`, bias as last column if present.
 
         Returns:
-            A tensor with newly sampled weights for the given layer.
+            The product of each Jacobian with the posterior covariance of `layer`, of the same shape as `jacobian`.
         """
         raise NotImplementedError
 
+    def predictive_variance(self,
+                            jacobians: Dict[Module, Tensor]) -> Tensor:
+        r"""Computes the predictive variance :math:`J\Sigma J^T` without materializing the posterior covariance.
+
+        Layers are assumed to be independent, s.t. the predictive variance is the sum over the contributions of all
+        layers present in the inverted state. Layers without inverted state are considered deterministic.
+
+        Args:
+            jacobians: A dict mapping layers to Jacobians of shape (..., out, in), bias as last column if present, as
+                       computed by `models.jacobians.Jacobian`.
+
+        Returns:
+            The predictive variance of shape (...), e.g. (batch, outputs).
+        """
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        variance = 0.
+        for layer, jacobian in jacobians.items():
+            if layer in self.inv_state:
+                variance = variance + (jacobian * self._sigma_product(layer, jacobian)).sum(dim=(-2, -1))
+        return variance
+
+    def predictive_covariance(self,
+                              jacobians: Dict[Module, Tensor]) -> Tensor:
+        r"""Computes the covariance :math:`J\Sigma J^T` between all outputs of the linearized model.
+
+        As `predictive_variance`, but including the covariances between outputs, e.g. between the logits of all classes
+        as required by the linearized (GLM) predictive.
+
+        Args:
+            jacobians: A dict mapping layers to Jacobians of shape (..., C, out, in), bias as last column if present, as
+                       computed by `models.jacobians.Jacobian`.
+
+        Returns:
+            The predictive covariance of shape (..., C, C), e.g. (batch, classes, classes).
+        """
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        covariance = 0.
+        for layer, jacobian in jacobians.items():
+            if layer in self.inv_state:
+                product = self._sigma_product(layer, jacobian)
+                covariance = covariance + torch.einsum('...coi,...doi->...cd', jacobian, product)
+        return covariance
+
+    def draw(self,
+             samples: int = None) -> Dict[Module, Tensor]:
+        """Samples weight offsets for all selected `Linear` and `Conv2d` layers.
+
+        Args:
+            samples: If given, the number of samples drawn at once. Default: None, i.e. a single sample.
+
+        Returns:
+            A dict mapping layers to sampled offsets of shape (out, in) or (samples, out, in), bias as last column if
+            present.
+        """
+        draws = dict()
+        for layer in self.model.modules():
+            if self._selects(layer):
+                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
+                    draws[layer] = self.sample(layer, samples)
+                elif layer.__class__.__name__ == 'MultiheadAttention':
+                    raise NotImplementedError
+        return draws
+
     def sample_and_replace(self):
         """Samples new model parameters and replaces old ones for selected layers, skipping all others."""
         self.model.load_state_dict(self.model_state)
         for layer in self.model.modules():
-            if layer.__class__.__name__ in self.layer_types:
+            if self._selects(layer):
                 if layer.__class__.__name__ in ['Linear', 'Conv2d']:
                     _sample = self.sample(layer)
                     self._replace(_sample, layer.weight, layer.bias)
@@ -128,21 +643,69 @@ class Curvature(ABC):
                         _sample = self.sample(layer)
                         self._replace(_sample, weight, bias)
 
-    # feat: add save/load model functions
-    def save(self, filename):         
-        torch.save({
-            'state': self.state,
-            'inv_state': self.inv_state,
-            'model': self.model,}, filename)
-        print('Writting %s complete!\n' % filename)     
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the accumulated and inverted state, keyed by module names, alongside the number of samples seen.
+
+        In contrast to the curvature instance itself, the result does not reference the model, s.t. it can be saved,
+        loaded into a fresh model of the same architecture and merged with other states.
+
+        Returns:
+            A dict of the class name, the sample count, the accumulators (see `_accumulators`) and `inv_state`.
+        """
+        names = {module: name for name, module in self.model.named_modules()}
+        state_dict = {'type': self.__class__.__name__, 'samples': self.samples}
+        for attr in self._accumulators + ['inv_state']:
+            state_dict[attr] = {names.get(key, key): value for key, value in getattr(self, attr).items()}
+        return state_dict
+
+    def load_state_dict(self,
+                        state_dict: Dict[str, Any]):
+        """Replaces the current state by a copy of a state returned by `state_dict`.
+
+        Args:
+            state_dict: The state of a curvature instance of the same type, computed for a model of the same
+                        architecture.
+        """
+        assert state_dict['type'] == self.__class__.__name__, f"Cannot load {state_dict['type']} state."
+        modules = dict(self.model.named_modules())
+        for attr in self._accumulators + ['inv_state']:
+            setattr(self, attr, {modules.get(key, key): _copy_state(value) for key, value in state_dict[attr].items()})
+        self.samples = state_dict['samples']
+        self.eigen.clear()
+
+    def merge(self,
+              other: Union['Curvature', Dict[str, Any]]):
+        """Adds the accumulated state and the sample count of another curvature instance to this one.
+
+        As all approximations accumulate sums over batches, the result is identical to having accumulated both in a
+        single instance, e.g. to combine shards of a dataset processed on different machines or days.
+
+        Args:
+            other: A curvature instance of the same type or its `state_dict`, computed for a model of the same
+                   architecture.
+        """
+        if isinstance(other, Curvature):
+            other = other.state_dict()
+        assert other['type'] == self.__class__.__name__, f"Cannot merge {other['type']} state."
+        modules = dict(self.model.named_modules())
+        for attr in self._accumulators:
+            accumulated = getattr(self, attr)
+            for name, value in other[attr].items():
+                key = modules.get(name, name)
+                accumulated[key] = _add_states(accumulated.get(key), value)
+        self.samples += other['samples']
+        self.eigen.clear()
+
+    def save(self, filename):
+        torch.save(self.state_dict(), filename)
+        print('Writting %s complete!\n' % filename)
 
     def load(self, filename):
-        state_dict = torch.load(filename)
-        self.state = state_dict['state']
-        self.inv_state = state_dict['inv_state']
-        self.model = state_dict['model']
+        device = next(self.model.parameters()).device
+        self.load_state_dict(torch.load(filename, map_location=device))
         print('Loading %s complete!\n' % filename)
-        
+
+
 class Diagonal(Curvature):
     r"""The diagonal Fisher information or Generalized Gauss Newton matrix approximation.
 
@@ -159,8 +722,9 @@ class Diagonal(Curvature):
         Args:
             batch_size: The size of the current batch.
         """
+        self.samples += batch_size
         for layer in self.model.modules():
-            if layer.__class__.__name__ in self.layer_types:
+            if self._selects(layer):
                 if layer.__class__.__name__ in ['Linear', 'Conv2d']:
                     grads = layer.weight.grad.contiguous().view(layer.weight.grad.shape[0], -1)
                     if layer.bias is not None:
@@ -201,10 +765,21 @@ class Diagonal(Curvature):
                 n, s = add, multiply
             self.inv_state[layer] = torch.reciprocal(s * value + n).sqrt()
 
+    def eigendecompose(self):
+        """Nothing to cache, `invert` already only rescales `state`."""
+
     def sample(self,
-               layer: Union[Module, str]):
+               layer: Union[Module, str],
+               samples: int = None) -> Tensor:
         assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
-        return self.inv_state[layer].new(self.inv_state[layer].size()).normal_() * self.inv_state[layer]
+        std = self.inv_state[layer]
+        shape = std.size() if samples is None else (samples, *std.size())
+        return std.new(*shape).normal_() * std
+
+    def _sigma_product(self,
+                       layer: Union[Module, str],
+                       jacobian: Tensor) -> Tensor:
+        return jacobian * self.inv_state[layer] ** 2
 
 
 class BlockDiagonal(Curvature):
@@ -215,6 +790,29 @@ class BlockDiagonal(Curvature):
 
     Source: `A Scalable Laplace Approximation for Neural Networks <https://openreview.net/pdf?id=Skdvd2xAZ>`_
     """
+    def __init__(self,
+                 model: Union[Module, Sequential],
+                 layer_types: Union[List[str], str] = None,
+                 per_sample: bool = False,
+                 packed: bool = False,
+                 layer_names: Union[List[str], str] = None):
+        """BlockDiagonal class initializer.
+
+        Args:
+            model: Any (pre-trained) PyTorch model including all `torchvision` models.
+            layer_types: Types of layers for which to compute src information.
+            per_sample: If True, sums the outer products of the per-example gradients instead of using the gradient of
+                        the batch loss. Only `Linear` and `Conv2d` layers are supported.
+            packed: If True, only the upper triangle of each `Linear` and `Conv2d` block is accumulated and stored in
+                    packed form, which halves the memory of the state, the inverse state and of checkpoints.
+            layer_names: Names of the selected modules, see `Curvature`.
+        """
+        super().__init__(model, layer_types, layer_names)
+        self.per_sample = per_sample
+        self.packed = packed
+        if per_sample:
+            self._register_hooks()
+
     def update(self,
                batch_size: int):
         """Computes the block-diagonal (per-layer) src selected layer types, skipping all others.
@@ -222,17 +820,19 @@ class BlockDiagonal(Curvature):
         Args:
             batch_size: The size of the current batch.
         """
+        self.samples += batch_size
+        self.eigen.clear()
         for layer in self.model.modules():
-            if layer.__class__.__name__ in self.layer_types:
+            if self._selects(layer):
                 if layer.__class__.__name__ in ['Linear', 'Conv2d']:
-                    grads = layer.weight.grad.contiguous().view(-1)
-                    if layer.bias is not None:
-                        grads = torch.cat([grads, layer.bias.grad])
-                    grads = torch.ger(grads, grads) * batch_size
-                    if layer in self.state:
-                        self.state[layer] += grads
+                    if self.per_sample:
+                        grads = self._per_sample_gradients(layer)
                     else:
-                        self.state[layer] = grads
+                        grads = layer.weight.grad.contiguous().view(-1)
+                        if layer.bias is not None:
+                            grads = torch.cat([grads, layer.bias.grad])
+                        grads = grads.unsqueeze(0) * batch_size ** 0.5
+                    self._accumulate(layer, grads.t(), packed=self.packed)
                 elif layer.__class__.__name__ == 'MultiheadAttention':
                     grads = layer.in_proj_weight.grad.contiguous().view(layer.in_proj_weight.grad.shape[0], -1)
                     if layer.in_proj_bias is not None:
@@ -264,15 +864,172 @@ class BlockDiagonal(Curvature):
                 n, s = add[index], multiply[index]
             else:
                 n, s = add, multiply
-            reg = torch.diag(value.new(value.shape[0]).fill_(n))
-            self.inv_state[layer] = torch.pinverse(s * value + reg)
+            if layer in self.eigen:
+                eigvals, eigvecs = self.eigen[layer]
+                self.inv_state[layer] = (s * eigvals + n, eigvecs)
+            elif value.dim() == 1:
+                reg = s * value
+                reg[packed_diagonal(packed_size(reg.numel()), reg.device)] += n
+                self.inv_state[layer] = PackedCholesky(reg)
+            else:
+                reg = s * value
+                reg.diagonal().add_(n)
+                # Only the Cholesky factor of the precision is kept, the covariance is never formed
+                self.inv_state[layer] = damped_cholesky(reg)
+
+    def eigendecompose(self):
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        for layer, value in self.state.items():
+            if value.dim() == 1:
+                value = unpack(value, packed_size(value.numel()))
+            self.eigen[layer] = eigendecomposition(value)
+
+    def sample(self,
+               layer: Module,
+               samples: int = None) -> Tensor:
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        value = self.state[layer]
+        size = packed_size(value.numel()) if value.dim() == 1 else value.shape[0]
+        x = spd_sample(value.new(size, samples or 1).normal_(), self.inv_state[layer]).t()
+        return unflatten(x if samples else x[0], layer)
+
+    def _sigma_product(self,
+                       layer: Module,
+                       jacobian: Tensor) -> Tensor:
+        return unflatten(spd_solve(flatten({layer: jacobian}), self.inv_state[layer]), layer)
+
+class KernelBlockDiagonal(Curvature):
+    r"""The kernel-block-diagonal Fisher information or Generalized Gauss Newton matrix approximation.
+
+    Refines the block-diagonal approximation by additionally assuming independence between the output neurons
+    (filters) of each layer: the weights into each output neuron form one block of size `in` (`in_channels * kh * kw`
+    for `Conv2d`) and the bias of each layer forms another block of size `out`. Memory and inversion cost scale with the
+    sum of the squared block sizes instead of :math:`P^2`, and all blocks of a layer are inverted in a single batched
+    call.
+    """
+    def __init__(self,
+                 model: Union[Module, Sequential],
+                 layer_types: Union[List[str], str] = None,
+                 per_sample: bool = False,
+                 layer_names: Union[List[str], str] = None):
+        """KernelBlockDiagonal class initializer.
+
+        Args:
+            model: Any (pre-trained) PyTorch model including all `torchvision` models.
+            layer_types: Types of layers for which to compute src information. Supported are `Linear` and `Conv2d`.
+            per_sample: If True, sums the outer products of the per-example gradients instead of using the gradient of
+                        the batch loss.
+            layer_names: Names of the selected modules, see `Curvature`.
+        """
+        super().__init__(model, layer_types, layer_names)
+        self.per_sample = per_sample
+        if per_sample:
+            self._register_hooks()
+
+    def update(self,
+               batch_size: int):
+        """Computes the weight blocks of each output neuron (filter) and the bias block of each selected layer.
+
+        Args:
+            batch_size: The size of the current batch.
+        """
+        self.samples += batch_size
+        self.eigen.clear()
+        for layer in self.model.modules():
+            if self._selects(layer):
+                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
+                    if self.per_sample:
+                        forward, backward = self.record[layer]
+                        grads = per_sample_gradients(layer, forward.detach(), backward.detach())
+                        weight = grads[..., :layer.weight[0].numel()]
+                        weight_blocks = torch.einsum('noi,noj->oij', weight, weight)
+                        bias_block = grads[..., -1].t() @ grads[..., -1] if layer.bias is not None else None
+                    else:
+                        weight = layer.weight.grad.reshape(layer.weight.shape[0], -1)
+                        weight_blocks = torch.einsum('oi,oj->oij', weight, weight) * batch_size
+                        bias_block = torch.ger(layer.bias.grad, layer.bias.grad) * batch_size \
+                            if layer.bias is not None else None
+                    if layer in self.state:
+                        self.state[layer][0] += weight_blocks
+                        if bias_block is not None:
+                            self.state[layer][1] += bias_block
+                    else:
+                        self.state[layer] = [weight_blocks, bias_block]
+                elif layer.__class__.__name__ == 'MultiheadAttention':
+                    raise NotImplementedError
+
+    def invert(self,
+               add: Union[float, list, tuple] = 0.,
+               multiply: Union[float, list, tuple] = 1.):
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        if self.inv_state:
+            Warning("State has already been inverted. Is this expected?")
+        for index, (layer, (weight_blocks, bias_block)) in enumerate(self.state.items()):
+            if isinstance(add, (list, tuple)) and isinstance(multiply, (list, tuple)):
+                assert len(add) == len(multiply) == len(self.state)
+                n, s = add[index], multiply[index]
+            else:
+                n, s = add, multiply
+            if layer in self.eigen:
+                (eigvals, eigvecs), bias_eigen = self.eigen[layer]
+                chol_bias = None
+                if bias_eigen is not None:
+                    chol_bias = (s * bias_eigen[0] + n, bias_eigen[1])
+                self.inv_state[layer] = ((s * eigvals + n, eigvecs), chol_bias)
+                continue
+            reg = s * weight_blocks
+            reg.diagonal(dim1=-2, dim2=-1).add_(n)
+            chol_bias = None
+            if bias_block is not None:
+                reg_bias = s * bias_block
+                reg_bias.diagonal().add_(n)
+                chol_bias = damped_cholesky(reg_bias)
+            self.inv_state[layer] = (damped_cholesky(reg), chol_bias)
+
+    def eigendecompose(self):
+        """Caches the eigendecompositions of the weight blocks of each layer, batched over blocks, and of its bias."""
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        for layer, (weight_blocks, bias_block) in self.state.items():
+            bias_eigen = eigendecomposition(bias_block) if bias_block is not None else None
+            self.eigen[layer] = (eigendecomposition(weight_blocks), bias_eigen)
 
     def sample(self,
-               layer: Module) -> Tensor:
+               layer: Module,
+               samples: int = None) -> Tensor:
         assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
-        x = self.inv_state[layer].new(self.inv_state[layer].shape[0]).normal_() @ self.inv_state[layer]
-        return torch.cat([x[:layer.weight.numel()].contiguous().view(*layer.weight.shape),
-                          torch.unsqueeze(x[layer.weight.numel():], dim=1)], dim=1)
+        chol, chol_bias = self.inv_state[layer]
+        if isinstance(chol, tuple):
+            eigvals, eigvecs = chol
+            z = eigvecs.new(*eigvecs.shape[:2], samples or 1).normal_()
+            x = eigvecs @ (z * eigvals.rsqrt().unsqueeze(-1))
+        else:
+            z = chol.new(*chol.shape[:2], samples or 1).normal_()
+            x = torch.triangular_solve(z, chol, upper=False, transpose=True)[0]
+        if chol_bias is not None:
+            bias = spd_sample(x.new(x.shape[0], samples or 1).normal_(), chol_bias)
+            x = torch.cat([x, bias.unsqueeze(1)], dim=1)
+        x = x.permute(2, 0, 1)
+        return x if samples else x[0]
+
+    def _sigma_product(self,
+                       layer: Module,
+                       jacobian: Tensor) -> Tensor:
+        chol, chol_bias = self.inv_state[layer]
+        if isinstance(chol, tuple):
+            eigvals, eigvecs = chol
+            out, size = eigvecs.shape[:2]
+            weight = jacobian[..., :size].reshape(-1, out, size).permute(1, 2, 0).to(eigvecs.dtype)
+            product = eigvecs @ ((eigvecs.transpose(-2, -1) @ weight) / eigvals.unsqueeze(-1))
+        else:
+            out, size = chol.shape[:2]
+            weight = jacobian[..., :size].reshape(-1, out, size).permute(1, 2, 0).to(chol.dtype)
+            product = torch.cholesky_solve(weight, chol)
+        product = product.permute(2, 0, 1).reshape(*jacobian.shape[:-1], size)
+        product = product.to(jacobian.dtype)
+        if chol_bias is not None:
+            product = torch.cat([product, spd_solve(jacobian[..., -1], chol_bias).unsqueeze(-1)], dim=-1)
+        return product
+
 
 class KFAC(Curvature):
     r"""The Kronecker-factored Fisher information matrix approximation.
@@ -294,7 +1051,8 @@ class KFAC(Curvature):
     """
     def __init__(self,
                  model: Union[Module, Sequential],
-                 layer_types: Union[List[str], str] = None):
+                 layer_types: Union[List[str], str] = None,
+                 layer_names: Union[List[str], str] = None):
         """KFAC class initializer.
 
         For the recursive computation of `H`, outputs and inputs for each layer are recorded in `record`. Forward and
@@ -302,25 +1060,10 @@ class KFAC(Curvature):
 
         Args:
             model: Any (pre-trained) PyTorch model including all `torchvision` models.
+            layer_names: Names of the selected modules, see `Curvature`.
         """
-        super().__init__(model, layer_types)
-        self.hooks = list()
-        self.record = dict()
-
-        for layer in model.modules():
-            if layer.__class__.__name__ in self.layer_types:
-                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
-                    self.record[layer] = [None, None]
-                    self.hooks.append(layer.register_forward_pre_hook(self._save_input))
-                    self.hooks.append(layer.register_backward_hook(self._save_output))
-                elif layer.__class__.__name__ == 'MultiheadAttention':
-                    raise NotImplementedError
-
-    def _save_input(self, module, input):
-        self.record[module][0] = input[0]
-
-    def _save_output(self, module, grad_input, grad_output):
-        self.record[module][1] = grad_output[0] * grad_output[0].size(0)
+        super().__init__(model, layer_types, layer_names)
+        self._register_hooks()
 
     def update(self,
                batch_size: int):
@@ -331,9 +1074,11 @@ class KFAC(Curvature):
         Args:
             batch_size: The size of the current batch.
         """
+        self.samples += batch_size
+        self.eigen.clear()
         for layer in self.model.modules():
             module_class = layer.__class__.__name__
-            if layer.__class__.__name__ in self.layer_types:
+            if self._selects(layer):
                 if module_class in ['Linear', 'Conv2d']:
                     forward, backward = self.record[layer]
 
@@ -346,21 +1091,16 @@ class KFAC(Curvature):
                     if layer.bias is not None:
                         ones = torch.ones_like(forward[:1])
                         forward = torch.cat([forward, ones], dim=0)
-                    first_factor = torch.mm(forward, forward.t()) / float(forward.shape[1])
 
                     # 2nd factor: H
                     if module_class == 'Conv2d':
                         backward = backward.data.permute(1, 0, 2, 3).contiguous().view(backward.shape[1], -1)
                     else:
                         backward = backward.data.t()
-                    second_factor = torch.mm(backward, backward.t()) / float(backward.shape[1])
 
                     # Expectation
-                    if layer in self.state:
-                        self.state[layer][0] += first_factor
-                        self.state[layer][1] += second_factor
-                    else:
-                        self.state[layer] = [first_factor, second_factor]
+                    self._accumulate(layer, [forward, backward], [1 / float(forward.shape[1]),
+                                                                  1 / float(backward.shape[1])])
                 elif layer.__class__.__name__ == 'MultiheadAttention':
                     raise NotImplementedError
 
@@ -378,31 +1118,44 @@ class KFAC(Curvature):
                 n, s = float(add), float(multiply)
             first, second = value
 
-            diag_frst = torch.diag(first.new(first.shape[0]).fill_(n ** 0.5))
-            diag_scnd = torch.diag(second.new(second.shape[0]).fill_(n ** 0.5))
-
-            reg_frst = s ** 0.5 * first + diag_frst
-            reg_scnd = s ** 0.5 * second + diag_scnd
+            if layer in self.eigen:
+                (frst_eigvals, frst_eigvecs), (scnd_eigvals, scnd_eigvecs) = self.eigen[layer]
+                self.inv_state[layer] = ((s ** 0.5 * frst_eigvals + n ** 0.5, frst_eigvecs),
+                                         (s ** 0.5 * scnd_eigvals + n ** 0.5, scnd_eigvecs))
+                continue
 
-            reg_frst = (reg_frst + reg_frst.t()) / 2.0
-            reg_scnd = (reg_scnd + reg_scnd.t()) / 2.0
+            reg_frst = s ** 0.5 * first
+            reg_frst.diagonal().add_(n ** 0.5)
+            reg_scnd = s ** 0.5 * second
+            reg_scnd.diagonal().add_(n ** 0.5)
 
-            try:
-                chol_ifrst = reg_frst.inverse().cholesky()
-                chol_iscnd = reg_scnd.inverse().cholesky()
-            except RuntimeError:
-                print("PyTorch Cholesky is singular. Using Numpy.")
-                chol_ifrst = torch.from_numpy(cholesky(inv(reg_frst.cpu().numpy()))).to(first.device)
-                chol_iscnd = torch.from_numpy(cholesky(inv(reg_scnd.cpu().numpy()))).to(second.device)
+            # Cholesky factors of the regularized factors (precision), not of their inverses
+            self.inv_state[layer] = (damped_cholesky(reg_frst), damped_cholesky(reg_scnd))
 
-            self.inv_state[layer] = (chol_ifrst, chol_iscnd)
+    def eigendecompose(self):
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        for layer, (first, second) in self.state.items():
+            self.eigen[layer] = (eigendecomposition(first), eigendecomposition(second))
 
     def sample(self,
-               layer: Module) -> Tensor:
+               layer: Module,
+               samples: int = None) -> Tensor:
         assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
         first, second = self.inv_state[layer]
-        z = torch.randn(first.size(0), second.size(0), device=first.device, dtype=first.dtype)
-        return (first @ z @ second.t()).t()  # Final transpose because PyTorch uses channels first
+        q, h = self.state[layer]
+        z = q.new(h.shape[0], samples or 1, q.shape[0]).normal_()
+        # X = L_H^-T Z L_Q^-1 has row covariance H^-1 and column covariance Q^-1 (PyTorch uses channels first). All
+        # samples are solved for at once, stacked along the second dimension.
+        x = spd_sample(spd_sample(z, second).transpose(0, 2), first).transpose(0, 2).transpose(0, 1)
+        return x if samples else x[0]
+
+    def _sigma_product(self,
+                       layer: Module,
+                       jacobian: Tensor) -> Tensor:
+        # (Q^-1 kron H^-1) vec(J) = vec(H^-1 J Q^-1), no (in * out)^2 matrix is formed
+        first, second = self.inv_state[layer]
+        product = spd_solve(jacobian, first)
+        return spd_solve(product.transpose(-2, -1), second).transpose(-2, -1)
 
 
 class EFB(Curvature):
@@ -410,17 +1163,21 @@ class EFB(Curvature):
 
     Todo: Add source/equations.
     """
+    _accumulators = ['state', 'diags']
+
     def __init__(self,
                  model: Union[Module, Sequential],
                  factors: Dict[Module, Tensor],
-                 layer_types: Union[List[str], str] = None):
+                 layer_types: Union[List[str], str] = None,
+                 layer_names: Union[List[str], str] = None):
         """EFB class initializer.
 
         Args:
             model: Any (pre-trained) PyTorch model including all `torchvision` models.
             factors: The Kronecker factors Q and H, computed using the `KFAC` class.
+            layer_names: Names of the selected modules, see `Curvature`. Must match those used for `factors`.
         """
-        super().__init__(model, layer_types)
+        super().__init__(model, layer_types, layer_names)
         self.eigvecs = get_eigenvectors(factors)
         self.diags = dict()
 
@@ -431,8 +1188,9 @@ class EFB(Curvature):
         Args:
             batch_size: The size of the current batch.
         """
+        self.samples += batch_size
         for layer in self.model.modules():
-            if layer.__class__.__name__ in self.layer_types:
+            if self._selects(layer):
                 if layer.__class__.__name__ in ['Linear', 'Conv2d']:
                     grads = layer.weight.grad.contiguous().view(layer.weight.grad.shape[0], -1)
                     if layer.bias is not None:
@@ -463,14 +1221,25 @@ class EFB(Curvature):
             reg_inv_lambda = torch.reciprocal(s * value + n).sqrt()
             self.inv_state[layer] = reg_inv_lambda
 
+    def eigendecompose(self):
+        """Nothing to cache, `state` already holds the eigenvalues in the Kronecker-factored eigenbasis."""
+
     def sample(self,
-               layer: Module) -> Tensor:
+               layer: Module,
+               samples: int = None) -> Tensor:
         assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
         first, second = self.eigvecs[layer]
         lambdas = self.inv_state[layer]
-        z = torch.randn(first.size(0), second.size(0), device=first.device, dtype=first.dtype)
+        z = torch.randn(samples or 1, first.size(0), second.size(0), device=first.device, dtype=first.dtype)
         z *= lambdas.t()
-        return (first @ z @ second.t()).t()  # Final transpose because PyTorch uses channels first
+        x = (first @ z @ second.t()).transpose(1, 2)  # Final transpose because PyTorch uses channels first
+        return x if samples else x[0]
+
+    def _sigma_product(self,
+                       layer: Module,
+                       jacobian: Tensor) -> Tensor:
+        first, second = self.eigvecs[layer]
+        return second @ (self.inv_state[layer] ** 2 * (second.t() @ jacobian @ first)) @ first.t()
 
 
 class INF(Curvature):
@@ -483,15 +1252,17 @@ class INF(Curvature):
                  diags: Dict[Module, Tensor],
                  factors: Dict[Module, Tensor],
                  lambdas: Dict[Module, Tensor],
-                 layer_types: Union[List[str], str] = None):
+                 layer_types: Union[List[str], str] = None,
+                 layer_names: Union[List[str], str] = None):
         """INF class initializer.
 
         Args:
             diags: Diagonal FiM or GNN computed by `Diagonal` class.
             factors: Kronecker-factored FiM or GNN computed by `KFAC` class.
             lambdas: Eigenvalue corrected diagonal FiM or GNN computed by `EFB` class.
+            layer_names: Names of the selected modules, see `Curvature`. Must match those used for the other inputs.
         """
-        super().__init__(model, layer_types)
+        super().__init__(model, layer_types, layer_names)
         assert diags.keys() == factors.keys() == lambdas.keys()
         self.eigvecs = get_eigenvectors(factors)
         self.lambdas = lambdas
@@ -539,11 +1310,36 @@ class INF(Curvature):
             pre_sample = self.pre_sampler(lr_frst_eigvecs, lr_scnd_eigvecs, reg_lr_lambda, reg_inv_correction)
             self.inv_state[layer] = (lr_frst_eigvecs, lr_scnd_eigvecs, reg_inv_correction, pre_sample)
 
+    def eigendecompose(self):
+        """Not supported. The state already is a low-rank eigenbasis of the KFAC factors plus a diagonal correction,
+        whose sum has no closed-form eigendecomposition, and `invert` requires a new pre-sample for each `add`.
+        """
+        raise NotImplementedError
+
     def sample(self,
-               layer: Module) -> Tensor:
+               layer: Module,
+               samples: int = None) -> Tensor:
         assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
         a, b, c, d = self.inv_state[layer]
-        return self.sampler(a, b, c, d).reshape(a.shape[0], b.shape[0]).t()
+        x = self.sampler(a, b, c, d, samples or 1).reshape(-1, a.shape[0], b.shape[0]).transpose(1, 2)
+        return x if samples else x[0]
+
+    def _sigma_product(self,
+                       layer: Module,
+                       jacobian: Tensor) -> Tensor:
+        # The covariance is L L^T with L = C - C^2 V P V^T C where V = U_A kron U_G, C is the regularized inverse
+        # square root of the correction term and P the pre-sample. V is only ever applied through its factors.
+        frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample = self.inv_state[layer]
+        correction = reg_inv_correction.view(frst_eigvecs.shape[0], scnd_eigvecs.shape[0]).t()
+
+        def project(x: Tensor, p: Tensor) -> Tensor:
+            inner = scnd_eigvecs.t() @ x @ frst_eigvecs
+            inner = inner.transpose(-2, -1).reshape(*inner.shape[:-2], -1) @ p.t()
+            inner = inner.reshape(*inner.shape[:-1], frst_eigvecs.shape[1], scnd_eigvecs.shape[1]).transpose(-2, -1)
+            return scnd_eigvecs @ inner @ frst_eigvecs.t()
+
+        half = correction * jacobian - correction * project(correction ** 2 * jacobian, pre_sample.t())
+        return correction * half - correction ** 2 * project(correction * half, pre_sample)
 
     @staticmethod
     def pre_sampler(frst_eigvecs: torch.Tensor,
@@ -562,19 +1358,23 @@ class INF(Curvature):
             A pre-sample used in `sampler` to sample weight sets.
         """
         scale_sqrt = torch.diag(reg_lambda)
-        try:
-            V_s = reg_inv_correction.contiguous().view(-1, 1) * kron(frst_eigvecs, scnd_eigvecs) @ scale_sqrt
-        except RuntimeError:
-            print("GPU capacity exhausted. Pre-sampling on CPU.")
-            frst_eigvecs = frst_eigvecs.cpu()
-            scnd_eigvecs = scnd_eigvecs.cpu()
-            reg_inv_correction = reg_inv_correction.cpu()
-            scale_sqrt = scale_sqrt.cpu()
-            V_s = reg_inv_correction.contiguous().view(-1, 1) * kron(frst_eigvecs, scnd_eigvecs) @ scale_sqrt
-        vtv = V_s.t() @ V_s
-        vtv = (vtv + vtv.t()) / 2.
-        A_c_inv = vtv.cholesky().inverse()
-        B_c = (vtv + torch.eye(scale_sqrt.shape[0], device=scale_sqrt.device)).cholesky()
+        n, r_a = frst_eigvecs.shape
+        m, r_g = scnd_eigvecs.shape
+
+        # V_s = diag(c) (U_A kron U_G) diag(lambda) is never formed. With C = c^2 reshaped to (n, m),
+        # (V_s^T V_s)[(a, g), (b, h)] = lambda_ag lambda_bh sum_i U_A[i, a] U_A[i, b] (U_G^T diag(C[i]) U_G)[g, h],
+        # accumulated over chunks of rows of U_A s.t. no intermediate is much larger than the (r_a r_g)^2 result.
+        correction = (reg_inv_correction ** 2).view(n, m)
+        chunk = max(1, (r_a * r_g) ** 2 // (m * r_g + r_g * r_g))
+        vtv = frst_eigvecs.new_zeros(r_a, r_g, r_a, r_g)
+        for start in range(0, n, chunk):
+            inner = torch.einsum('iog,oh->igh', correction[start:start + chunk].unsqueeze(2) * scnd_eigvecs,
+                                 scnd_eigvecs)
+            outer = frst_eigvecs[start:start + chunk]
+            vtv += torch.einsum('ia,ib,igh->agbh', outer, outer, inner)
+        vtv = reg_lambda.view(-1, 1) * vtv.view(r_a * r_g, r_a * r_g) * reg_lambda.view(1, -1)
+        A_c_inv = damped_cholesky(vtv).inverse()
+        B_c = damped_cholesky(vtv + torch.eye(scale_sqrt.shape[0], device=scale_sqrt.device))
         C = A_c_inv.t() @ (B_c - torch.eye(scale_sqrt.shape[0], device=scale_sqrt.device)) @ A_c_inv
         L_c = (C.inverse() + vtv).inverse()
         P_c = scale_sqrt @ L_c @ scale_sqrt
@@ -585,74 +1385,64 @@ class INF(Curvature):
     def sampler(frst_eigvecs: Tensor,
                 scnd_eigvecs: Tensor,
                 reg_inv_correction: Tensor,
-                pre_sample: Tensor) -> Tensor:
-        """Samples a new set of weights from the INF weight posterior distribution for the current layer.
+                pre_sample: Tensor,
+                samples: int = None) -> Tensor:
+        """Samples new sets of weights from the INF weight posterior distribution for the current layer.
 
         Args:
             frst_eigvecs: Eigenvectors of first KFAC factor.
             scnd_eigvecs: Eigenvectors of second KFAC factor.
             reg_inv_correction: Regularized inverse of the diagonal correction term of INF.
             pre_sample: Pre-sample computed by the pre-sampler.
+            samples: If given, the number of samples drawn at once with batched matrix multiplications.
 
         Returns:
-            A new set of weights for the current layer.
+            A new set of (vectorized) weights for the current layer or a stack of shape (samples, in * out).
         """
-        X = torch.randn(frst_eigvecs.shape[0] * scnd_eigvecs.shape[0], device=frst_eigvecs.device,
+        X = torch.randn(samples or 1, frst_eigvecs.shape[0] * scnd_eigvecs.shape[0], device=frst_eigvecs.device,
                         dtype=frst_eigvecs.dtype)
+        # Vectors are flattened in-major, i.e. element `i * m + o` is input `i` and output `o`, as in `_sigma_product`
         Y_l = reg_inv_correction * X
-        unvec_Y_l = Y_l.t().reshape((scnd_eigvecs.shape[0], frst_eigvecs.shape[0]))
+        unvec_Y_l = Y_l.reshape(-1, frst_eigvecs.shape[0], scnd_eigvecs.shape[0]).transpose(1, 2)
         Xq = scnd_eigvecs.t() @ unvec_Y_l @ frst_eigvecs
-        Qx = pre_sample @ Xq.t().contiguous().view(-1)
-        unvec_Qx = Qx.t().reshape((scnd_eigvecs.shape[1], frst_eigvecs.shape[1]))
+        Qx = Xq.transpose(1, 2).reshape(Xq.shape[0], -1) @ pre_sample.t()
+        unvec_Qx = Qx.reshape(-1, frst_eigvecs.shape[1], scnd_eigvecs.shape[1]).transpose(1, 2)
         X_p_s = scnd_eigvecs @ unvec_Qx @ frst_eigvecs.t()
-        Y_r = reg_inv_correction ** 2 * X_p_s.t().contiguous().view(-1)
+        Y_r = reg_inv_correction ** 2 * X_p_s.transpose(1, 2).reshape(X_p_s.shape[0], -1)
 
-        return Y_l.t() - Y_r.t()
+        return Y_l - Y_r if samples else (Y_l - Y_r)[0]
 
     @staticmethod
     def _dim_reduction(frst_eigvecs: Tensor,
                        scnd_eigvecs: Tensor,
                        lambda_vec: Tensor,
                        rank: int):
-        """
+        """Reduces the eigenbasis to the eigenvectors involved in the `rank` largest eigenvalues.
+
+        The flat index `i * m + j` of each of the `rank` largest (absolute) eigenvalues is decoded into the indices `i`
+        and `j` of the first and second factor eigenvectors. All combinations of the selected eigenvectors are kept,
+        s.t. the result is again Kronecker-factored.
 
         Args:
-            frst_eigvecs:
-            scnd_eigvecs:
-            lambda_vec:
-            rank:
+            frst_eigvecs: Eigenvectors of the first KFAC factor of shape (n, n).
+            scnd_eigvecs: Eigenvectors of the second KFAC factor of shape (m, m).
+            lambda_vec: Eigenvalues of shape (n * m) in Kronecker order.
+            rank: Number of eigenvalues to select.
 
         Returns:
-
+            The low-rank first and second factor eigenvectors and the corresponding eigenvalues in Kronecker order.
         """
         if rank >= lambda_vec.shape[0]:
             return frst_eigvecs, scnd_eigvecs, lambda_vec
         else:
             m = scnd_eigvecs.shape[1]
-            idx_total_0 = torch.argsort(-torch.abs(lambda_vec))
-            idx_total = idx_total_0 + 1
-            idx_top_l = idx_total[0:rank]
-            idx_left = list()
-            idx_right = list()
-            for z in range(rank):
-                i = int((idx_top_l[z] - 1.) / m + 1.)
-                j = idx_top_l[z] - (m * (i - 1))
-                idx_left.append(i)
-                idx_right.append(j)
-
-            idx_top_lm = list()
-            idx_left = torch.unique(torch.tensor(idx_left))
-            idx_right = torch.unique(torch.tensor(idx_right))
-            len_l = len(idx_left)
-            len_r = len(idx_right)
-
-            for i in range(0, len_l):
-                for j in range(0, len_r):
-                    idx_top_lm.append(m * (idx_left[i] - 1) + idx_right[j])
-
-            lr_lambda = lambda_vec[[idx - 1 for idx in idx_top_lm]]
-            lr_cov_inner = frst_eigvecs[:, [idx - 1 for idx in idx_left]]
-            lr_cov_outer = scnd_eigvecs[:, [idx - 1 for idx in idx_right]]
+            idx_top = torch.topk(lambda_vec.abs(), rank, sorted=False)[1]
+            idx_left = torch.unique(torch.div(idx_top, m, rounding_mode='floor'))
+            idx_right = torch.unique(idx_top % m)
+
+            lr_lambda = lambda_vec.view(-1, m)[idx_left.unsqueeze(1), idx_right].reshape(-1)
+            lr_cov_inner = frst_eigvecs[:, idx_left]
+            lr_cov_outer = scnd_eigvecs[:, idx_right]
 
             return lr_cov_inner, lr_cov_outer, lr_lambda
 
@@ -660,23 +1450,474 @@ class INF(Curvature):
     def _diagonal_accumulator(xxt_eigvecs: Tensor,
                               ggt_eigvecs: Tensor,
                               lambda_vec: Tensor):
+        r"""Computes the diagonal of :math:`(U_A\otimes U_G)\Lambda(U_A\otimes U_G)^T`.
+
+        Element `i * m + j` of the diagonal is :math:`\sum_{a,g}U_A[i,a]^2\Lambda[a,g]U_G[j,g]^2`, i.e. the diagonal
+        is the (flattened) product of three small matrices and the Kronecker product is never formed.
+
+        Args:
+            xxt_eigvecs: Eigenvectors of the first KFAC factor of shape (n, r_a).
+            ggt_eigvecs: Eigenvectors of the second KFAC factor of shape (m, r_g).
+            lambda_vec: Eigenvalues of shape (r_a * r_g) in Kronecker order.
+
+        Returns:
+            The diagonal of shape (n * m).
+        """
+        lambdas = lambda_vec.view(xxt_eigvecs.shape[1], ggt_eigvecs.shape[1])
+        return ((xxt_eigvecs ** 2) @ lambdas @ (ggt_eigvecs ** 2).t()).view(-1)
+
+
+class DenseCurvature(Curvature):
+    r"""The dense Fisher information or Generalized Gauss Newton matrix approximation.
+
+    In contrast to all other approximations, no independence between layers is assumed, s.t. the full
+    :math:`P\times P` matrix over all parameters of the selected layers is computed, ordered as in `model.parameters()`.
+
+    Gradients are buffered in a panel of `panel_size` rows and added to the running sum with a single rank-k update once
+    the panel is full. Akin to BLAS `syrk`, only the upper triangle is updated, tile by tile. The running sum can be kept
+    in higher precision than the panel. With `packed`, the upper triangle is stored in packed form (see
+    `models.utilities.pack`) and factorized by `PackedCholesky`, which halves the memory of the state, of its Cholesky
+    factor and of checkpoints.
+
+    By default, the gradient of the batch loss is used, i.e. one rank-1 update per batch. With `per_sample`, the
+    per-example gradients are recovered from the recorded layer inputs and output gradients, which yields the
+    empirical Fisher (true labels) or its Monte Carlo estimate (labels sampled from the model) without additional
+    backward passes.
+
+    With `subset`, the matrix is only computed over the given coordinates of the flat parameter vector, e.g. the
+    parameters with the largest marginal variance (see `subnetwork`), while all other parameters stay at their MAP
+    estimate. Memory and compute then scale with the size of the subset instead of `P`.
+
+    Source: `Bayesian Deep Learning via Subnetwork Inference <https://arxiv.org/abs/2010.14689>`_
+    """
+    def __init__(self,
+                 model: Union[Module, Sequential],
+                 layer_types: Union[List[str], str] = None,
+                 panel_size: int = 256,
+                 tile_size: int = 2048,
+                 dtype: torch.dtype = torch.float64,
+                 per_sample: bool = False,
+                 packed: bool = False,
+                 layer_names: Union[List[str], str] = None,
+                 subset: Tensor = None):
+        """DenseCurvature class initializer.
+
+        Args:
+            model: Any (pre-trained) PyTorch model including all `torchvision` models.
+            layer_types: Types of layers for which to compute src information. Supported are `Linear` and `Conv2d`.
+            panel_size: Number of gradients buffered before they are added to the running sum.
+            tile_size: Number of columns of the running sum updated at once.
+            dtype: Data type of the running sum.
+            per_sample: If True, sums the outer products of the per-example gradients instead of using the gradient of
+                        the batch loss.
+            packed: If True, stores the upper triangle of the running sum in packed form. `tile_size` then is the
+                    number of rows updated and factorized at once.
+            layer_names: Names of the selected modules, see `Curvature`.
+            subset: Indices into the flat parameter vector of the selected layers (ordered as in `model.parameters()`)
+                    to which the matrix is restricted. Default: None, i.e. all parameters.
         """
+        super().__init__(model, layer_types, layer_names)
+        self.per_sample = per_sample
+        self.packed = packed
+        if per_sample:
+            self._register_hooks()
+        self.layers = list()
+        for layer in model.modules():
+            if self._selects(layer):
+                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
+                    self.layers.append(layer)
+                elif layer.__class__.__name__ == 'MultiheadAttention':
+                    raise NotImplementedError
+        self.numel = sum(param.numel() for layer in self.layers for param in [layer.weight, layer.bias]
+                         if param is not None)
+        self.subset = None if subset is None else subset.to(self.layers[0].weight.device).sort()[0]
+        self.size = self.numel if subset is None else self.subset.numel()
+        self.panel_size = panel_size
+        self.tile_size = tile_size
+        self.dtype = dtype
+        self.panel = None
+        self.rows = 0
+        self.gradient = FlatGradient([param for layer in self.layers for param in [layer.weight, layer.bias]
+                                      if param is not None])
+
+    def update(self,
+               batch_size: int):
+        """Appends the gradient of all selected layers to the panel, flushing the panel once it is full.
 
         Args:
-            xxt_eigvecs:
-            ggt_eigvecs:
-            lambda_vec:
+            batch_size: The size of the current batch.
+        """
+        self.samples += batch_size
+        self.eigen.clear()
+        if self.panel is None:
+            self.panel = self.layers[0].weight.new_empty(self.panel_size, self.size)
+        if self.per_sample:
+            grads = torch.cat([self._per_sample_gradients(layer) for layer in self.layers], dim=1)
+            if self.subset is not None:
+                grads = grads[:, self.subset]
+            while grads.shape[0]:
+                count = min(self.panel_size - self.rows, grads.shape[0])
+                self.panel[self.rows:self.rows + count].copy_(grads[:count])
+                grads = grads[count:]
+                self.rows += count
+                if self.rows == self.panel_size:
+                    self.flush()
+            return
+        if self.subset is not None:
+            torch.mul(self.gradient()[self.subset], batch_size ** 0.5, out=self.panel[self.rows])
+        else:
+            torch.mul(self.gradient(), batch_size ** 0.5, out=self.panel[self.rows])
+        self.rows += 1
+        if self.rows == self.panel_size:
+            self.flush()
+
+    def flush(self):
+        """Adds the outer products of all buffered gradients to the upper triangle of the running sum.
+
+        With `mixed_precision`, the products are computed in `compute_dtype` and added tile by tile as configured, s.t.
+        no temporary of the size of the running sum is required.
+        """
+        if self.rows == 0:
+            return
+        dtype = torch.float64 if self.accumulation == 'fp64' else self.dtype
+        panel = self.panel[:self.rows].to(self.compute_dtype or dtype)
+        shape = (self.size * (self.size + 1) // 2,) if self.packed else (self.size, self.size)
+        if 'dense' not in self.state:
+            self.state['dense'] = panel.new_zeros(shape, dtype=dtype)
+        state = self.state['dense']
+        if self.accumulation == 'kahan' and 'dense' not in self.compensation:
+            self.compensation['dense'] = torch.zeros_like(state)
+        if 'reference' in self._accumulators and 'dense' not in self.reference:
+            self.reference['dense'] = panel.new_zeros(shape, dtype=torch.float64)
+        compensation = self.compensation.get('dense') if self.accumulation == 'kahan' else None
+        reference = self.reference.get('dense') if 'reference' in self._accumulators else None
+
+        if self.packed:
+            packed_syrk(state, panel, self.tile_size, compensation)
+            if reference is not None:
+                packed_syrk(reference, self.panel[:self.rows].double(), self.tile_size)
+            self.rows = 0
+            return
+        exact = self.panel[:self.rows].double() if reference is not None else None
+        for start in range(0, self.size, self.tile_size):
+            end = min(start + self.tile_size, self.size)
+            if self.compute_dtype is None and compensation is None:
+                state[:end, start:end].addmm_(panel[:, :end].t(), panel[:, start:end])
+            else:
+                product = (panel[:, :end].t() @ panel[:, start:end]).to(dtype)
+                if compensation is None:
+                    state[:end, start:end] += product
+                else:
+                    kahan_add(state[:end, start:end], product, compensation[:end, start:end])
+            if reference is not None:
+                reference[:end, start:end].addmm_(exact[:, :end].t(), exact[:, start:end])
+        self.rows = 0
+
+    def matrix(self) -> Tensor:
+        """Flushes the panel and returns the full symmetric matrix, mirrored from its upper triangle.
 
         Returns:
+            The dense src matrix of shape (P, P).
+        """
+        self.flush()
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        state = self.state['dense']
+        if self.packed:
+            return unpack(state, self.size, self.tile_size)
+        matrix = torch.empty_like(state)
+        for start in range(0, self.size, self.tile_size):
+            end = min(start + self.tile_size, self.size)
+            tile = state[start:end, start:end]
+            matrix[start:end, start:end] = tile.triu() + tile.triu(diagonal=1).t()
+            matrix[start:end, end:] = state[start:end, end:]
+            matrix[end:, start:end] = state[start:end, end:].t()
+        return matrix
 
+    def invert(self,
+               add: float = 0.,
+               multiply: float = 1.):
+        self.flush()
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        if self.inv_state:
+            Warning("State has already been inverted. Is this expected?")
+        if 'dense' in self.eigen:
+            eigvals, eigvecs = self.eigen['dense']
+            self.inv_state['dense'] = (float(multiply) * eigvals + float(add), eigvecs)
+            return
+        if self.packed:
+            reg = self.state['dense'] * float(multiply)
+            reg[packed_diagonal(self.size, reg.device)] += float(add)
+            self.inv_state['dense'] = PackedCholesky(reg, self.size, self.tile_size)
+            return
+        reg = self.matrix().mul_(float(multiply))
+        reg.diagonal().add_(float(add))
+        # Only the Cholesky factor of the precision is kept, the covariance is never formed
+        self.inv_state['dense'] = damped_cholesky(reg)
+
+    def eigendecompose(self):
+        self.flush()
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        if self.packed:
+            self.eigen['dense'] = eigendecomposition(self.matrix())
+        else:
+            self.eigen['dense'] = eigendecomposition(self.state['dense'], upper=True)
+
+    def state_dict(self) -> Dict[str, Any]:
+        self.flush()
+        return super().state_dict()
+
+    def load_state_dict(self,
+                        state_dict: Dict[str, Any]):
+        # Buffered rows belong to the replaced state and must not be flushed into the loaded one
+        self.rows = 0
+        super().load_state_dict(state_dict)
+
+    def covariance(self) -> Tensor:
+        """Returns the posterior covariance. Only required for inspection, sampling and variances do not need it.
+
+        Returns:
+            The inverse of the regularized matrix of shape (P, P).
         """
-        n = xxt_eigvecs.shape[0]
-        m = ggt_eigvecs.shape[0]
-        diag_vec = torch.zeros(n * m).to(lambda_vec.device)
-        k = 0
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        eye = torch.eye(self.size, dtype=self.state['dense'].dtype, device=self.state['dense'].device)
+        return spd_solve(eye, self.inv_state['dense'])
+
+    def draw(self,
+             samples: int = None) -> Dict[Module, Tensor]:
+        """Samples weight offsets for all selected layers jointly."""
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        x = spd_sample(self.state['dense'].new(self.size, samples or 1).normal_(), self.inv_state['dense']).t()
+        if self.subset is not None:
+            x = x.new_zeros(x.shape[0], self.numel).index_copy_(1, self.subset, x)
+        x = x if samples else x[0]
+        draws = dict()
+        start = 0
+        for layer in self.layers:
+            size = layer.weight.numel() + (layer.bias.numel() if layer.bias is not None else 0)
+            draws[layer] = unflatten(x[..., start:start + size], layer).to(layer.weight.dtype)
+            start += size
+        return draws
+
+    def sample(self,
+               layer: Module,
+               samples: int = None) -> Tensor:
+        return self.draw(samples)[layer]
+
+    def sample_and_replace(self):
+        self.model.load_state_dict(self.model_state)
+        for layer, _sample in self.draw().items():
+            self._replace(_sample, layer.weight, layer.bias)
+
+    def _sigma_product(self,
+                       layer: str,
+                       jacobian: Tensor) -> Tensor:
+        return spd_solve(jacobian, self.inv_state[layer])
+
+    def predictive_variance(self,
+                            jacobians: Dict[Module, Tensor]) -> Tensor:
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        jacobian = self._flatten(jacobians)
+        return (jacobian * self._sigma_product('dense', jacobian)).sum(dim=-1)
+
+    def predictive_covariance(self,
+                              jacobians: Dict[Module, Tensor]) -> Tensor:
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        jacobian = self._flatten(jacobians)
+        return jacobian @ self._sigma_product('dense', jacobian).transpose(-2, -1)
+
+    def _flatten(self,
+                 jacobians: Dict[Module, Tensor]) -> Tensor:
+        """Concatenates the Jacobians of all selected layers, restricted to `subset`."""
+        jacobian = flatten({layer: jacobians[layer] for layer in self.layers})
+        return jacobian if self.subset is None else jacobian[..., self.subset]
+
 
-        for i in range(n):
-            diag_kron = kron(xxt_eigvecs[i, :].unsqueeze(0), ggt_eigvecs) ** 2
-            diag_vec[k:k + m] = diag_kron @ lambda_vec
-            k += m
-        return diag_vec
+class LowRankDiagonal(Curvature):
+    r"""The low-rank plus diagonal Generalized Gauss Newton matrix approximation.
+
+    The GGN over all parameters of the selected layers is approximated as :math:`G\approx U\Lambda U^T+D` with its `rank`
+    leading eigenpairs :math:`(\Lambda, U)` and the diagonal `D` of the residual. The eigenpairs are estimated by a
+    randomized eigensolver and the diagonal by Hutchinson's estimator :math:`\mathrm{diag}(G)\approx
+    \mathbb{E}[z\odot Gz]` with Rademacher probes `z`, both using products with `models.operators.GGN` only. Neither
+    `G` nor the posterior covariance is ever formed, s.t. memory is linear in the number of parameters `P`.
+
+    Source: `Finding Structure with Randomness <https://arxiv.org/abs/0909.4061>`_
+    """
+    def __init__(self,
+                 model: Union[Module, Sequential],
+                 layer_types: Union[List[str], str] = None,
+                 rank: int = 20,
+                 oversampling: int = 10,
+                 power_iterations: int = 1,
+                 probes: int = 10,
+                 likelihood: str = 'classification',
+                 layer_names: Union[List[str], str] = None):
+        """LowRankDiagonal class initializer.
+
+        Args:
+            model: Any (pre-trained) PyTorch model including all `torchvision` models.
+            layer_types: Types of layers for which to compute src information. Supported are `Linear` and `Conv2d`.
+            rank: Number of eigenpairs.
+            oversampling: Number of additional random directions of the range finder.
+            power_iterations: Number of power iterations, each requiring an additional pass over the data.
+            probes: Number of Rademacher probes of the diagonal estimator. If zero, no diagonal correction is used.
+            likelihood: Either `classification` or `regression`, see `models.operators.ggn_matmat`.
+            layer_names: Names of the selected modules, see `Curvature`.
+        """
+        super().__init__(model, layer_types, layer_names)
+        self.layers = list()
+        for layer in model.modules():
+            if self._selects(layer):
+                if layer.__class__.__name__ in ['Linear', 'Conv2d']:
+                    self.layers.append(layer)
+                elif layer.__class__.__name__ == 'MultiheadAttention':
+                    raise NotImplementedError
+        self.parameters = [param for layer in self.layers for param in [layer.weight, layer.bias] if param is not None]
+        self.size = sum(param.numel() for param in self.parameters)
+        self.rank = rank
+        self.oversampling = oversampling
+        self.power_iterations = power_iterations
+        self.probes = probes
+        self.likelihood = likelihood
+
+    def update(self,
+               data: Iterable[Tuple[Tensor, Tensor]],
+               batches: int = None):
+        """Estimates the leading eigenpairs and the residual diagonal of the GGN summed over `data`.
+
+        Requires `2 + power_iterations` passes over the data, see `models.operators.randomized_eigh`.
+
+        Args:
+            data: An iterable of inputs and labels, e.g. a `DataLoader`. The labels are not used.
+            batches: If given, only the first `batches` batches are used.
+        """
+        self.eigen.clear()
+        operator = GGN(self.model, data, self.parameters, self.likelihood, batches)
+        eigvals, eigvecs, diagonal = randomized_eigh(operator, self.rank, self.oversampling, self.power_iterations,
+                                                     self.probes)
+        if diagonal is None:
+            residual = torch.zeros_like(eigvecs[:, 0])
+        else:
+            residual = (diagonal - (eigvecs ** 2) @ eigvals).clamp(min=0)
+        self.state['lowrank'] = (eigvals, eigvecs, residual)
+        self.samples = operator.samples
+
+    def invert(self,
+               add: float = 0.,
+               multiply: float = 1.):
+        r"""Prepares solves and sampling with the posterior precision :math:`A=s(U\Lambda U^T+D)+nI`.
+
+        With :math:`D'=sD+nI` and :math:`V=D'^{-1/2}U(s\Lambda)^{1/2}=QSR^T`, :math:`A=D'^{1/2}(I+VV^T)D'^{1/2}` and
+        :math:`(I+VV^T)^{-1/2}=I+Q((I+S^2)^{-1/2}-I)Q^T`. Only `D'`, `Q` and `S` are kept.
+        """
+        assert self.state, "State dict is empty. Did you call 'update' prior to this?"
+        if self.inv_state:
+            Warning("State has already been inverted. Is this expected?")
+        eigvals, eigvecs, residual = self.state['lowrank']
+        inv_sqrt = (float(multiply) * residual + float(add)).rsqrt()
+        low_rank = inv_sqrt.unsqueeze(1) * eigvecs * (float(multiply) * eigvals).sqrt()
+        basis, singular, _ = torch.linalg.svd(low_rank, full_matrices=False)
+        self.inv_state['lowrank'] = (inv_sqrt, basis, singular ** 2)
+
+    def eigendecompose(self):
+        """Nothing to cache, `state` already holds the eigendecomposition of the low-rank term."""
+
+    def merge(self,
+              other: Union['Curvature', Dict[str, Any]]):
+        r"""Adds the estimate of another instance, re-compressing the sum to `rank` eigenpairs.
+
+        The sum :math:`U_1\Lambda_1U_1^T+U_2\Lambda_2U_2^T` is projected onto an orthonormal basis of :math:`[U_1,U_2]`
+        and eigendecomposed there. The diagonals of both estimates are added, s.t. the mass of the truncated eigenpairs
+        moves to the residual diagonal, as in `update`.
+        """
+        if isinstance(other, Curvature):
+            other = other.state_dict()
+        assert other['type'] == self.__class__.__name__, f"Cannot merge {other['type']} state."
+        self.samples += other['samples']
+        self.eigen.clear()
+        if 'lowrank' not in self.state:
+            self.state['lowrank'] = _copy_state(other['state']['lowrank'])
+            return
+        eigvals, eigvecs, residual = self.state['lowrank']
+        other_eigvals, other_eigvecs, other_residual = [value.to(eigvecs) for value in other['state']['lowrank']]
+        diagonal = residual + (eigvecs ** 2) @ eigvals + other_residual + (other_eigvecs ** 2) @ other_eigvals
+        basis = torch.linalg.qr(torch.cat([eigvecs, other_eigvecs], dim=1))[0]
+        left, right = basis.t() @ eigvecs, basis.t() @ other_eigvecs
+        eigvals, small = eigendecomposition(left @ torch.diag(eigvals) @ left.t() +
+                                            right @ torch.diag(other_eigvals) @ right.t())
+        eigvals, eigvecs = eigvals[-self.rank:], basis @ small[:, -self.rank:]
+        residual = (diagonal - (eigvecs ** 2) @ eigvals).clamp(min=0)
+        self.state['lowrank'] = (eigvals, eigvecs, residual)
+
+    def _apply(self,
+               tensor: Tensor,
+               power: float) -> Tensor:
+        """Multiplies `tensor` of shape (P, k) by :math:`D'^{-1/2}(I+VV^T)^{power}`, see `invert`."""
+        inv_sqrt, basis, squares = self.inv_state['lowrank']
+        tensor = tensor + basis @ (((1 + squares) ** power - 1).unsqueeze(1) * (basis.t() @ tensor))
+        return inv_sqrt.unsqueeze(1) * tensor
+
+    def draw(self,
+             samples: int = None) -> Dict[Module, Tensor]:
+        """Samples weight offsets for all selected layers jointly."""
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        inv_sqrt = self.inv_state['lowrank'][0]
+        x = self._apply(inv_sqrt.new(self.size, samples or 1).normal_(), -0.5).t()
+        x = x if samples else x[0]
+        draws = dict()
+        start = 0
+        for layer in self.layers:
+            size = layer.weight.numel() + (layer.bias.numel() if layer.bias is not None else 0)
+            draws[layer] = unflatten(x[..., start:start + size], layer).to(layer.weight.dtype)
+            start += size
+        return draws
+
+    def sample(self,
+               layer: Module,
+               samples: int = None) -> Tensor:
+        return self.draw(samples)[layer]
+
+    def sample_and_replace(self):
+        self.model.load_state_dict(self.model_state)
+        for layer, _sample in self.draw().items():
+            self._replace(_sample, layer.weight, layer.bias)
+
+    def _sigma_product(self,
+                       layer: str,
+                       jacobian: Tensor) -> Tensor:
+        inv_sqrt = self.inv_state[layer][0]
+        rows = (inv_sqrt * jacobian.reshape(-1, self.size).to(inv_sqrt.dtype)).t()
+        return self._apply(rows, -1.).t().reshape(jacobian.shape).to(jacobian.dtype)
+
+    def predictive_variance(self,
+                            jacobians: Dict[Module, Tensor]) -> Tensor:
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        jacobian = flatten({layer: jacobians[layer] for layer in self.layers})
+        return (jacobian * self._sigma_product('lowrank', jacobian)).sum(dim=-1)
+
+    def predictive_covariance(self,
+                              jacobians: Dict[Module, Tensor]) -> Tensor:
+        assert self.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+        jacobian = flatten({layer: jacobians[layer] for layer in self.layers})
+        return jacobian @ self._sigma_product('lowrank', jacobian).transpose(-2, -1)
+
+
+def subnetwork(diagonal: Diagonal,
+               size: int,
+               layers: List[Module] = None) -> Tensor:
+    """Selects the parameters with the largest marginal posterior variance under a diagonal approximation.
+
+    Args:
+        diagonal: A `Diagonal` instance after `invert`.
+        size: The number of parameters to select.
+        layers: The layers whose parameters are ranked, in model order. Must match the layers of the `DenseCurvature`
+                instance the result is passed to. Default: all `Linear` and `Conv2d` layers of `diagonal`.
+
+    Returns:
+        The (sorted) indices into the flat parameter vector of `layers`, to be passed as `subset` to `DenseCurvature`.
+    """
+    assert diagonal.inv_state, "Inverse state dict is empty. Did you call 'invert' prior to this?"
+    if layers is None:
+        layers = [layer for layer in diagonal.selection if layer.__class__.__name__ in ['Linear', 'Conv2d']]
+    variance = flatten({layer: diagonal.inv_state[layer] ** 2 for layer in layers})
+    return variance.topk(min(size, variance.numel()))[1].sort()[0]
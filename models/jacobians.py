@@ -0,0 +1,180 @@
+"""Batched per-example Jacobians of the model outputs w.r.t. the weights of `Linear` and `Conv2d` layers."""
+
+from typing import Union, List, Dict, Tuple, Callable
+
+import torch
+from torch import Tensor
+from torch.nn import Module, Sequential
+import torch.nn.functional as F
+
+
+def per_sample_gradients(layer: Module,
+                         forward: Tensor,
+                         backward: Tensor) -> Tensor:
+    r"""Computes the per-example gradients of a `Linear` or `Conv2d` layer from its inputs and output gradients.
+
+    For a single example, the gradient w.r.t. the weights of a linear layer is the outer product :math:`ga^T` of the
+    gradient `g` w.r.t. the layer output and the layer input `a`. Convolutions are handled identically after unfolding
+    the input into patches, summing over all spatial locations. No additional backward pass is required.
+
+    Args:
+        layer: A `Linear` or `Conv2d` layer.
+        forward: The input of the layer, batch dimension first.
+        backward: The gradient w.r.t. the output of the layer, batch dimension first.
+
+    Returns:
+        The per-example gradients of shape (batch, out, in), with the bias gradient appended as last column if present.
+    """
+    if layer.__class__.__name__ == 'Conv2d':
+        if layer.groups != 1 or isinstance(layer.padding, str):
+            raise NotImplementedError
+        forward = F.unfold(forward, layer.kernel_size, dilation=layer.dilation, padding=layer.padding,
+                           stride=layer.stride)
+        backward = backward.reshape(backward.shape[0], backward.shape[1], -1)
+    else:
+        forward = forward.reshape(forward.shape[0], -1, forward.shape[-1]).transpose(1, 2)
+        backward = backward.reshape(backward.shape[0], -1, backward.shape[-1]).transpose(1, 2)
+
+    grads = torch.einsum('nol,nil->noi', backward, forward)
+    if layer.bias is not None:
+        grads = torch.cat([grads, backward.sum(dim=2, keepdim=True)], dim=2)
+    return grads
+
+
+def flatten(jacobians: Dict[Module, Tensor]) -> Tensor:
+    """Concatenates per-layer Jacobians into a single tensor, following the parameter order of each layer.
+
+    The parameters of each layer are ordered as `torch.cat([weight.view(-1), bias])`, i.e. identical to the order
+    obtained by iterating over `model.parameters()`.
+
+    Args:
+        jacobians: A dict mapping layers to tensors of shape (..., out, in), with the bias as last column if present.
+
+    Returns:
+        A tensor of shape (..., P) where `P` is the total number of parameters of all layers.
+    """
+    flat = list()
+    for layer, jacobian in jacobians.items():
+        if layer.bias is not None:
+            flat.append(jacobian[..., :-1].flatten(start_dim=-2))
+            flat.append(jacobian[..., -1])
+        else:
+            flat.append(jacobian.flatten(start_dim=-2))
+    return torch.cat(flat, dim=-1)
+
+
+def unflatten(tensor: Tensor,
+              layer: Module) -> Tensor:
+    """Inverse of `flatten` for a single layer.
+
+    Args:
+        tensor: A tensor of shape (..., P) following the parameter order of `layer`.
+        layer: A `Linear` or `Conv2d` layer.
+
+    Returns:
+        A tensor of shape (..., out, in) with the bias as last column if present.
+    """
+    out = layer.weight.shape[0]
+    weight = tensor[..., :layer.weight.numel()].reshape(*tensor.shape[:-1], out, -1)
+    if layer.bias is not None:
+        weight = torch.cat([weight, tensor[..., layer.weight.numel():].unsqueeze(-1)], dim=-1)
+    return weight
+
+
+class Jacobian:
+    """Computes the Jacobians of the model outputs w.r.t. the weights of each selected layer for a whole batch.
+
+    Inputs and outputs of each selected layer are recorded during the forward pass. A single backward pass per model
+    output then yields the gradients w.r.t. all layer outputs for all examples at once, from which the per-example
+    Jacobians are assembled in closed form (see `per_sample_gradients`). This replaces one backward pass per example,
+    output and parameter tensor by one backward pass per output.
+
+    Note:
+        Examples have to be processed independently by the model, i.e. batch normalization has to be in `eval` mode.
+    """
+
+    def __init__(self,
+                 model: Union[Module, Sequential],
+                 layer_types: Union[List[str], str] = None,
+                 layer_names: Union[List[str], str] = None):
+        """Jacobian class initializer.
+
+        Args:
+            model: Any (pre-trained) PyTorch model.
+            layer_types: Types of layers for which to compute Jacobians. Supported are `Linear` and `Conv2d`. If
+                         `None`, all supported types are considered. Default: None.
+            layer_names: Names of the modules for which to compute Jacobians, as in `model.named_modules()`. If
+                         `None`, all layers of `layer_types` are considered. Default: None.
+        """
+        self.model = model
+        if isinstance(layer_types, str):
+            self.layer_types = [layer_types]
+        elif layer_types:
+            self.layer_types = list(layer_types)
+        else:
+            self.layer_types = ['Linear', 'Conv2d']
+        for _type in self.layer_types:
+            assert _type in ['Linear', 'Conv2d']
+        self.hooks = list()
+        self.record = dict()
+
+        if isinstance(layer_names, str):
+            layer_names = [layer_names]
+        for name, layer in model.named_modules():
+            if layer.__class__.__name__ in self.layer_types and (not layer_names or name in layer_names):
+                self.record[layer] = [None, None]
+                self.hooks.append(layer.register_forward_hook(self._save))
+
+    def _save(self, module, input, output):
+        self.record[module] = [input[0].detach(), output]
+
+    def remove(self):
+        """Removes all forward hooks from the model."""
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = list()
+
+    def __call__(self,
+                 inputs: Tensor,
+                 transform: Callable[[Tensor], Tensor] = None,
+                 argmax: bool = False) -> Tuple[Tensor, Dict[Module, Tensor]]:
+        """Computes the model outputs and their per-example Jacobians for a batch of inputs.
+
+        Args:
+            inputs: A batch of inputs.
+            transform: Optional function applied to the model outputs, e.g. a softmax. Default: None.
+            argmax: If True, only the Jacobian of the largest output of each example is computed. Default: False.
+
+        Returns:
+            The (transformed) outputs of shape (batch, C) and a dict mapping layers to Jacobians of shape
+            (batch, C, out, in), with the bias as last column if present. If `argmax` is True, C is one.
+        """
+        outputs = self.model(inputs)
+        if transform is not None:
+            outputs = transform(outputs)
+        outputs = outputs.reshape(outputs.shape[0], -1)
+
+        if argmax:
+            index = outputs.argmax(dim=1, keepdim=True)
+            grad_outputs = [torch.zeros_like(outputs).scatter_(1, index, 1.)]
+        else:
+            grad_outputs = list()
+            for c in range(outputs.shape[1]):
+                grad = torch.zeros_like(outputs)
+                grad[:, c] = 1.
+                grad_outputs.append(grad)
+
+        layers = list(self.record.keys())
+        jacobians = {layer: list() for layer in layers}
+        for grad in grad_outputs:
+            backward = torch.autograd.grad(outputs, [self.record[layer][1] for layer in layers], grad_outputs=grad,
+                                           retain_graph=True, allow_unused=True)
+            for layer, grad_layer in zip(layers, backward):
+                forward, output = self.record[layer]
+                if grad_layer is None:
+                    grad_layer = torch.zeros_like(output)
+                jacobians[layer].append(per_sample_gradients(layer, forward, grad_layer.detach()))
+
+        for layer in layers:
+            self.record[layer] = [None, None]
+        return outputs.detach(), {layer: torch.stack(jacobian, dim=1) for layer, jacobian in jacobians.items()}
@@ -0,0 +1,234 @@
+"""Matrix-free linear operators for curvature matrices of neural networks and algorithms using only their products."""
+
+from typing import List, Tuple, Iterable, Optional
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+import torch.nn.functional as F
+
+
+def ggn_matmat(model: Module,
+               parameters: List[Tensor],
+               inputs: Tensor,
+               matrix: Tensor,
+               likelihood: str = 'classification') -> Tensor:
+    r"""Multiplies the Generalized Gauss Newton matrix of a batch by the columns of `matrix` without forming it.
+
+    With the Jacobians :math:`J_n` of the model outputs w.r.t. the parameters and the Hessians :math:`\Lambda_n` of the
+    loss w.r.t. the outputs, :math:`G=\sum_nJ_n^T\Lambda_nJ_n`. :math:`Jv` is computed by differentiating the
+    vector-Jacobian product :math:`J^Tu` w.r.t. a dummy `u` (double-backward trick), :math:`J^T\Lambda Jv` by a regular
+    backward pass. Only a single forward pass per batch is required.
+
+    Args:
+        model: Any PyTorch model.
+        parameters: The parameters w.r.t. which `G` is defined, in the order of the rows of `matrix`.
+        inputs: A batch of inputs.
+        matrix: A tensor of shape (P, k).
+        likelihood: Either `classification` for the softmax cross-entropy or `regression` for the squared error loss,
+                    each summed over the batch.
+
+    Returns:
+        The product of shape (P, k).
+    """
+    outputs = model(inputs)
+    outputs = outputs.reshape(outputs.shape[0], -1)
+    dummy = torch.zeros_like(outputs, requires_grad=True)
+    vjp = torch.autograd.grad(outputs, parameters, dummy, create_graph=True)
+    if likelihood == 'classification':
+        probabilities = F.softmax(outputs.detach(), dim=1)
+    elif likelihood != 'regression':
+        raise ValueError(f"Unknown likelihood {likelihood}.")
+
+    columns = list()
+    for column in matrix.t():
+        vectors = list()
+        start = 0
+        for param in parameters:
+            vectors.append(column[start:start + param.numel()].view_as(param).to(param.dtype))
+            start += param.numel()
+        jvp = torch.autograd.grad(vjp, dummy, vectors, retain_graph=True)[0]
+        if likelihood == 'classification':
+            # Hessian of the cross-entropy w.r.t. the logits: diag(p) - pp^T
+            jvp = probabilities * jvp - probabilities * (probabilities * jvp).sum(dim=1, keepdim=True)
+        product = torch.autograd.grad(outputs, parameters, jvp, retain_graph=True)
+        columns.append(torch.cat([grad.reshape(-1) for grad in product]).to(matrix.dtype))
+    return torch.stack(columns, dim=1)
+
+
+class GGN:
+    """The Generalized Gauss Newton matrix (Fisher) of a model summed over a dataset as a matrix-free linear operator.
+
+    Each product with a vector or a block of `k` vectors makes a single pass over the data, with one forward and
+    `2k` backward passes per batch (see `ggn_matmat`). Memory is linear in the number of parameters `P`, i.e. the
+    operator can be used for eigen-analysis (`randomized_eigh`), linear solves (`conjugate_gradient`) and trace
+    estimation (`trace`) of models for which a :math:`P\\times P` matrix is infeasible.
+    """
+
+    def __init__(self,
+                 model: Module,
+                 data: Iterable[Tuple[Tensor, Tensor]],
+                 parameters: List[Tensor] = None,
+                 likelihood: str = 'classification',
+                 batches: int = None):
+        """GGN class initializer.
+
+        Args:
+            model: Any PyTorch model.
+            data: An iterable of inputs and labels, e.g. a `DataLoader`, which can be iterated over multiple times. The
+                  labels are not used.
+            parameters: The parameters w.r.t. which the GGN is defined. Default: all parameters requiring gradients.
+            likelihood: Either `classification` or `regression`, see `ggn_matmat`.
+            batches: If given, only the first `batches` batches of `data` are used.
+        """
+        self.model = model
+        self.data = data
+        self.parameters = parameters or [param for param in model.parameters() if param.requires_grad]
+        self.likelihood = likelihood
+        self.batches = batches
+        self.size = sum(param.numel() for param in self.parameters)
+        self.dtype = self.parameters[0].dtype
+        self.device = self.parameters[0].device
+        self.samples = 0
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.size, self.size
+
+    def matmat(self,
+               matrix: Tensor) -> Tensor:
+        """Multiplies the GGN by `matrix` of shape (P, k) with one pass over the data.
+
+        Returns:
+            The product of shape (P, k) in the data type of `matrix`.
+        """
+        product = torch.zeros_like(matrix)
+        self.samples = 0
+        for index, (inputs, _) in enumerate(self.data):
+            if self.batches is not None and index == self.batches:
+                break
+            product += ggn_matmat(self.model, self.parameters, inputs.to(self.device), matrix, self.likelihood)
+            self.samples += inputs.shape[0]
+        return product
+
+    def matvec(self,
+               vector: Tensor) -> Tensor:
+        """Multiplies the GGN by `vector` of shape (P,) with one pass over the data."""
+        return self.matmat(vector.unsqueeze(1)).squeeze(1)
+
+    def __matmul__(self,
+                   other: Tensor) -> Tensor:
+        return self.matvec(other) if other.dim() == 1 else self.matmat(other)
+
+
+def _rademacher(operator: GGN,
+                probes: int) -> Tensor:
+    return torch.empty(operator.size, probes, dtype=torch.float64, device=operator.device).bernoulli_().mul_(2).sub_(1)
+
+
+def randomized_eigh(operator: GGN,
+                    rank: int,
+                    oversampling: int = 10,
+                    power_iterations: int = 1,
+                    probes: int = 0) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+    """Estimates the leading eigenpairs of a symmetric positive semi-definite operator by a randomized range finder.
+
+    Requires `2 + power_iterations` products with blocks of `rank + oversampling` vectors. Optionally, the diagonal
+    is estimated from Rademacher probes in the last product (see `diagonal`), at no additional pass over the data.
+
+    Source: `Finding Structure with Randomness <https://arxiv.org/abs/0909.4061>`_
+
+    Args:
+        operator: A `GGN` or any object with `size`, `device` and `matmat`.
+        rank: The number of eigenpairs.
+        oversampling: The number of additional random directions.
+        power_iterations: The number of power iterations, which improve the accuracy for slowly decaying spectra.
+        probes: The number of probes of the diagonal estimator. Default: 0, i.e. no estimate.
+
+    Returns:
+        The eigenvalues of shape (rank,) in ascending order, the eigenvectors of shape (P, rank) as columns and the
+        estimated diagonal of shape (P,) or None, all in double precision.
+    """
+    sketch = torch.empty(operator.size, rank + oversampling, dtype=torch.float64, device=operator.device).normal_()
+    image = operator.matmat(sketch)
+    for _ in range(power_iterations):
+        image = operator.matmat(torch.linalg.qr(image)[0])
+    basis = torch.linalg.qr(image)[0]
+
+    noise = _rademacher(operator, probes)
+    product = operator.matmat(torch.cat([basis, noise], dim=1))
+    projected = basis.t() @ product[:, :basis.shape[1]]
+    eigvals, eigvecs = torch.linalg.eigh((projected + projected.t()) / 2)
+    eigvals, eigvecs = eigvals[-rank:].clamp(min=0), basis @ eigvecs[:, -rank:]
+    diagonal = (noise * product[:, basis.shape[1]:]).mean(dim=1) if probes else None
+    return eigvals, eigvecs, diagonal
+
+
+def diagonal(operator: GGN,
+             probes: int = 10) -> Tensor:
+    r"""Estimates the diagonal by Hutchinson's estimator :math:`\mathrm{diag}(G)\approx\mathbb{E}[z\odot Gz]`.
+
+    Args:
+        operator: A `GGN` or any object with `size`, `device` and `matmat`.
+        probes: The number of Rademacher probes `z`.
+
+    Returns:
+        The estimated diagonal of shape (P,).
+    """
+    noise = _rademacher(operator, probes)
+    return (noise * operator.matmat(noise)).mean(dim=1)
+
+
+def trace(operator: GGN,
+          probes: int = 10) -> float:
+    r"""Estimates the trace by Hutchinson's estimator :math:`\mathrm{tr}(G)\approx\mathbb{E}[z^TGz]`.
+
+    Args:
+        operator: A `GGN` or any object with `size`, `device` and `matmat`.
+        probes: The number of Rademacher probes `z`.
+
+    Returns:
+        The estimated trace.
+    """
+    return diagonal(operator, probes).sum().item()
+
+
+def conjugate_gradient(operator: GGN,
+                       rhs: Tensor,
+                       add: float = 0.,
+                       multiply: float = 1.,
+                       tol: float = 1e-6,
+                       max_iter: int = 100) -> Tensor:
+    """Solves :math:`(sG+nI)x=b` for one or more right-hand sides by the conjugate gradient method.
+
+    All right-hand sides are solved for simultaneously, s.t. each iteration requires a single pass over the data.
+
+    Args:
+        operator: A `GGN` or any object with `size`, `device` and `matmat`.
+        rhs: The right-hand sides `b` of shape (P,) or (P, k).
+        add: The prior precision `n`.
+        multiply: The scale `s` of the GGN.
+        tol: The relative residual norm at which a column is considered converged.
+        max_iter: The maximal number of iterations.
+
+    Returns:
+        The solution of the shape of `rhs`.
+    """
+    vector = rhs.dim() == 1
+    b = rhs.unsqueeze(1) if vector else rhs
+    x = torch.zeros_like(b)
+    residual = b.clone()
+    direction = residual.clone()
+    norms = (residual * residual).sum(dim=0)
+    thresholds = tol ** 2 * norms
+    for _ in range(max_iter):
+        if (norms <= thresholds).all():
+            break
+        product = multiply * operator.matmat(direction) + add * direction
+        step = norms / (direction * product).sum(dim=0).clamp(min=torch.finfo(b.dtype).tiny)
+        x += step * direction
+        residual -= step * product
+        updated = (residual * residual).sum(dim=0)
+        direction = residual + updated / norms.clamp(min=torch.finfo(b.dtype).tiny) * direction
+        norms = updated
+    return x.squeeze(1) if vector else x
@@ -0,0 +1,124 @@
+"""Data-parallel accumulation of curvature approximations over shards of a dataset on multiple CPU processes."""
+
+from typing import Any, Callable
+from queue import Empty
+import multiprocessing
+
+import torch
+import torch.multiprocessing as mp
+from torch import Tensor
+from torch.nn import CrossEntropyLoss
+from torch.utils.data import DataLoader, Dataset, Subset
+
+from .curvatures import Curvature
+
+
+def mc_fisher_step(curvature: Curvature,
+                   images: Tensor,
+                   labels: Tensor):
+    """Updates `curvature` with a single batch, sampling the labels from the models' output distribution.
+
+    Args:
+        curvature: Any curvature instance whose `update` takes the batch size.
+        images: A batch of inputs.
+        labels: The ground truth labels. Unused, as the Fisher is approximated by Monte Carlo integration.
+    """
+    logits = curvature.model(images)
+    labels = torch.distributions.Categorical(logits=logits).sample()
+    loss = CrossEntropyLoss()(logits, labels)
+    curvature.model.zero_grad(set_to_none=False)
+    loss.backward()
+    curvature.update(batch_size=images.size(0))
+
+
+def _worker(rank: int,
+            curvature: Curvature,
+            dataset: Dataset,
+            indices: Tensor,
+            batch_size: int,
+            step: Callable[[Curvature, Tensor, Tensor], None],
+            threads: int,
+            queue: Any,
+            done: Any):
+    """Accumulates `curvature` over one shard of `dataset` and sends the result through shared memory."""
+    torch.set_num_threads(threads)
+    torch.manual_seed(torch.initial_seed() + rank)
+    for attr in curvature._accumulators:
+        getattr(curvature, attr).clear()
+    curvature.samples = 0
+
+    for images, labels in DataLoader(Subset(dataset, indices.tolist()), batch_size=batch_size):
+        step(curvature, images, labels)
+
+    state_dict = curvature.state_dict()
+    del state_dict['inv_state']
+    queue.put(state_dict)
+    # Shared tensors can only be received while the sending process is alive
+    done.wait()
+
+
+def accumulate(curvature: Curvature,
+               dataset: Dataset,
+               step: Callable[[Curvature, Tensor, Tensor], None] = mc_fisher_step,
+               workers: int = None,
+               batch_size: int = 32,
+               cpus: int = None,
+               timeout: float = 1.) -> int:
+    """Accumulates `curvature` over `dataset` using multiple forked CPU processes.
+
+    The dataset is split into one contiguous shard per worker. Each worker updates its own copy of `curvature` and the
+    model, after which the `state_dict` of all workers is sent back through shared memory and merged into `curvature`.
+    As all curvature approximations accumulate sums over batches, the reduction is exact up to the different batch
+    boundaries at the end of each shard.
+
+    Args:
+        curvature: Any curvature instance with CPU model and hooks already registered.
+        dataset: The dataset to accumulate over.
+        step: Function processing one batch of inputs and labels, i.e. computing a loss, its gradient and calling
+              `curvature.update`. Default: `mc_fisher_step`.
+        workers: Number of worker processes. Default: number of CPUs.
+        batch_size: Batch size of each worker.
+        cpus: Number of CPUs shared by the workers, which determines the number of threads of each worker. Default:
+              number of CPUs.
+        timeout: Interval in seconds in which the workers are checked for failures while waiting for results.
+
+    Returns:
+        The number of samples processed.
+    """
+    cpus = cpus or multiprocessing.cpu_count()
+    workers = workers or cpus
+    threads = max(1, cpus // workers)
+    # Buffered rows would be inherited and flushed by every worker
+    if hasattr(curvature, 'flush'):
+        curvature.flush()
+
+    context = mp.get_context('fork')
+    queue = context.Queue()
+    done = context.Event()
+    processes = list()
+    for rank, indices in enumerate(torch.arange(len(dataset)).chunk(workers)):
+        process = context.Process(target=_worker, args=(rank, curvature, dataset, indices, batch_size, step, threads,
+                                                        queue, done))
+        process.start()
+        processes.append(process)
+
+    samples = 0
+    received = 0
+    while received < len(processes):
+        try:
+            state_dict = queue.get(timeout=timeout)
+        except Empty:
+            failed = [(rank, process.exitcode) for rank, process in enumerate(processes)
+                      if process.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError(f"Worker {failed[0][0]} exited with code {failed[0][1]}.")
+            continue
+        samples += state_dict['samples']
+        curvature.merge(state_dict)
+        received += 1
+    done.set()
+    for process in processes:
+        process.join()
+    return samples
@@ -0,0 +1,354 @@
+"""Posterior predictive distributions of Laplace approximations."""
+
+from typing import Dict, Tuple, Callable, Iterable
+from contextlib import contextmanager
+import math
+
+import torch
+from torch import Tensor
+from torch.nn import Module, CrossEntropyLoss
+import torch.nn.functional as F
+
+from .curvatures import Curvature
+from .jacobians import Jacobian
+
+
+def _split(layer: Module,
+           sample: Tensor) -> Tuple[Tensor, Tensor]:
+    """Splits sampled offsets of shape (S, out, in) into weights (S, *weight.shape) and biases (S, out) or None."""
+    bias = None
+    if layer.bias is not None:
+        bias = layer.bias + sample[:, :, -1].to(layer.bias.dtype)
+        sample = sample[:, :, :-1]
+    weight = layer.weight + sample.reshape(sample.shape[0], *layer.weight.shape).to(layer.weight.dtype)
+    return weight, bias
+
+
+def _linear(layer: Module,
+            weight: Tensor,
+            bias: Tensor,
+            input: Tensor) -> Tensor:
+    samples = weight.shape[0]
+    x = input.reshape(samples, -1, input.shape[-1])
+    if bias is None:
+        output = torch.bmm(x, weight.transpose(1, 2))
+    else:
+        output = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+    return output.reshape(*input.shape[:-1], weight.shape[1])
+
+
+def _conv2d(layer: Module,
+            weight: Tensor,
+            bias: Tensor,
+            input: Tensor) -> Tensor:
+    if layer.groups != 1 or layer.padding_mode != 'zeros':
+        raise NotImplementedError
+    samples = weight.shape[0]
+    # (S * B, C, H, W) -> (B, S * C, H, W), s.t. each weight sample is one group of a grouped convolution
+    x = input.reshape(samples, -1, *input.shape[1:]).transpose(0, 1).reshape(-1, samples * input.shape[1],
+                                                                              *input.shape[2:])
+    output = F.conv2d(x, weight.reshape(-1, *weight.shape[2:]), None if bias is None else bias.reshape(-1),
+                      layer.stride, layer.padding, layer.dilation, groups=samples)
+    output = output.reshape(output.shape[0], samples, -1, *output.shape[2:]).transpose(0, 1)
+    return output.reshape(-1, *output.shape[2:])
+
+
+@contextmanager
+def batched_weights(samples: Dict[Module, Tensor]):
+    """Temporarily evaluates `Linear` and `Conv2d` layers for a stack of S weight samples at once.
+
+    Inside the context, the inputs of the model are expected to be repeated S times along the batch dimension, i.e. of
+    shape (S * B, ...), with the examples of sample `s` at `[s * B:(s + 1) * B]`. Each selected layer applies its
+    `s`-th weight sample to its slice of the batch with a single batched matrix multiplication (or a grouped
+    convolution), all other layers operate on the enlarged batch as usual. The parameters of the model are not
+    modified.
+
+    Args:
+        samples: A dict mapping layers to sampled offsets from their weights of shape (S, out, in), bias as last column
+                 if present, as returned by `Curvature.draw`.
+    """
+    for layer, sample in samples.items():
+        weight, bias = _split(layer, sample)
+        function = _conv2d if layer.__class__.__name__ == 'Conv2d' else _linear
+        layer.forward = lambda input, layer=layer, weight=weight, bias=bias, function=function: \
+            function(layer, weight, bias, input)
+    try:
+        yield
+    finally:
+        for layer in samples:
+            del layer.forward
+
+
+@torch.no_grad()
+def posterior_predictive(model: Module,
+                         samples: Dict[Module, Tensor],
+                         inputs: Tensor,
+                         transform: Callable[[Tensor], Tensor] = None) -> Tensor:
+    """Evaluates the model for a batch of inputs and all weight samples in a single forward pass.
+
+    Args:
+        model: The model whose layers were sampled, in `eval` mode.
+        samples: Sampled weight offsets as returned by `Curvature.draw`.
+        inputs: A batch of inputs of shape (B, ...).
+        transform: Optional function applied to the outputs, e.g. a softmax. Default: None.
+
+    Returns:
+        The (transformed) outputs for each weight sample of shape (S, B, ...).
+    """
+    count = next(iter(samples.values())).shape[0]
+    with batched_weights(samples):
+        outputs = model(inputs.repeat(count, *[1] * (inputs.dim() - 1)))
+    if transform is not None:
+        outputs = transform(outputs)
+    return outputs.reshape(count, inputs.shape[0], *outputs.shape[1:])
+
+
+def predict(curvature: Curvature,
+            data: Iterable[Tuple[Tensor, Tensor]],
+            samples: int = 30,
+            transform: Callable[[Tensor], Tensor] = lambda logits: F.softmax(logits, dim=1),
+            device: torch.device = None) -> Tuple[Tensor, Tensor]:
+    """Computes the Monte Carlo estimate of the posterior predictive mean over a dataset.
+
+    The same `samples` weight samples are used for all batches, i.e. the result is identical to averaging the
+    predictions of `samples` calls to `sample_and_replace`, each followed by a pass over the dataset, while data
+    loading happens only once and each batch is processed in a single forward pass.
+
+    Args:
+        curvature: Any curvature instance after `invert`.
+        data: An iterable of inputs and labels, e.g. a `DataLoader`.
+        samples: The number of weight samples. Default: 30.
+        transform: Function applied to the outputs of each sample before averaging. Default: softmax.
+        device: The device of the model. Default: the device of its first parameter.
+
+    Returns:
+        The mean predictions of shape (N, ...) and the labels of shape (N,).
+    """
+    model = curvature.model
+    device = device or next(model.parameters()).device
+    model.eval()
+    draws = curvature.draw(samples)
+    predictions, targets = list(), list()
+    for inputs, labels in data:
+        predictions.append(posterior_predictive(model, draws, inputs.to(device), transform).mean(dim=0))
+        targets.append(labels)
+    return torch.cat(predictions), torch.cat(targets)
+
+
+def probit(mean: Tensor,
+           covariance: Tensor) -> Tensor:
+    r"""Approximates the expected softmax of Gaussian logits by the (multi-class) probit approximation.
+
+    Each logit is scaled by :math:`\kappa_c=(1+\frac{\pi}{8}\Sigma_{cc})^{-1/2}` before the softmax, i.e. only the
+    variances are used.
+
+    Source: `Being Bayesian, Even Just a Bit, Fixes Overconfidence in ReLU Networks <https://arxiv.org/abs/2002.10118>`_
+
+    Args:
+        mean: The mean of the logits of shape (..., C).
+        covariance: The covariance of the logits of shape (..., C, C).
+
+    Returns:
+        The approximate predictive class probabilities of shape (..., C).
+    """
+    variance = covariance.diagonal(dim1=-2, dim2=-1)
+    return F.softmax(mean * torch.rsqrt(1 + math.pi / 8 * variance).to(mean.dtype), dim=-1)
+
+
+def laplace_bridge(mean: Tensor,
+                   covariance: Tensor) -> Tensor:
+    r"""Approximates the distribution of the softmax of Gaussian logits by a Dirichlet and returns its mean.
+
+    With `K` classes, the Dirichlet parameters are
+    :math:`\alpha_k=\frac{1}{\Sigma_{kk}}\left(1-\frac{2}{K}+\frac{e^{\mu_k}}{K^2}\sum_le^{-\mu_l}\right)`.
+
+    Source: `Fast Predictive Uncertainty for Classification with Bayesian Deep Networks
+    <https://arxiv.org/abs/2003.01227>`_
+
+    Args:
+        mean: The mean of the logits of shape (..., C).
+        covariance: The covariance of the logits of shape (..., C, C).
+
+    Returns:
+        The approximate predictive class probabilities of shape (..., C).
+    """
+    classes, dtype = mean.shape[-1], mean.dtype
+    variance = covariance.diagonal(dim1=-2, dim2=-1).double()
+    mean = mean.double()
+    alpha = (1 - 2 / classes + torch.exp(mean + torch.logsumexp(-mean, dim=-1, keepdim=True)) / classes ** 2) / variance
+    return (alpha / alpha.sum(dim=-1, keepdim=True)).to(dtype)
+
+
+def glm_predictive(curvature: Curvature,
+                   jacobian: Jacobian,
+                   inputs: Tensor,
+                   link: str = 'probit') -> Tuple[Tensor, Tensor]:
+    """Computes the linearized (GLM) predictive class probabilities for a batch of inputs in a single pass.
+
+    The logits of the model linearized around the MAP estimate are Gaussian with the MAP logits as mean and the
+    covariance :math:`J\Sigma J^T` (see `Curvature.predictive_covariance`). The expected softmax is then approximated
+    in closed form, i.e. no weights are sampled.
+
+    Args:
+        curvature: Any curvature instance after `invert`.
+        jacobian: A `Jacobian` instance for the model of `curvature`.
+        inputs: A batch of inputs.
+        link: Either `probit` or `bridge` for the Laplace bridge. Default: `probit`.
+
+    Returns:
+        The predictive class probabilities of shape (batch, C) and the covariance of the logits of shape
+        (batch, C, C).
+    """
+    logits, jacobians = jacobian(inputs)
+    covariance = curvature.predictive_covariance(jacobians)
+    if link == 'probit':
+        return probit(logits, covariance), covariance
+    elif link == 'bridge':
+        return laplace_bridge(logits, covariance), covariance
+    raise ValueError(f"Unknown link {link}.")
+
+
+def predict_glm(curvature: Curvature,
+                data: Iterable[Tuple[Tensor, Tensor]],
+                link: str = 'probit',
+                device: torch.device = None) -> Tuple[Tensor, Tensor]:
+    """Computes the linearized predictive class probabilities over a dataset, see `glm_predictive`.
+
+    The result can be passed to `calibration_curve` or `expected_calibration_error` as is.
+
+    Args:
+        curvature: Any curvature instance after `invert`.
+        data: An iterable of inputs and labels, e.g. a `DataLoader`.
+        link: Either `probit` or `bridge` for the Laplace bridge. Default: `probit`.
+        device: The device of the model. Default: the device of its first parameter.
+
+    Returns:
+        The predictive class probabilities of shape (N, C) and the labels of shape (N,).
+    """
+    model = curvature.model
+    device = device or next(model.parameters()).device
+    model.eval()
+    names = [name for name, layer in model.named_modules() if curvature._selects(layer)]
+    jacobian = Jacobian(model, [layer for layer in curvature.layer_types if layer in ['Linear', 'Conv2d']], names)
+    predictions, targets = list(), list()
+    try:
+        for inputs, labels in data:
+            predictions.append(glm_predictive(curvature, jacobian, inputs.to(device), link)[0])
+            targets.append(labels)
+    finally:
+        jacobian.remove()
+    return torch.cat(predictions), torch.cat(targets)
+
+
+@torch.no_grad()
+def cache_features(model: Module,
+                   layer: Module,
+                   data: Iterable[Tuple[Tensor, Tensor]],
+                   device: torch.device = None) -> Tuple[Tensor, Tensor]:
+    """Computes the inputs of `layer`, e.g. the features of the last layer, for a whole dataset in one pass.
+
+    Args:
+        model: Any PyTorch model, in `eval` mode.
+        layer: A module of `model`.
+        data: An iterable of inputs and labels, e.g. a `DataLoader`.
+        device: The device of the model. Default: the device of its first parameter.
+
+    Returns:
+        The features of shape (N, ...) and the labels of shape (N,).
+    """
+    device = device or next(model.parameters()).device
+    features, targets = list(), list()
+    hook = layer.register_forward_pre_hook(lambda module, input: features.append(input[0].detach()))
+    try:
+        for inputs, labels in data:
+            model(inputs.to(device))
+            targets.append(labels)
+    finally:
+        hook.remove()
+    return torch.cat(features), torch.cat(targets)
+
+
+def fit_features(curvature: Curvature,
+                 layer: Module,
+                 features: Tensor,
+                 labels: Tensor = None,
+                 batch_size: int = 32):
+    """Updates a curvature restricted to the last layer from cached features, backpropagating through `layer` only.
+
+    Args:
+        curvature: A curvature instance whose only selected layer is `layer`, see `layer_names`.
+        layer: The last layer of the model, whose outputs are the logits.
+        features: The inputs of `layer` as returned by `cache_features`.
+        labels: The labels of the features. If `None`, labels are sampled from the models' output distribution,
+                i.e. the Fisher is approximated by Monte Carlo integration. Default: None.
+        batch_size: The number of features per update.
+    """
+    assert curvature.selection == [layer], "The curvature has to be restricted to `layer`."
+    criterion = CrossEntropyLoss()
+    for start in range(0, features.shape[0], batch_size):
+        batch = features[start:start + batch_size]
+        logits = layer(batch)
+        if labels is None:
+            targets = torch.distributions.Categorical(logits=logits.detach()).sample()
+        else:
+            targets = labels[start:start + batch_size].to(logits.device)
+        layer.zero_grad(set_to_none=False)
+        criterion(logits, targets).backward()
+        curvature.update(batch_size=batch.shape[0])
+
+
+def last_layer_jacobians(layer: Module,
+                         features: Tensor) -> Dict[Module, Tensor]:
+    r"""Computes the Jacobians of the outputs of a `Linear` layer w.r.t. its weights in closed form.
+
+    The Jacobian of output `c` w.r.t. the weight `(o, i)` is :math:`\delta_{co}\phi_i` with the (bias-augmented)
+    features :math:`\phi`, i.e. no backward pass is required.
+
+    Args:
+        layer: A `Linear` layer.
+        features: The inputs of `layer` of shape (batch, in).
+
+    Returns:
+        A dict mapping `layer` to the Jacobians of shape (batch, C, C, in), bias as last column if present.
+    """
+    assert layer.__class__.__name__ == 'Linear', "Only `Linear` layers are supported."
+    if layer.bias is not None:
+        features = torch.cat([features, torch.ones_like(features[:, :1])], dim=1)
+    eye = torch.eye(layer.out_features, dtype=features.dtype, device=features.device)
+    return {layer: eye[None, :, :, None] * features[:, None, None, :]}
+
+
+@torch.no_grad()
+def last_layer_predictive(curvature: Curvature,
+                          layer: Module,
+                          features: Tensor,
+                          link: str = 'probit',
+                          batch_size: int = 256) -> Tuple[Tensor, Tensor]:
+    r"""Computes the linearized predictive of a last-layer Laplace approximation from cached features.
+
+    As the logits are linear in the weights of the last layer, the linearization is exact and the covariance of the
+    logits is the quadratic form :math:`J\Sigma J^T` of the closed-form Jacobians in the features. Only the last layer is
+    evaluated, i.e. predictions cost a single forward pass of the backbone to compute the features.
+
+    Args:
+        curvature: Any curvature instance restricted to `layer` after `invert`.
+        layer: The last `Linear` layer of the model, whose outputs are the logits.
+        features: The inputs of `layer` as returned by `cache_features`.
+        link: Either `probit` or `bridge` for the Laplace bridge. Default: `probit`.
+        batch_size: The number of features processed at once.
+
+    Returns:
+        The predictive class probabilities of shape (N, C) and the covariance of the logits of shape (N, C, C).
+    """
+    probabilities, covariances = list(), list()
+    for batch in features.split(batch_size):
+        logits = layer(batch)
+        covariance = curvature.predictive_covariance(last_layer_jacobians(layer, batch))
+        if link == 'probit':
+            probabilities.append(probit(logits, covariance))
+        elif link == 'bridge':
+            probabilities.append(laplace_bridge(logits, covariance))
+        else:
+            raise ValueError(f"Unknown link {link}.")
+        covariances.append(covariance)
+    return torch.cat(probabilities), torch.cat(covariances)
@@ -0,0 +1,178 @@
+"""Tiled, memory-mapped on-disk storage for large symmetric matrices such as dense Hessians."""
+
+from typing import Union, Tuple, Iterator
+import struct
+
+import numpy as np
+import torch
+from torch import Tensor
+
+_MAGIC = b'HSTORE01'
+_HEADER = struct.Struct('<8s8sqq')  # magic, dtype, size, tile size
+_DTYPES = {torch.float32: 'float32', torch.float64: 'float64'}
+
+
+class HessianStore:
+    """A symmetric P x P matrix stored as raw upper-triangular tiles behind a small header.
+
+    The file consists of a header (magic, dtype, size `P`, tile size `T`) followed by the tiles `(i, j)` with `i <= j`
+    in row-major order, each stored as a full `T x T` block (zero-padded at the edges). The file is memory-mapped, s.t.
+    only tiles which are actually accessed are read from disk. Slicing returns regular tensors, e.g. `store[a:b, a:b]`
+    reads only the tiles overlapping the requested block, which makes the store a drop-in replacement for a dense
+    tensor in read-only analysis code.
+    """
+
+    def __init__(self,
+                 filename: str,
+                 mode: str = 'r'):
+        """HessianStore class initializer. Opens an existing store.
+
+        Args:
+            filename: Path of the store.
+            mode: `r` for read-only or `r+` for read-write access.
+        """
+        with open(filename, 'rb') as f:
+            magic, dtype, size, tile_size = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(f"{filename} is not a Hessian store.")
+        self.filename = filename
+        self.size = size
+        self.tile_size = tile_size
+        self.tiles = -(-size // tile_size)
+        self.np_dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        self.dtype = {name: dtype for dtype, name in _DTYPES.items()}[self.np_dtype.name]
+        self.data = np.memmap(filename, dtype=self.np_dtype, mode=mode, offset=_HEADER.size,
+                              shape=(self.tiles * (self.tiles + 1) // 2, tile_size, tile_size))
+
+    @classmethod
+    def create(cls,
+               filename: str,
+               size: int,
+               tile_size: int = 1024,
+               dtype: torch.dtype = torch.float32) -> 'HessianStore':
+        """Creates an empty (zero) store and opens it for writing.
+
+        Args:
+            filename: Path of the store.
+            size: The number of rows and columns `P`.
+            tile_size: The number of rows and columns of each tile.
+            dtype: Either `torch.float32` or `torch.float64`.
+
+        Returns:
+            The opened store.
+        """
+        tiles = -(-size // tile_size)
+        np_dtype = np.dtype(_DTYPES[dtype])
+        with open(filename, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, np_dtype.name.encode(), size, tile_size))
+            f.truncate(_HEADER.size + tiles * (tiles + 1) // 2 * tile_size ** 2 * np_dtype.itemsize)
+        return cls(filename, mode='r+')
+
+    @classmethod
+    def from_tensor(cls,
+                    filename: str,
+                    matrix: Tensor,
+                    tile_size: int = 1024,
+                    dtype: torch.dtype = torch.float32,
+                    upper: bool = False,
+                    scale: float = 1.) -> 'HessianStore':
+        """Writes a symmetric matrix to a new store, tile by tile.
+
+        Args:
+            filename: Path of the store.
+            matrix: A symmetric matrix of shape (P, P).
+            tile_size: The number of rows and columns of each tile.
+            dtype: Either `torch.float32` or `torch.float64`.
+            upper: If True, only the upper triangle of `matrix` is valid, as in the state of `DenseCurvature`.
+            scale: Factor applied to all elements.
+
+        Returns:
+            The opened store.
+        """
+        store = cls.create(filename, matrix.shape[0], tile_size, dtype)
+        for i, j, rows, cols in store.indices():
+            tile = matrix[rows, cols]
+            if i == j and upper:
+                tile = tile.triu() + tile.triu(diagonal=1).t()
+            store.write(i, j, tile * scale)
+        store.data.flush()
+        return store
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.size, self.size
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device('cpu')
+
+    def numel(self) -> int:
+        return self.size ** 2
+
+    def _index(self, i: int, j: int) -> int:
+        """Position of the upper-triangular tile `(i, j)`, `i <= j`, in the file."""
+        return i * self.tiles - i * (i - 1) // 2 + j - i
+
+    def _range(self, i: int) -> slice:
+        return slice(i * self.tile_size, min((i + 1) * self.tile_size, self.size))
+
+    def indices(self) -> Iterator[Tuple[int, int, slice, slice]]:
+        """Iterates over the stored (upper-triangular) tiles.
+
+        Yields:
+            The tile indices `i <= j` and the corresponding row and column ranges of the matrix.
+        """
+        for i in range(self.tiles):
+            for j in range(i, self.tiles):
+                yield i, j, self._range(i), self._range(j)
+
+    def tile(self, i: int, j: int) -> Tensor:
+        """Reads tile `(i, j)`. Tiles of the lower triangle are obtained by transposition.
+
+        Returns:
+            A tensor of shape (rows, cols) without padding, sharing memory with the file.
+        """
+        if i > j:
+            return self.tile(j, i).t()
+        rows, cols = self._range(i), self._range(j)
+        tile = torch.from_numpy(self.data[self._index(i, j)])
+        return tile[:rows.stop - rows.start, :cols.stop - cols.start]
+
+    def write(self, i: int, j: int, tile: Tensor):
+        """Writes tile `(i, j)`, `i <= j`."""
+        assert i <= j, "Only tiles of the upper triangle are stored."
+        self.tile(i, j).copy_(tile)
+
+    def __getitem__(self, index: Tuple[slice, slice]) -> Tensor:
+        """Reads a (contiguous, unit-step) block of the matrix, touching only the overlapping tiles."""
+        rows, cols = [slice(*part.indices(self.size)) for part in index]
+        assert rows.step == 1 and cols.step == 1, "Only unit-step slices are supported."
+        block = torch.empty(max(rows.stop - rows.start, 0), max(cols.stop - cols.start, 0), dtype=self.dtype)
+        for i in range(rows.start // self.tile_size, -(-rows.stop // self.tile_size)):
+            for j in range(cols.start // self.tile_size, -(-cols.stop // self.tile_size)):
+                tile_rows, tile_cols = self._range(i), self._range(j)
+                r0, r1 = max(rows.start, tile_rows.start), min(rows.stop, tile_rows.stop)
+                c0, c1 = max(cols.start, tile_cols.start), min(cols.stop, tile_cols.stop)
+                if r0 < r1 and c0 < c1:
+                    block[r0 - rows.start:r1 - rows.start, c0 - cols.start:c1 - cols.start] = \
+                        self.tile(i, j)[r0 - tile_rows.start:r1 - tile_rows.start,
+                                        c0 - tile_cols.start:c1 - tile_cols.start]
+        return block
+
+    def diagonal(self) -> Tensor:
+        """Reads the diagonal from the diagonal tiles only."""
+        return torch.cat([self.tile(i, i).diagonal() for i in range(self.tiles)])
+
+    def abs_sum(self) -> float:
+        """Computes the sum of the absolute values of all elements, counting off-diagonal tiles twice."""
+        total = 0.
+        for i, j, _, _ in self.indices():
+            total += (1 if i == j else 2) * self.tile(i, j).abs().sum().item()
+        return total
+
+
+def abs_sum(matrix: Union[Tensor, HessianStore]) -> float:
+    """Computes the sum of the absolute values of a dense tensor or (tile-wise) of a `HessianStore`."""
+    if isinstance(matrix, HessianStore):
+        return matrix.abs_sum()
+    return matrix.abs().sum().item()
@@ -0,0 +1,262 @@
+"""Vectorized search for the prior precision (`add`) and dataset scale (`multiply`) of the Laplace approximation.
+
+All objectives are evaluated for a whole grid of (add, multiply) pairs at once from the eigenvalues of the curvature,
+s.t. no inversion is required per grid point. See `Curvature.eigendecompose`.
+"""
+
+from typing import Union, Tuple, Dict
+import math
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+import torch.nn.functional as F
+
+from .curvatures import Curvature, Diagonal, BlockDiagonal, KernelBlockDiagonal, KFAC, EFB, DenseCurvature
+from .jacobians import flatten
+
+
+def grid(calls: int = 50,
+         add_bounds: Tuple[float, float] = (1e-4, 1e4),
+         multiply_bounds: Tuple[float, float] = (1., 1.),
+         optimizer: str = "grid",
+         boundaries: bool = False) -> Tuple[Tensor, Tensor]:
+    """Generates (add, multiply) pairs, log-uniformly spaced within the given bounds.
+
+    Args:
+        calls: Number of pairs. For `grid`, the closest square number of pairs is used if both bounds are non-trivial.
+        add_bounds: Lower and upper bound of `add`.
+        multiply_bounds: Lower and upper bound of `multiply`.
+        optimizer: Either `grid` for a regular grid or `random` for random search.
+        boundaries: If True, the corners of the search space are always included.
+
+    Returns:
+        The `add` and `multiply` values, each of shape (calls,).
+    """
+    log_add = [math.log10(bound) for bound in add_bounds]
+    log_multiply = [math.log10(bound) for bound in multiply_bounds]
+    if optimizer == "grid":
+        if log_add[0] == log_add[1] or log_multiply[0] == log_multiply[1]:
+            steps_add = steps_multiply = calls
+        else:
+            steps_add = steps_multiply = max(int(round(calls ** 0.5)), 2)
+        add = torch.logspace(log_add[0], log_add[1], steps_add, dtype=torch.float64)
+        multiply = torch.logspace(log_multiply[0], log_multiply[1], steps_multiply, dtype=torch.float64)
+        if log_add[0] == log_add[1]:
+            add, multiply = add[:1].expand(steps_multiply), multiply
+        elif log_multiply[0] == log_multiply[1]:
+            add, multiply = add, multiply[:1].expand(steps_add)
+        else:
+            add, multiply = torch.cartesian_prod(add, multiply).t()
+    elif optimizer == "random":
+        add = 10 ** (log_add[0] + (log_add[1] - log_add[0]) * torch.rand(calls, dtype=torch.float64))
+        multiply = 10 ** (log_multiply[0] + (log_multiply[1] - log_multiply[0]) * torch.rand(calls,
+                                                                                            dtype=torch.float64))
+    else:
+        raise ValueError(f"Unknown optimizer: {optimizer}")
+    if boundaries:
+        corners = torch.cartesian_prod(torch.tensor(add_bounds, dtype=torch.float64),
+                                       torch.tensor(multiply_bounds, dtype=torch.float64)).t()
+        add, multiply = torch.cat([add, corners[0]]), torch.cat([multiply, corners[1]])
+    return add.contiguous(), multiply.contiguous()
+
+
+def _spectrum(curvature: Curvature) -> Dict[Union[Module, str], Tuple[Tensor, ...]]:
+    """Collects the eigenvalues and eigenvectors of each block or factor of `curvature`.
+
+    Args:
+        curvature: A `Diagonal`, `BlockDiagonal`, `KernelBlockDiagonal`, `KFAC`, `EFB` or `DenseCurvature` instance
+                   with non-empty state.
+
+    Returns:
+        A dict mapping layers to (eigenvalues, eigenvectors) for `BlockDiagonal` and `DenseCurvature`,
+        ((weight eigenvalues, eigenvectors), (bias eigenvalues, eigenvectors) or None) for `KernelBlockDiagonal`,
+        ((first eigenvalues, eigenvectors), (second eigenvalues, eigenvectors)) for `KFAC`, (eigenvalues, first
+        eigenvectors, second eigenvectors) for `EFB` and (eigenvalues,) for `Diagonal`.
+    """
+    assert curvature.state, "State dict is empty. Did you call 'update' prior to this?"
+    if isinstance(curvature, (BlockDiagonal, KernelBlockDiagonal, KFAC, DenseCurvature)):
+        if not curvature.eigen:
+            curvature.eigendecompose()
+        return curvature.eigen
+    if isinstance(curvature, EFB):
+        return {layer: (value, *curvature.eigvecs[layer]) for layer, value in curvature.state.items()}
+    if isinstance(curvature, Diagonal):
+        return {layer: (value,) for layer, value in curvature.state.items()}
+    raise NotImplementedError
+
+
+def _parameters(curvature: Curvature,
+                layer: Union[Module, str]) -> Tensor:
+    """Returns the flattened parameters of `layer` in the order of its curvature block, restricted to `subset`."""
+    layers = curvature.layers if layer == 'dense' else [layer]
+    parameters = flatten({layer: torch.cat([layer.weight.reshape(layer.weight.shape[0], -1)] +
+                                           ([layer.bias.unsqueeze(1)] if layer.bias is not None else []), dim=1)
+                          for layer in layers}).detach()
+    if layer == 'dense' and curvature.subset is not None:
+        return parameters[curvature.subset]
+    return parameters
+
+
+def log_marginal_likelihood(curvature: Curvature,
+                            add: Tensor,
+                            multiply: Tensor,
+                            loss: float) -> Tensor:
+    r"""Computes the Laplace log marginal likelihood for all (add, multiply) pairs at once.
+
+    With the curvature `F` of the negative log-likelihood `loss` at the MAP estimate :math:`\theta`, a Gaussian prior
+    with precision `add` and the likelihood scaled by `multiply`, it is (up to constants)
+    :math:`-s\,\mathrm{loss}-\frac{n}{2}\lVert\theta\rVert^2+\frac{P}{2}\log n-\frac{1}{2}\log\det(sF+nI)`.
+    For `KFAC`, the regularized factors :math:`\sqrt{s}Q+\sqrt{n}I` and :math:`\sqrt{s}H+\sqrt{n}I` are used, as in
+    `KFAC.invert`. As the evidence of a fixed MAP estimate always favours a smaller `multiply`, it is best used to
+    select `add`, while `validation_nll` can select both.
+
+    Args:
+        curvature: A `Diagonal`, `BlockDiagonal`, `KernelBlockDiagonal`, `KFAC`, `EFB` or `DenseCurvature` instance
+                   with non-empty state.
+        add: Prior precisions of shape (G,).
+        multiply: Dataset scales of shape (G,).
+        loss: Negative log-likelihood of the training data at the MAP estimate, whose curvature is `state`.
+
+    Returns:
+        The log marginal likelihood of shape (G,).
+    """
+    add, multiply = add.to(torch.float64), multiply.to(torch.float64)
+    logml = -multiply * loss
+    for layer, spectrum in _spectrum(curvature).items():
+        if isinstance(curvature, KFAC):
+            (frst_eigvals, _), (scnd_eigvals, _) = spectrum
+            frst = torch.log(multiply.sqrt().unsqueeze(1) * frst_eigvals.to(add) + add.sqrt().unsqueeze(1)).sum(1)
+            scnd = torch.log(multiply.sqrt().unsqueeze(1) * scnd_eigvals.to(add) + add.sqrt().unsqueeze(1)).sum(1)
+            logdet = scnd_eigvals.numel() * frst + frst_eigvals.numel() * scnd
+            size = frst_eigvals.numel() * scnd_eigvals.numel()
+        elif isinstance(curvature, KernelBlockDiagonal):
+            (eigvals, _), bias = spectrum
+            eigvals = torch.cat([eigvals.reshape(-1)] + ([bias[0]] if bias is not None else [])).to(add)
+            logdet = torch.log(multiply.unsqueeze(1) * eigvals + add.unsqueeze(1)).sum(1)
+            size = eigvals.numel()
+        else:
+            eigvals = spectrum[0].reshape(-1).to(add)
+            logdet = torch.log(multiply.unsqueeze(1) * eigvals + add.unsqueeze(1)).sum(1)
+            size = eigvals.numel()
+        norm = _parameters(curvature, layer).to(add).pow(2).sum()
+        logml = logml - 0.5 * add * norm + 0.5 * size * add.log() - 0.5 * logdet
+    return logml
+
+
+def predictive_variance(curvature: Curvature,
+                        jacobians: Dict[Module, Tensor],
+                        add: Tensor,
+                        multiply: Tensor) -> Tensor:
+    """Computes the predictive variance of all (add, multiply) pairs at once.
+
+    The Jacobians are projected onto the eigenbasis of each block once, after which the variance of each pair is a
+    single matrix product with the reciprocal regularized eigenvalues.
+
+    Args:
+        curvature: A `Diagonal`, `BlockDiagonal`, `KernelBlockDiagonal`, `KFAC`, `EFB` or `DenseCurvature` instance
+                   with non-empty state.
+        jacobians: A dict mapping layers to Jacobians of shape (..., out, in), as computed by
+                   `models.jacobians.Jacobian`.
+        add: Prior precisions of shape (G,).
+        multiply: Dataset scales of shape (G,).
+
+    Returns:
+        The predictive variance of shape (G, ...).
+    """
+    spectra = _spectrum(curvature)
+    shape = next(iter(jacobians.values())).shape[:-2]
+    variance = 0.
+    for layer, spectrum in spectra.items():
+        if isinstance(curvature, DenseCurvature):
+            eigvals, eigvecs = spectrum
+            projection = curvature._flatten(jacobians).to(eigvecs) @ eigvecs
+        elif layer not in jacobians:
+            continue
+        elif isinstance(curvature, BlockDiagonal):
+            eigvals, eigvecs = spectrum
+            projection = flatten({layer: jacobians[layer]}).to(eigvecs) @ eigvecs
+        elif isinstance(curvature, KernelBlockDiagonal):
+            (eigvals, eigvecs), bias = spectrum
+            jacobian = jacobians[layer].to(eigvecs)
+            weight = jacobian[..., :eigvecs.shape[1]].unsqueeze(-2) @ eigvecs
+            projection = [weight.squeeze(-2).flatten(start_dim=-2)]
+            if bias is not None:
+                projection.append(jacobian[..., -1] @ bias[1])
+                eigvals = torch.cat([eigvals.reshape(-1), bias[0]])
+            projection = torch.cat(projection, dim=-1)
+        elif isinstance(curvature, KFAC):
+            (frst_eigvals, frst_eigvecs), (scnd_eigvals, scnd_eigvecs) = spectrum
+            projection = scnd_eigvecs.t() @ jacobians[layer].to(frst_eigvecs) @ frst_eigvecs
+        elif isinstance(curvature, EFB):
+            eigvals, frst_eigvecs, scnd_eigvecs = spectrum
+            projection = scnd_eigvecs.t() @ jacobians[layer].to(frst_eigvecs) @ frst_eigvecs
+        else:
+            eigvals = spectrum[0]
+            projection = jacobians[layer]
+        projection = projection.reshape(*shape, -1).to(torch.float64) ** 2
+
+        add_, multiply_ = add.to(projection).unsqueeze(1), multiply.to(projection).unsqueeze(1)
+        if isinstance(curvature, KFAC):
+            precision = ((multiply_.sqrt() * scnd_eigvals.to(projection) + add_.sqrt()).unsqueeze(2) *
+                         (multiply_.sqrt() * frst_eigvals.to(projection) + add_.sqrt()).unsqueeze(1))
+            precision = precision.reshape(len(add), -1)
+        else:
+            precision = multiply_ * eigvals.reshape(-1).to(projection) + add_
+        variance = variance + (projection.reshape(-1, projection.shape[-1]) @ precision.reciprocal().t()).t()
+    return variance.reshape(len(add), *shape)
+
+
+def validation_nll(curvature: Curvature,
+                   jacobians: Dict[Module, Tensor],
+                   outputs: Tensor,
+                   targets: Tensor,
+                   add: Tensor,
+                   multiply: Tensor,
+                   sigma: float = None) -> Tensor:
+    r"""Computes the negative log-likelihood of held-out data under the linearized Laplace predictive for all pairs.
+
+    For classification, the probit approximation :math:`\mathrm{softmax}(f/\sqrt{1+\pi\sigma^2_f/8})` of the
+    predictive is used. For regression, the predictive is Gaussian with the observation noise `sigma` added.
+
+    Args:
+        curvature: A `Diagonal`, `BlockDiagonal`, `KernelBlockDiagonal`, `KFAC`, `EFB` or `DenseCurvature` instance
+                   with non-empty state.
+        jacobians: A dict mapping layers to Jacobians of shape (N, C, out, in) of the model outputs (logits for
+                   classification).
+        outputs: Model outputs of shape (N, C) at the MAP estimate.
+        targets: Class labels of shape (N,) for classification or regression targets of shape (N, C).
+        add: Prior precisions of shape (G,).
+        multiply: Dataset scales of shape (G,).
+        sigma: Standard deviation of the observation noise. If None, `outputs` are treated as logits.
+
+    Returns:
+        The mean negative log-likelihood of shape (G,).
+    """
+    variance = predictive_variance(curvature, jacobians, add, multiply).to(outputs)
+    if sigma is None:
+        log_probs = F.log_softmax(outputs / torch.sqrt(1 + math.pi / 8 * variance), dim=-1)
+        return -log_probs.gather(-1, targets.view(1, -1, 1).expand(len(add), -1, 1)).squeeze(-1).mean(1)
+    variance = variance + sigma ** 2
+    nll = 0.5 * torch.log(2 * math.pi * variance) + (targets - outputs) ** 2 / (2 * variance)
+    return nll.reshape(len(add), -1).sum(1) / outputs.shape[0]
+
+
+def best(scores: Tensor,
+         add: Tensor,
+         multiply: Tensor,
+         maximize: bool = True) -> Tuple[float, float]:
+    """Returns the (add, multiply) pair with the best score.
+
+    Args:
+        scores: Scores of shape (G,), e.g. from `log_marginal_likelihood` or `validation_nll`.
+        add: Prior precisions of shape (G,).
+        multiply: Dataset scales of shape (G,).
+        maximize: Whether higher scores are better.
+
+    Returns:
+        The best `add` and `multiply`.
+    """
+    scores = torch.nan_to_num(scores, nan=-math.inf if maximize else math.inf)
+    index = scores.argmax() if maximize else scores.argmin()
+    return add[index].item(), multiply[index].item()
@@ -18,6 +18,8 @@ from tqdm import tqdm
 from scipy.stats import entropy
 from matplotlib import pyplot as plt
 
+from .storage import abs_sum
+
 
 def get_near_psd(A, epsilon):
     C = (A + A.T)/2
@@ -48,17 +50,19 @@ def jacobian(y, x, device):
 
 
 def calculateDominance(H, regParam = 0.00001):
-    if H.numel() != 15080 ** 2:
+    # H is a tensor or a HessianStore, of which only the diagonal and kernel blocks are read at once
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * regParam
     coords = generate_kernel_coords()
 
-    sum_diag = torch.diag(reg).abs().sum().item()
-    sum_all  = reg.abs().sum().item()
+    diag = H.diagonal()
+    sum_diag = (diag + regParam).abs().sum().item()
+    sum_all  = abs_sum(H) - diag.abs().sum().item() + sum_diag
     sum_block=0
     for (a,b) in coords:
-        sum_block += reg[a:b,a:b].abs().sum().item()
+        block = H[a:b,a:b]
+        sum_block += block.abs().sum().item() - block.diagonal().abs().sum().item() \
+            + (block.diagonal() + regParam).abs().sum().item()
 
     print(f"Sum of diagonal         : {sum_diag:.2f}")
     print(f"Sum of kernel diagonal  : {sum_block:.2f}")
@@ -69,16 +73,17 @@ def calculateDominance(H, regParam = 0.00001):
     return sum_diag/sum_all, sum_block/sum_all
 
 def calculateEigval(H, regParam = 0.00001):
-    if H.numel() != 15080 ** 2:
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * regParam
+    # only the leading 1000 x 1000 block is read
+    reg = H[:1000,:1000].clone()
+    reg.diagonal().add_(regParam)
     # coords = generate_kernel_coords()
 
     try:
-        eig = torch.eig(reg[:1000,:1000])[0].cpu()
+        eig = torch.eig(reg)[0].cpu()
     except:
-        eig = torch.linalg.eigvals(reg[:1000,:1000])[0].cpu()
+        eig = torch.linalg.eigvals(reg)[0].cpu()
 
     if eig[:,1].abs().max() > 1e-30:
         raise ValueError('The eigenvalues of the matrix contain imaginary parts')
@@ -117,6 +122,56 @@ def generate_kernel_coords():
 
     return coords
 
+def last_layer(model: Module,
+               layer_types: Union[List[str], str] = None) -> str:
+    """Returns the name of the last `Linear` or `Conv2d` module of a model, e.g. to select it by `layer_names`.
+
+    Args:
+        model: Any PyTorch model.
+        layer_types: Types of layers to consider. Supported are `Linear` and `Conv2d`. Default: both.
+
+    Returns:
+        The name of the module as in `model.named_modules()`.
+    """
+    if isinstance(layer_types, str):
+        layer_types = [layer_types]
+    layer_types = layer_types or ['Linear', 'Conv2d']
+    names = [name for name, layer in model.named_modules() if layer.__class__.__name__ in layer_types]
+    assert names, "The model has no layer of the selected types."
+    return names[-1]
+
+
+def kernel_coords(model: Module,
+                  layer_types: Union[List[str], str] = None) -> List[Tuple[int, int]]:
+    """Computes the index ranges of the kernel blocks of a model in parameter order.
+
+    Each output neuron (filter) of a `Linear` (`Conv2d`) layer contributes one block with its incoming weights, and the
+    bias of each layer one block with all of its elements, as in `models.curvatures.KernelBlockDiagonal`.
+
+    Args:
+        model: Any PyTorch model. Parameters of other than the selected layers have to follow the selected ones.
+        layer_types: Types of layers to consider. Supported are `Linear` and `Conv2d`. Default: both.
+
+    Returns:
+        A list of (start, end) tuples, one per block.
+    """
+    if isinstance(layer_types, str):
+        layer_types = [layer_types]
+    layer_types = layer_types or ['Linear', 'Conv2d']
+    coords = []
+    curr = 0
+    for layer in model.modules():
+        if layer.__class__.__name__ in layer_types:
+            size = layer.weight[0].numel()
+            for _ in range(layer.weight.shape[0]):
+                coords.append((curr, curr + size))
+                curr += size
+            if layer.bias is not None:
+                coords.append((curr, curr + layer.bias.numel()))
+                curr += layer.bias.numel()
+    return coords
+
+
 def get_eigenvalues(factors: List[Tensor],
                     verbose: bool = False) -> Tensor:
     """Computes the eigenvalues of KFAC, EFB or diagonal factors.
@@ -409,6 +464,142 @@ def kron(a: Tensor,
     return torch.einsum("ab,cd->acbd", [a, b]).contiguous().view(a.size(0) * b.size(0), a.size(1) * b.size(1))
 
 
+def packed_offset(row: int,
+                  size: int) -> int:
+    """Returns the position of the diagonal element of `row` in the packed upper triangle of a `size` x `size` matrix.
+
+    The packed upper triangle stores the elements `(i, j)`, `j >= i`, row by row, i.e. row `i` occupies
+    `packed[packed_offset(i, size):packed_offset(i + 1, size)]` and the packed tensor has `size * (size + 1) / 2`
+    elements.
+    """
+    return row * size - row * (row - 1) // 2
+
+
+def packed_size(length: int) -> int:
+    """Returns the number of rows of the symmetric matrix whose packed upper triangle has `length` elements."""
+    return (int(round((8 * length + 1) ** 0.5)) - 1) // 2
+
+
+def packed_diagonal(size: int,
+                    device: torch.device = None) -> Tensor:
+    """Returns the positions of the diagonal elements in the packed upper triangle of a `size` x `size` matrix."""
+    rows = torch.arange(size, device=device)
+    return rows * size - rows * (rows - 1) // 2
+
+
+def _trapezoid(rows: int,
+               cols: int,
+               device: torch.device) -> Tensor:
+    """Mask of the upper trapezoid of a (rows, cols) block starting on the diagonal."""
+    return torch.ones(rows, cols, dtype=torch.bool, device=device).triu()
+
+
+def packed_rows(packed: Tensor,
+                size: int,
+                start: int,
+                end: int) -> Tensor:
+    """Unpacks rows `start:end` of a packed upper triangle, from column `start` onwards.
+
+    Args:
+        packed: The packed upper triangle of a `size` x `size` matrix.
+        size: The number of rows (and columns) of the matrix.
+        start: The first row.
+        end: The row after the last row.
+
+    Returns:
+        A tensor of shape (end - start, size - start), which is zero below the diagonal.
+    """
+    block = packed.new_zeros(end - start, size - start)
+    block.masked_scatter_(_trapezoid(end - start, size - start, packed.device),
+                          packed[packed_offset(start, size):packed_offset(end, size)])
+    return block
+
+
+def pack(matrix: Tensor,
+         tile_size: int = 1024) -> Tensor:
+    """Packs the upper triangle of a square matrix row by row into a 1D tensor, using `tile_size` rows at a time.
+
+    Args:
+        matrix: A tensor of shape (P, P) of which only the upper triangle is read.
+        tile_size: The number of rows packed at once.
+
+    Returns:
+        A tensor of shape (P * (P + 1) / 2).
+    """
+    size = matrix.shape[0]
+    packed = matrix.new_empty(size * (size + 1) // 2)
+    for start in range(0, size, tile_size):
+        end = min(start + tile_size, size)
+        packed[packed_offset(start, size):packed_offset(end, size)] = \
+            matrix[start:end, start:].masked_select(_trapezoid(end - start, size - start, matrix.device))
+    return packed
+
+
+def unpack(packed: Tensor,
+           size: int,
+           tile_size: int = 1024) -> Tensor:
+    """Unpacks a packed upper triangle into the full symmetric matrix, using `tile_size` rows at a time.
+
+    Args:
+        packed: A tensor of shape (P * (P + 1) / 2).
+        size: The number of rows (and columns) `P`.
+        tile_size: The number of rows unpacked at once.
+
+    Returns:
+        The symmetric matrix of shape (P, P).
+    """
+    matrix = packed.new_empty(size, size)
+    for start in range(0, size, tile_size):
+        end = min(start + tile_size, size)
+        block = packed_rows(packed, size, start, end)
+        matrix[start:, start:end] = block.t()
+        matrix[start:end, start:] = block
+        tile = block[:, :end - start]
+        matrix[start:end, start:end] = tile + tile.triu(diagonal=1).t()
+    return matrix
+
+
+def kahan_add(total: Tensor,
+              value: Tensor,
+              error: Tensor):
+    """Adds `value` to `total` in-place with Kahan compensation, updating the running rounding `error` in-place.
+
+    Args:
+        total: The running sum.
+        value: The summand of the shape of `total`. It is overwritten.
+        error: The running rounding error of the shape of `total`, initially zero.
+    """
+    # y = x - c, t = s + y, c = (t - s) - y, s = t
+    value.sub_(error)
+    updated = total + value
+    error.copy_(updated - total - value)
+    total.copy_(updated)
+
+
+def packed_syrk(packed: Tensor,
+                panel: Tensor,
+                tile_size: int = 1024,
+                compensation: Tensor = None):
+    """Adds the upper triangle of :math:`X^TX` for a panel `X` to a packed upper triangle in-place (cf. BLAS `syrk`).
+
+    Args:
+        packed: A tensor of shape (P * (P + 1) / 2).
+        panel: A tensor of shape (k, P), e.g. k gradients. The products are computed in its data type.
+        tile_size: The number of rows updated at once.
+        compensation: If given, the running rounding error of `packed` for a compensated sum, see `kahan_add`.
+    """
+    size = panel.shape[1]
+    for start in range(0, size, tile_size):
+        end = min(start + tile_size, size)
+        block = panel[:, start:end].t() @ panel[:, start:]
+        block = block.masked_select(_trapezoid(end - start, size - start, packed.device)).to(packed.dtype)
+        rows = slice(packed_offset(start, size), packed_offset(end, size))
+        if compensation is None:
+            packed[rows] += block
+        else:
+            kahan_add(packed[rows], block, compensation[rows])
+
+
 def seed_all_rng(seed: Union[int, None] = None):
     """
     Set the random seed for the RNG in torch, numpy and python.
@@ -483,7 +674,7 @@ def setup(required: bool = True,
     parser.add_argument("--momentum", default=0.9, type=float, help="Momentum in SGD training (default: 0.9)")
     parser.add_argument("--l2", default=0, type=float, help="L2-norm regularization strength (default: 0)")
     parser.add_argument("--optimizer", default="random", type=str,
-                        help="Optimizer used for hyperparameter optimization (deafult: random)")
+                        help="Optimizer used for hyperparameter optimization: grid or random (deafult: random)")
 
     parser.add_argument("--estimator", default="kfac", type=str, help="Fisher estimator (default: kfac)")
     parser.add_argument("--samples", default=30, type=int, help="Number of posterior weight samples (default: 30)")
@@ -8,16 +8,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import transforms, datasets
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, random_split
 
 # From the repository
 from models.wrapper import BaseNet
 from models.curvatures import BlockDiagonal, KFAC, EFB, INF
-from models.utilities import calibration_curve
-from models import plot
+from models.utilities import calibration_curve, setup
+from models.jacobians import Jacobian
+from models import plot, tuning, parallel, predictive
 
 
 if __name__ == '__main__':
+    args = setup(required=False)
     models_dir = 'theta'
     results_dir = 'results'
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -32,6 +34,9 @@ if __name__ == '__main__':
                                            train=True,
                                            transform=transforms.ToTensor(),
                                            download=True)
+    # hold out part of the training set for the hyperparameter search, s.t. the test set is only used for evaluation
+    train_set, val_set = random_split(train_set, [len(train_set) - 1000, 1000],
+                                      generator=torch.Generator().manual_seed(0))
     train_loader = DataLoader(train_set, batch_size=32)
 
     # And some for evaluating/testing
@@ -51,32 +56,40 @@ if __name__ == '__main__':
 
     # compute the Kronecker factored FiM
     kfac = KFAC(net.model)
-    for images, labels in tqdm(train_loader):
-        logits = net.model(images.to(device))
-        dist = torch.distributions.Categorical(logits=logits)
-        # A rank-1 Kronecker factored FiM approximation.
-        labels = dist.sample()
-        loss = criterion(logits, labels)
-        net.model.zero_grad()
-        loss.backward()
-        kfac.update(batch_size=images.size(0))
+    if args.parallel:
+        # data-parallel accumulation over shards of the training set, one process per worker
+        assert device == "cpu", "Data-parallel accumulation requires a CPU model."
+        parallel.accumulate(kfac, train_set, parallel.mc_fisher_step, workers=args.workers,
+                            batch_size=args.batch_size, cpus=args.cpus)
+    else:
+        for images, labels in tqdm(train_loader):
+            logits = net.model(images.to(device))
+            dist = torch.distributions.Categorical(logits=logits)
+            # A rank-1 Kronecker factored FiM approximation.
+            labels = dist.sample()
+            loss = criterion(logits, labels)
+            net.model.zero_grad(set_to_none=False)
+            loss.backward()
+            kfac.update(batch_size=images.size(0))
     kfac.save(models_dir + '/kfac.dat')
 
-    # inversion and sampling
+    # hyperparameter search: the validation NLL of all (add, multiply) pairs is computed from one eigendecomposition
     estimator = kfac
-    add = 1e15
-    multiply = 1e20
-    estimator.invert(add, multiply)
+    val_images, val_labels = next(iter(DataLoader(val_set, batch_size=len(val_set))))
+    jacobian = Jacobian(net.model)
+    val_logits, val_jacobians = jacobian(val_images.to(device))
+    jacobian.remove()
+    add, multiply = tuning.grid(calls=50, add_bounds=(1e10, 1e20), multiply_bounds=(1e15, 1e25), optimizer="grid",
+                                boundaries=True)
+    scores = tuning.validation_nll(estimator, val_jacobians, val_logits, val_labels.to(device), add, multiply)
+    add, multiply = tuning.best(scores, add, multiply, maximize=False)
+    print(f"Best add: {add:.2e}, multiply: {multiply:.2e}, validation NLL: {scores.min().item():.4f}")
 
-    mean_predictions = 0
-    samples = 10  # 10 Monte Carlo samples from the weight posterior.
+    # inversion and sampling
+    estimator.invert(add, multiply)
 
-    with torch.no_grad():
-        for sample in range(samples):
-            estimator.sample_and_replace()
-            predictions, labels = net.eval(test_loader)
-            mean_predictions += predictions
-        mean_predictions /= samples
+    samples = 10  # 10 Monte Carlo samples from the weight posterior, evaluated jointly in each forward pass.
+    mean_predictions, labels = predictive.predict(estimator, test_loader, samples, device=device)
     print(f"KFAC Accuracy: {100 * np.mean(np.argmax(mean_predictions.cpu().numpy(), axis=1) == labels.numpy()):.2f}%")
 
     # calibration
@@ -10,7 +10,7 @@ sys.path.append(parent)
 from models.wrapper import BaseNet
 from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF
 from models.utilities import calibration_curve
-from models import plot
+from models import plot, predictive
 
 
 import torch
@@ -78,12 +78,8 @@ x_ = Variable(x_)
 y_ = Variable(y_)
 
 
-pred_lst = []
-for i in range(100):
-    estimator.sample_and_replace()
-    pred_lst.append(net.forward(x_).data.numpy().squeeze(1))
-
-pred = np.array(pred_lst).T
+draws = estimator.draw(100)
+pred = predictive.posterior_predictive(net, draws, x_).squeeze(2).numpy().T
 pred_mean = pred.mean(axis=1)
 pred_std = pred.std(axis=1)
 
@@ -33,6 +33,7 @@ from models.curvatures import Diagonal, BlockDiagonal, KFAC, EFB, INF
 from models.utilities import *
 from models.plot import *
 from models.wrapper import *
+from models.jacobians import Jacobian
 
 # file path
 parent = os.path.dirname(os.path.dirname(current))
@@ -107,65 +108,38 @@ estimator.invert(std**2, N)
 
 
 # test image
+jacobian = Jacobian(net)
+softmax = lambda logits: F.softmax(logits, dim=1)
+const = 2*np.e*np.pi
 targets = torch.Tensor()
 kfac_prediction = torch.Tensor().to(device)
 kfac_entropy_lst  = []
 #mean_predictions, labels = net.eval(test_loader)
 for images,labels in tqdm(test_loader):
-    # prediction mean, equals to the MAP output 
-    pred_mean = torch.nn.functional.softmax(net(images.to(device)) ,dim=1)        
+    # prediction mean, equals to the MAP output; Jacobian of the predicted class probability
+    pred_mean, J = jacobian(images.to(device), transform=softmax, argmax=True)
     # compute prediction variance  
-    pred_std = 0
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs = torch.zeros_like(pred_mean)
-    grad_outputs[:,idx] = 1
-    for layer in list(estimator.model.modules())[1:]:
-        g = []
-        if layer in estimator.state:
-            if torch.cuda.is_available():
-                Q_i = estimator.inv_state[layer][0]
-                H_i = estimator.inv_state[layer][1] 
-                for p in layer.parameters():    
-                    g.append(torch.flatten(gradient(pred_mean, p, grad_outputs=grad_outputs)))
-                J_i = torch.cat(g, dim=0).unsqueeze(0) 
-                H = torch.kron(Q_i,H_i)
-                pred_std += torch.abs(J_i @ H @ J_i.t()).item()
+    pred_std = torch.abs(estimator.predictive_variance(J).squeeze(1))
     # uncertainty
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
-    kfac_entropy_lst.append(entropy) 
-    kfac_uncertainty = np.array(kfac_entropy_lst)
+    entropy = 0.5 * np.log2(const * pred_std.cpu().numpy())
+    kfac_entropy_lst.extend(entropy) 
     # ground truth
     targets = torch.cat([targets, labels])  
     # prediction, mean value of the gaussian distribution
     kfac_prediction = torch.cat([kfac_prediction, pred_mean]) 
+kfac_uncertainty = np.array(kfac_entropy_lst)
 print(f"KFAC Accuracy: {100 * np.mean(np.argmax(kfac_prediction.cpu().detach().numpy(), axis=1) == targets.numpy()):.2f}%")
 print(f"Mean KFAC Entropy:{np.mean(kfac_uncertainty)}%")
 # kfac entropy: -1.7657 bits
 
 # noise image
 res_entropy_lst = []
-for i in tqdm(range(10000)):
-    noise = torch.randn_like(images)
-    pred_mean = torch.nn.functional.softmax(net(noise.to(device)) ,dim=1)        
+for noise in tqdm(torch.randn(len(test_set), *images.shape[1:]).split(test_loader.batch_size)):
+    pred_mean, J = jacobian(noise.to(device), transform=softmax, argmax=True)
     # compute prediction variance  
-    pred_std = 0
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs = torch.zeros_like(pred_mean)
-    grad_outputs[:,idx] = 1
-    for layer in list(estimator.model.modules())[1:]:
-        g = []
-        if layer in estimator.state:
-            Q_i = estimator.inv_state[layer][0]
-            H_i = estimator.inv_state[layer][1] 
-            for p in layer.parameters():    
-                g.append(torch.flatten(gradient(pred_mean, p, grad_outputs=grad_outputs)))
-            J_i = torch.cat(g, dim=0).unsqueeze(0) 
-            H = torch.kron(Q_i,H_i)
-            pred_std += torch.abs(J_i @ H @ J_i.t()).item()
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
-    res_entropy_lst.append(entropy) 
-    res_uncertainty = np.array(res_entropy_lst)
+    pred_std = torch.abs(estimator.predictive_variance(J).squeeze(1))
+    entropy = 0.5 * np.log2(const * pred_std.cpu().numpy())
+    res_entropy_lst.extend(entropy) 
+res_uncertainty = np.array(res_entropy_lst)
 print(f"Mean Noise Entropy:{np.mean(res_uncertainty)}%")
-# noise entropy: 1.8006 bits
+# noise entropy: 1.8006 bits
\ No newline at end of file
@@ -29,10 +29,12 @@ from torchvision import transforms, datasets
 from torch.utils.data import DataLoader
 
 # From the repository
-from models.curvatures import BlockDiagonal, KFAC, EFB, INF
+from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF, DenseCurvature, subnetwork
 from models.utilities import *
 from models.plot import *
 from models.wrapper import *
+from models.jacobians import Jacobian
+from models import predictive, parallel
 
 # file path
 parent = os.path.dirname(os.path.dirname(current))
@@ -85,28 +87,21 @@ sgd_predictions, sgd_labels = eval(net, device, test_loader)
 acc = accuracy(sgd_predictions, sgd_labels)
 
 # update likelihood FIM
-H = None
+# per-example gradients of the sampled labels give the Monte Carlo Fisher
+dense = DenseCurvature(net, per_sample=True)
 for images, labels in tqdm(train_loader):
     logits = net(images.to(device))
     dist = torch.distributions.Categorical(logits=logits)
     labels = dist.sample()
     loss = criterion(logits, labels)
-    net.zero_grad()
+    net.zero_grad(set_to_none=False)
     loss.backward()
-    grads = []
-    for layer in list(net.modules())[1:]:
-        for p in layer.parameters():    
-            J_p = torch.flatten(p.grad.view(-1)).unsqueeze(0)
-            grads.append(J_p)
-    J_loss = torch.cat(grads, dim=1)
-    H_loss = J_loss.t() @ J_loss
-    H_loss.requires_grad = False
-    H = H_loss if H == None else H + H_loss
+    dense.update(batch_size=images.size(0))
+dense.remove()
          
-H = H.cpu()/len(train_loader) 
-
-diag = torch.diag((std**2) * torch.ones(H.shape[0]))
-H_inv = torch.pinverse(H + diag)
+# posterior precision: H / len(train_set) + std^2 * I
+estimator = dense
+estimator.invert(std**2, 1 / len(train_set))
 
 '''
 H_diag = torch.diag(H)
@@ -141,27 +136,21 @@ H_inv_diag_norm = torch.load(result_path+'tensor/H_inv_diag_norm_15k.pt')
 '''
 
 # test image
+jacobian = Jacobian(net)
+softmax = lambda logits: F.softmax(logits, dim=1)
+const = 2*np.e*np.pi
 targets = torch.Tensor()
 dense_prediction = torch.Tensor().to(device)
 dense_entropy_lst  = []
 #mean_predictions, labels = net.eval(test_loader)
 for images,labels in tqdm(test_loader):
-    # prediction mean, equals to the MAP output 
-    pred_mean = torch.nn.functional.softmax(net(images.to(device)) ,dim=1)        
-    # compute prediction variance  
-    pred_std = 0
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs = torch.zeros_like(pred_mean)
-    grad_outputs[:,idx] = 1
-    g = []
-    for p in net.parameters():    
-        g.append(torch.flatten(utils.gradient(pred_mean, p, grad_outputs=grad_outputs)))
-    J = torch.cat(g, dim=0).unsqueeze(0).cpu()
-    pred_std = torch.abs(J @ H_inv @ J.t()).item()
+    # prediction mean, equals to the MAP output; Jacobian of the predicted class probability
+    pred_mean, J = jacobian(images.to(device), transform=softmax, argmax=True)
+    # compute prediction variance
+    pred_std = torch.abs(estimator.predictive_variance(J).squeeze(1)).cpu()
     # uncertainty
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
-    dense_entropy_lst.append(entropy) 
+    entropy = 0.5 * np.log2(const * pred_std.numpy())
+    dense_entropy_lst.extend(entropy)
     # ground truth
     targets = torch.cat([targets, labels])  
     # prediction, mean value of the gaussian distribution
@@ -170,24 +159,52 @@ dense_uncertainty = np.array(dense_entropy_lst)
 print(f"Dense Accuracy: {100 * np.mean(np.argmax(dense_prediction.cpu().detach().numpy(), axis=1) == targets.numpy()):.2f}%")
 print(f"Mean Dense Entropy:{np.mean(dense_uncertainty)}%")
 
+# linearized predictive over all classes: the probit approximation of the expected softmax replaces the MAP softmax
+glm_prediction, glm_labels = predictive.predict_glm(estimator, test_loader, link='probit', device=device)
+ece_map = expected_calibration_error(sgd_predictions.cpu().numpy(), sgd_labels.numpy())[0]
+ece_glm = expected_calibration_error(glm_prediction.cpu().numpy(), glm_labels.numpy())[0]
+print(f"GLM Accuracy: {100 * np.mean(np.argmax(glm_prediction.cpu().numpy(), axis=1) == glm_labels.numpy()):.2f}%")
+print(f"ECE MAP: {100 * ece_map:.2f}%, ECE GLM: {100 * ece_glm:.2f}%")
+
+# last-layer Laplace: features are computed once, curvature and predictive only involve the last layer
+name = last_layer(net)
+layer = dict(net.named_modules())[name]
+ll_dense = DenseCurvature(net, layer_names=name)
+train_features, _ = predictive.cache_features(net, layer, train_loader, device)
+predictive.fit_features(ll_dense, layer, train_features, batch_size=32)
+ll_dense.remove()
+ll_dense.invert(std**2, 1 / len(train_set))
+test_features, test_labels = predictive.cache_features(net, layer, test_loader, device)
+ll_prediction = predictive.last_layer_predictive(ll_dense, layer, test_features, link='probit')[0]
+ece_ll = expected_calibration_error(ll_prediction.cpu().numpy(), test_labels.numpy())[0]
+print(f"Last-Layer Accuracy: {100 * np.mean(np.argmax(ll_prediction.cpu().numpy(), axis=1) == test_labels.numpy()):.2f}%")
+print(f"ECE Last-Layer: {100 * ece_ll:.2f}%")
+
+# subnetwork Laplace: dense over the 2000 parameters with the largest diagonal posterior variance, the rest at the MAP
+diagonal = Diagonal(net)
+for images, labels in tqdm(train_loader):
+    parallel.mc_fisher_step(diagonal, images.to(device), labels)
+diagonal.remove()
+diagonal.invert(std**2, 1 / len(train_set))
+sub_dense = DenseCurvature(net, per_sample=True, subset=subnetwork(diagonal, 2000))
+for images, labels in tqdm(train_loader):
+    parallel.mc_fisher_step(sub_dense, images.to(device), labels)
+sub_dense.remove()
+sub_dense.invert(std**2, 1 / len(train_set))
+sub_prediction, sub_labels = predictive.predict_glm(sub_dense, test_loader, link='probit', device=device)
+ece_sub = expected_calibration_error(sub_prediction.cpu().numpy(), sub_labels.numpy())[0]
+print(f"Subnetwork Accuracy: {100 * np.mean(np.argmax(sub_prediction.cpu().numpy(), axis=1) == sub_labels.numpy()):.2f}%")
+print(f"ECE Subnetwork: {100 * ece_sub:.2f}%")
+
  # noise image
 res_entropy_lst = []
-for i in tqdm(range(10000)):
-    noise = torch.randn_like(images)
-    pred_mean = torch.nn.functional.softmax(net(noise.to(device)) ,dim=1)        
-    # compute prediction variance  
-    pred_std = 0
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs = torch.zeros_like(pred_mean)
-    grad_outputs[:,idx] = 1
-    g = []
-    for p in net.parameters():    
-        g.append(torch.flatten(gradient(pred_mean, p, grad_outputs=grad_outputs)))
-    J = torch.cat(g, dim=0).unsqueeze(0).cpu()
-    pred_std = torch.abs(J @ H @ J.t()).item()
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
-    res_entropy_lst.append(entropy) 
-    res_uncertainty = np.array(res_entropy_lst)
+for noise in tqdm(torch.randn(len(test_set), *images.shape[1:]).split(test_loader.batch_size)):
+    pred_mean, J = jacobian(noise.to(device), transform=softmax, argmax=True)
+    # compute prediction variance
+    pred_std = torch.abs(estimator.predictive_variance(J).squeeze(1)).cpu()
+    entropy = 0.5 * np.log2(const * pred_std.numpy())
+    res_entropy_lst.extend(entropy)
+jacobian.remove()
+res_uncertainty = np.array(res_entropy_lst)
 print(f"Mean Noise Entropy:{np.mean(res_uncertainty)}%")
 # noise entropy: 1.8006 bits
\ No newline at end of file
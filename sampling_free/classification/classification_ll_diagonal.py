@@ -33,6 +33,7 @@ from models.curvatures import Diagonal, BlockDiagonal, KFAC, EFB, INF
 from models.utilities import *
 from models.plot import *
 from models.wrapper import *
+from models.jacobians import Jacobian
 
     
 # file path
@@ -105,59 +106,36 @@ for images, labels in tqdm(train_loader):
 estimator = diag
 estimator.invert(std**2, N)
 
-h = []
-for i,layer in enumerate(list(estimator.model.modules())[1:]):
-    if layer in estimator.state:
-        H_i = estimator.inv_state[layer]
-        h.append(torch.flatten(H_i))
-H = torch.cat(h, dim=0)
-H_inv = torch.diag(H).cpu()
-
+jacobian = Jacobian(net)
+softmax = lambda logits: F.softmax(logits, dim=1)
+const = 2*np.e*np.pi
 targets = torch.Tensor()
 diag_prediction = torch.Tensor().to(device)
 diag_entropy_lst = []
 
 for images,labels in tqdm(test_loader):
-    # prediction mean, equals to the MAP output 
-    pred_mean = torch.nn.functional.softmax(net(images.to(device)) ,dim=1)        
+    # prediction mean, equals to the MAP output; Jacobian of the predicted class probability
+    pred_mean, J = jacobian(images.to(device), transform=softmax, argmax=True)
     # compute prediction variance  
-    grad_outputs = torch.zeros_like(pred_mean)
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs[:,idx] = 1
-    g = []
-    for p in net.parameters():    
-        g.append(torch.flatten(utils.gradient(pred_mean, p, grad_outputs=grad_outputs)))
-    J = torch.cat(g, dim=0).unsqueeze(0).cpu()
-    pred_std = torch.abs(J * H_inv * J).sum().item()
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
+    pred_std = estimator.predictive_variance(J).squeeze(1).cpu()
+    entropy = 0.5 * np.log2(const * pred_std.numpy())
     # ground truth
     targets = torch.cat([targets, labels])  
     # prediction, mean value of the gaussian distribution
     diag_prediction = torch.cat([diag_prediction, pred_mean]) 
-    diag_entropy_lst.append(entropy)
+    diag_entropy_lst.extend(entropy)
 diag_uncertainty = np.array(diag_entropy_lst)
 print(f"Diagonal Accuracy: {100 * np.mean(np.argmax(diag_prediction.cpu().detach().numpy(), axis=1) == targets.numpy()):.2f}%")
 print(f"Mean Diagonal Entropy: {diag_uncertainty.mean()}")
 # kfac entropy: -0.64
 
 res_entropy_lst = []
-for i in tqdm(range(10000)):
-    noise = torch.randn_like(images)
-    pred_mean = torch.nn.functional.softmax(net(noise.to(device)) ,dim=1)        
+for noise in tqdm(torch.randn(len(test_set), *images.shape[1:]).split(test_loader.batch_size)):
+    pred_mean, J = jacobian(noise.to(device), transform=softmax, argmax=True)
     # compute prediction variance  
-    grad_outputs = torch.zeros_like(pred_mean)
-    idx  = np.argmax(pred_mean.cpu().detach().numpy(), axis=1)
-    grad_outputs[:,idx] = 1
-    g = []
-    for p in net.parameters():    
-        g.append(torch.flatten(gradient(pred_mean, p, grad_outputs=grad_outputs)))
-    J = torch.cat(g, dim=0).unsqueeze(0)
-    pred_std = torch.abs(J * H_inv * J).sum().item()
-    del J
-    const = 2*np.e*np.pi 
-    entropy = 0.5 * np.log2(const * pred_std)
-    res_entropy_lst.append(entropy) 
-    res_uncertainty = np.array(res_entropy_lst)
+    pred_std = estimator.predictive_variance(J).squeeze(1).cpu()
+    entropy = 0.5 * np.log2(const * pred_std.numpy())
+    res_entropy_lst.extend(entropy) 
+res_uncertainty = np.array(res_entropy_lst)
 print(f"Mean Noise Entropy: {res_uncertainty.mean()}")
 # noise entropy: 2.86
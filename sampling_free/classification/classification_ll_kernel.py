@@ -29,7 +29,7 @@ from torchvision import transforms, datasets
 from torch.utils.data import DataLoader
 
 # From the repository
-from models.curvatures import BlockDiagonal, KFAC, EFB, INF
+from models.curvatures import BlockDiagonal, KFAC, EFB, INF, DenseCurvature
 from models.utilities import *
 from models.plot import *
 from models.wrapper import *
@@ -87,25 +87,17 @@ sgd_predictions, sgd_labels = eval(net, device, test_loader)
 acc = accuracy(sgd_predictions, sgd_labels)
 
 # update likelihood FIM
-H = None
+dense = DenseCurvature(net)
 for images, labels in tqdm(train_loader):
     logits = net(images.to(device))
     dist = torch.distributions.Categorical(logits=logits)
     labels = dist.sample()
     loss = criterion(logits, labels)
-    net.zero_grad()
+    net.zero_grad(set_to_none=False)
     loss.backward()
-    grads = []
-    for layer in list(net.modules())[1:]:
-        for p in layer.parameters():    
-            J_p = torch.flatten(p.grad.view(-1)).unsqueeze(0)
-            grads.append(J_p)
-    J_loss = torch.cat(grads, dim=1)
-    H_loss = J_loss.t() @ J_loss
-    H_loss.requires_grad = False
-    H = H_loss if H == None else H + H_loss
+    dense.update(batch_size=images.size(0))
             
-H = H.cpu()/len(train_loader) 
+H = dense.matrix().float().cpu() / len(train_set)
 
 orig,   orig_inv    = utils.generate_H(H, tau)
 kernel, kernel_inv  = utils.generate_kernel_diag_748(H, tau)
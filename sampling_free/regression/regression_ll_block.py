@@ -17,6 +17,7 @@ import numpy as np
 
 # From the repository
 from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF
+from models.jacobians import Jacobian
 from sampling_free import utils
 
 # define a network
@@ -54,27 +55,6 @@ class Net(torch.nn.Module):
 def get_nb_parameters(model):
     print('Total params: %.2f' % (np.sum(p.numel() for p in model.parameters())))
 
-# backward Jacobian: derivative of outputs with respect to weights
-def gradient(y, x, grad_outputs=None):
-    """Compute dy/dx @ grad_outputs"""
-    if grad_outputs is None:
-        grad_outputs = torch.ones_like(y)
-    grad = torch.autograd.grad(y, [x], grad_outputs = grad_outputs, create_graph=True, retain_graph=True, allow_unused=True)[0]
-    return grad
-
-def jacobian(y, x):
-    '''
-    Compute dy/dx = dy/dx @ grad_outputs; 
-    y: output, batch_size * class_number
-    x: parameter
-    '''
-    jac = torch.zeros(y.shape[0], torch.flatten(x).shape[0])
-    for i in range(y.shape[0]):
-        grad_outputs = torch.zeros_like(y)
-        grad_outputs[i] = 1
-        jac[i,:] = torch.flatten(gradient(y, x, grad_outputs))
-    return jac
-
 # file path
 parent = os.path.dirname(os.path.dirname(current))
 data_path = parent + "/data/"
@@ -109,35 +89,17 @@ for t in range(10000):
     optimizer.step()        # apply gradients  
     kfac.update(batch_size=1)
 
+# N * (Q + tau * I) and N * (H + tau * I) for each Kronecker factor
 estimator = kfac
-#estimator.invert(std**2, N)
+estimator.invert((N * tau) ** 2, N ** 2)
 
 x_ = torch.unsqueeze(torch.linspace(-6, 6), dim=1)  # x data (tensor), shape=(100, 1)
 y_ = x_.pow(3)      
 x_ = Variable(x_)
 y_ = Variable(y_)
 
-std = []
-for j,x_j in enumerate(x_):
-    g = []
-    pred_j = net.forward(x_j)  
-    std_j = 0
-    for layer in list(estimator.model.modules())[1:]:
-        g = []
-        if layer in estimator.state:
-            q_i = estimator.state[layer][0]
-            h_i = estimator.state[layer][1] 
-            dq = torch.diag(tau * torch.ones(q_i.shape[0]))
-            dh = torch.diag(tau * torch.ones(h_i.shape[0]))
-            q_inv = torch.pinverse(N * (q_i+dq))
-            h_inv = torch.pinverse(N * (h_i+dh))
-            for p in layer.parameters():    
-                g.append(torch.flatten(jacobian(pred_j, p)))
-            J_i = torch.cat(g, dim=0).unsqueeze(0) 
-            H_inv = utils.kronecker_product(q_inv,h_inv)
-            #H_inv = torch.kron(q_inv,h_inv)
-            std_j += torch.abs(J_i @ H_inv @ J_i.t()).item()
-    std.append(std_j**0.5 + sigma)
+_, J = Jacobian(net)(x_)
+std = estimator.predictive_variance(J).squeeze(1).abs() ** 0.5 + sigma
 
 
 pred_mean = net.forward(x_).data.numpy().squeeze(1)
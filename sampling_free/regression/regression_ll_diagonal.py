@@ -12,6 +12,7 @@ sys.path.append(parent)
 from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF
 from models.utilities import calibration_curve
 from models import plot
+from models.jacobians import Jacobian
 
 
 import torch
@@ -60,27 +61,6 @@ class Net(torch.nn.Module):
 def get_nb_parameters(model):
     print('Total params: %.2f' % (np.sum(p.numel() for p in model.parameters())))
 
-# backward Jacobian: derivative of outputs with respect to weights
-def gradient(y, x, grad_outputs=None):
-    """Compute dy/dx @ grad_outputs"""
-    if grad_outputs is None:
-        grad_outputs = torch.ones_like(y)
-    grad = torch.autograd.grad(y, [x], grad_outputs = grad_outputs, create_graph=True, retain_graph=True, allow_unused=True)[0]
-    return grad
-
-def jacobian(y, x):
-    '''
-    Compute dy/dx = dy/dx @ grad_outputs; 
-    y: output, batch_size * class_number
-    x: parameter
-    '''
-    jac = torch.zeros(y.shape[0], torch.flatten(x).shape[0])
-    for i in range(y.shape[0]):
-        grad_outputs = torch.zeros_like(y)
-        grad_outputs[i] = 1
-        jac[i,:] = torch.flatten(gradient(y, x, grad_outputs))
-    return jac
-
 # file path
 data_path = parent + "/data/"
 model_path = parent + "/theta/"
@@ -117,26 +97,13 @@ std = 0.1
 estimator = diag
 estimator.invert(0, N)
 
-h = []
-for i,layer in enumerate(list(estimator.model.modules())[1:]):
-    if layer in estimator.state:
-        H_i = estimator.inv_state[layer]
-        h.append(torch.flatten(H_i))
-H_inv = torch.cat(h, dim=0).unsqueeze(0)
-
 x_ = torch.unsqueeze(torch.linspace(-6, 6), dim=1)  # x data (tensor), shape=(100, 1)
 y_ = x_.pow(3)      
 x_ = Variable(x_)
 y_ = Variable(y_)
 
-std = []
-for j,x_j in enumerate(x_):
-    g = []
-    pred_j = net.forward(x_j)  
-    for p in net.parameters():    
-        g.append(torch.flatten(jacobian(pred_j, p)))
-    J = torch.cat(g, dim=0).unsqueeze(0)  #shape (64, 32*in_channels, 224, 224)
-    std.append(torch.abs(J * H_inv * J).sum() ** 0.5 + sigma)
+_, J = Jacobian(net)(x_)
+std = estimator.predictive_variance(J).squeeze(1) ** 0.5 + sigma
 
 
 pred_mean = net.forward(x_).data.numpy().squeeze(1)
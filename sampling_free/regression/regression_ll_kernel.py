@@ -9,9 +9,10 @@ sys.path.append(parent)
 
 
 # From the repository
-from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF
+from models.curvatures import BlockDiagonal, Diagonal, KFAC, EFB, INF, KernelBlockDiagonal
 from models.utilities import calibration_curve
 from models import plot
+from models.jacobians import Jacobian
 
 
 import torch
@@ -65,27 +66,6 @@ class Net(torch.nn.Module):
 def get_nb_parameters(model):
     print('Total params: %.2f' % (np.sum(p.numel() for p in model.parameters())))
 
-# backward Jacobian: derivative of outputs with respect to weights
-def gradient(y, x, grad_outputs=None):
-    """Compute dy/dx @ grad_outputs"""
-    if grad_outputs is None:
-        grad_outputs = torch.ones_like(y)
-    grad = torch.autograd.grad(y, [x], grad_outputs = grad_outputs, create_graph=True, retain_graph=True, allow_unused=True)[0]
-    return grad
-
-def jacobian(y, x):
-    '''
-    Compute dy/dx = dy/dx @ grad_outputs; 
-    y: output, batch_size * class_number
-    x: parameter
-    '''
-    jac = torch.zeros(y.shape[0], torch.flatten(x).shape[0])
-    for i in range(y.shape[0]):
-        grad_outputs = torch.zeros_like(y)
-        grad_outputs[i] = 1
-        jac[i,:] = torch.flatten(gradient(y, x, grad_outputs))
-    return jac
-
 # file path
 parent = os.path.dirname(os.path.dirname(current))
 data_path = parent + "/data/"
@@ -111,27 +91,19 @@ loss_func = torch.nn.MSELoss()  # this is for regression mean squared loss
 
 
 # update likelihood FIM
-H = None
+kernel = KernelBlockDiagonal(net)
 for t in range(10000):
     prediction = net.forward(x)     # input x and predict based on x
     loss = loss_func(prediction, y)     # must be (1. nn output, 2. target)
     optimizer.zero_grad()   # clear gradients for next train
     loss.backward()         # backpropagation, compute gradients
     optimizer.step()        # apply gradients  
-    grads = []
-    for layer in list(net.modules())[1:]:
-        for p in layer.parameters():    
-            J_p = torch.flatten(p.grad.view(-1)).unsqueeze(0)
-            grads.append(J_p)
-    J_loss = torch.cat(grads, dim=1)
-    H_loss = J_loss.t() @ J_loss
-    H_loss.requires_grad = False
-    H = H_loss if H == None else H + H_loss
-H = H/10000
-
-# get inversion of H
+    kernel.update(batch_size=1)
+
+# get inversion of N * (H / 10000 + std^2 * I), block by block
 std = 0.1
-kernel, kernel_inv  = utils.generate_kernel_diag(H, std ** 2, N, 30)
+estimator = kernel
+estimator.invert(N * std**2, N / 10000)
 
 # make new prediction
 x_ = torch.unsqueeze(torch.linspace(-6, 6), dim=1)  # x data (tensor), shape=(100, 1)
@@ -139,14 +111,8 @@ y_ = x_.pow(3)
 x_ = Variable(x_)
 y_ = Variable(y_)
 
-std = []
-for j,x_j in enumerate(x_):
-    g = []
-    pred_j = net.forward(x_j)  
-    for p in net.parameters():    
-        g.append(torch.flatten(jacobian(pred_j, p)))
-    J = torch.cat(g, dim=0).unsqueeze(0) 
-    std.append(torch.abs(J @ kernel_inv @ J.t()) ** 0.5 + sigma)
+_, J = Jacobian(net)(x_)
+std = torch.abs(estimator.predictive_variance(J).squeeze(1)) ** 0.5 + sigma
 
 
 pred_mean = net.forward(x_).data.numpy().squeeze(1)
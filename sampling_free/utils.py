@@ -3,13 +3,17 @@ from matplotlib import pyplot as plt
 from PIL import Image, ImageOps  
 import numpy as np
 
+from models.utilities import kernel_coords
+from models.curvatures import damped_cholesky
+from models.storage import abs_sum
+
 def calculate_dominance(H, tau = 0.00001):
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * tau
+    # H is a tensor or a HessianStore, which is read tile by tile
     # coords = generate_kernel_coords_15k()
 
-    sum_diag = torch.diag(reg).abs().sum().item()
-    sum_all  = reg.abs().sum().item()
+    diag = H.diagonal()
+    sum_diag = (diag + tau).abs().sum().item()
+    sum_all  = abs_sum(H) - diag.abs().sum().item() + sum_diag
     # sum_block=0
     # for (a,b) in coords:
     #     sum_block += reg[a:b,a:b].abs().sum().item()
@@ -21,16 +25,17 @@ def calculate_dominance(H, tau = 0.00001):
     return sum_diag/sum_all
 
 def calculateEigval(H, regParam = 0.00001):
-    if H.numel() != 15080 ** 2:
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    reg = H + diag * regParam
+    # only the leading 1000 x 1000 block is read
+    reg = H[:1000,:1000].clone()
+    reg.diagonal().add_(regParam)
     # coords = generate_kernel_coords()
 
     try:
-        eig = torch.eig(reg[:1000,:1000])[0].cpu()
+        eig = torch.eig(reg)[0].cpu()
     except:
-        eig = torch.linalg.eigvals(reg[:1000,:1000])[0].cpu()
+        eig = torch.linalg.eigvals(reg)[0].cpu()
 
     if eig[:,1].abs().max() > 1e-30:
         raise ValueError('The eigenvalues of the matrix contain imaginary parts')
@@ -60,7 +65,38 @@ def generate_H_true(H, tau = 0):
         raise ValueError('H + tau*eye not invertible!')
     return H + diag, H_inv
 
-def generate_kernel_diag_15080(H, tau = 0):
+def invert_kernel_blocks(H, coords, tau = 0, n = 1, dense = True):
+    # blocks of equal size are gathered into one (k, size, size) batch and inverted with a single batched cholesky,
+    # the store maps each block size to the start indices and the (regularized) blocks and their inverses
+    groups = {}
+    for (a,b) in coords:
+        groups.setdefault(b - a, []).append(a)
+    # H is a tensor or a HessianStore, of which only the tiles overlapping the blocks are read
+    store = {}
+    for size, starts in groups.items():
+        blocks = torch.stack([H[a:a+size,a:a+size] for a in starts])
+        starts = torch.tensor(starts, device=blocks.device)
+        blocks.diagonal(dim1=-2, dim2=-1).add_(tau)
+        eye = torch.eye(size, dtype=H.dtype, device=H.device).expand_as(blocks)
+        inverse = torch.cholesky_solve(eye, damped_cholesky(n * blocks))
+        store[size] = (starts, blocks, inverse)
+    if not dense:
+        return store
+    return kernel_dense(store, H.shape[0])
+
+def kernel_dense(store, P):
+    # dense (P, P) views of the regularized kernel blocks and of their inverses
+    res, res_inv = None, None
+    for size, (starts, blocks, inverse) in store.items():
+        if res is None:
+            res = blocks.new_zeros(P, P)
+            res_inv = inverse.new_zeros(P, P)
+        idx = starts.unsqueeze(1) + torch.arange(size, device=starts.device)
+        res[idx.unsqueeze(2), idx.unsqueeze(1)] = blocks
+        res_inv[idx.unsqueeze(2), idx.unsqueeze(1)] = inverse
+    return res, res_inv
+
+def generate_kernel_diag_15080(H, tau = 0, dense = True):
 
     def generate_kernel_coords_15k():
         # 15080
@@ -92,17 +128,11 @@ def generate_kernel_diag_15080(H, tau = 0):
 
         return coords
 
-    if H.numel() != 15080 ** 2:
+    if H.shape[0] != 15080:
         raise NotImplementedError
-    res = torch.zeros_like(H)
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    H += diag * tau
-    for (a,b) in generate_kernel_coords_15k():
-        res[a:b,a:b] = H[a:b,a:b]
-
-    return res, torch.inverse(res)
+    return invert_kernel_blocks(H, generate_kernel_coords_15k(), tau, dense=dense)
 
-def generate_kernel_diag_748(H, tau = 0):
+def generate_kernel_diag_748(H, tau = 0, dense = True):
 
     def generate_kernel_coords_748():
 
@@ -130,17 +160,11 @@ def generate_kernel_diag_748(H, tau = 0):
 
 
 
-    if H.numel() != 748 ** 2:
+    if H.shape[0] != 748:
         raise NotImplementedError
-    res = torch.zeros_like(H)
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    H += diag * tau
-    for (a,b) in generate_kernel_coords_748():
-        res[a:b,a:b] = H[a:b,a:b]
-
-    return res, torch.inverse(res)
+    return invert_kernel_blocks(H, generate_kernel_coords_748(), tau, dense=dense)
 
-def generate_kernel_diag_141(H, tau = 0, n = 1):
+def generate_kernel_diag_141(H, tau = 0, n = 1, dense = True):
 
     def generate_kernel_coords_141():
 
@@ -166,49 +190,16 @@ def generate_kernel_diag_141(H, tau = 0, n = 1):
 
         return coords
 
-    if H.numel() != 141 ** 2:
+    if H.shape[0] != 141:
         raise NotImplementedError
-    res = torch.zeros_like(H)
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    H += diag * tau
-    for (a,b) in generate_kernel_coords_141():
-        res[a:b,a:b] = H[a:b,a:b]
-
-    return res, torch.inverse(n*res)
-
-def generate_kernel_diag(H, tau = 0, n = 1, n_hid = 1):
+    return invert_kernel_blocks(H, generate_kernel_coords_141(), tau, n, dense=dense)
 
-    def generate_kernel_coords():
-
-        coords = []
-        curr = 0
-
-        for _ in range(n_hid):
-            coords.append((curr,curr+n_hid))
-            curr += 1
-        coords.append((curr,curr+n_hid))
-        curr += n_hid
-
-        for _ in range(n_hid):
-            coords.append((curr,curr+n_hid))
-            curr += n_hid
-        coords.append((curr,curr+n_hid))
-        curr += n_hid
-
-        for _ in range(1):
-            coords.append((curr,curr+n_hid))
-            curr += n_hid
-        coords.append((curr,curr+1))
-
-        return coords
-
-    res = torch.zeros_like(H)
-    diag = torch.diag(H.new(H.shape[0]).fill_(1))
-    H += diag * tau
-    for (a,b) in generate_kernel_coords():
-        res[a:b,a:b] = H[a:b,a:b]
-
-    return res, torch.inverse(n*res)
+def generate_kernel_diag(H, model, tau = 0, n = 1, dense = True):
+    # kernel blocks derived from the Linear/Conv2d modules of the model
+    coords = kernel_coords(model)
+    if coords[-1][1] != H.shape[0]:
+        raise NotImplementedError
+    return invert_kernel_blocks(H, coords, tau, n, dense=dense)
 
 
 
@@ -263,11 +254,14 @@ def plot_lambda(H, lambdas):
     def calculateDiff(a,b):
         return (b-a).abs().sum() / b.abs().sum()
 
+    # a single eigendecomposition, (H + v * I)^-1 = U diag(1 / (eig + v)) U^T for all v
+    eig, U = torch.linalg.eigh(H)
+    diag = torch.diag(H)
     val = []
     idx = []
     for v in lambdas:
-        a,b = generate_H_true(H,v)
-        c,d = generate_diag(H,v)
+        b = (U / (eig + v)) @ U.t()
+        d = torch.diag(torch.reciprocal(diag + v))
         val.append(calculateDiff(b,d))
         idx.append(v)
 
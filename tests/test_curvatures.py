@@ -0,0 +1,346 @@
+"""Equivalence tests of the curvature algebra against the explicit (Kronecker or dense) formulations."""
+
+import copy
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from models.curvatures import INF, PackedCholesky, Diagonal, BlockDiagonal, KernelBlockDiagonal, KFAC, EFB, \
+    DenseCurvature, LowRankDiagonal
+from models.utilities import pack
+
+
+def _orthonormal(rows: int,
+                 cols: int) -> torch.Tensor:
+    return torch.linalg.qr(torch.randn(rows, rows, dtype=torch.float64))[0][:, :cols]
+
+
+def _inf_factors(n: int = 6,
+                 m: int = 5,
+                 r_a: int = 3,
+                 r_g: int = 4):
+    torch.manual_seed(0)
+    frst_eigvecs = _orthonormal(n, r_a)
+    scnd_eigvecs = _orthonormal(m, r_g)
+    reg_lambda = torch.rand(r_a * r_g, dtype=torch.float64) + 0.5
+    reg_inv_correction = torch.rand(n * m, dtype=torch.float64) + 0.5
+    return frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction
+
+
+def _kron_pre_sampler(frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction):
+    """The pre-sampler formed from the explicit Kronecker product, as in the original implementation."""
+    scale_sqrt = torch.diag(reg_lambda)
+    eye = torch.eye(scale_sqrt.shape[0], dtype=torch.float64)
+    V_s = reg_inv_correction.view(-1, 1) * torch.kron(frst_eigvecs, scnd_eigvecs) @ scale_sqrt
+    vtv = V_s.t() @ V_s
+    vtv = (vtv + vtv.t()) / 2.
+    A_c_inv = torch.linalg.cholesky(vtv).inverse()
+    B_c = torch.linalg.cholesky(vtv + eye)
+    C = A_c_inv.t() @ (B_c - eye) @ A_c_inv
+    L_c = (C.inverse() + vtv).inverse()
+    return scale_sqrt @ L_c @ scale_sqrt
+
+
+def test_pre_sampler_matches_kron():
+    factors = _inf_factors()
+    expected = _kron_pre_sampler(*factors)
+    assert torch.allclose(INF.pre_sampler(*factors), expected, rtol=1e-8, atol=1e-10)
+
+
+def test_pre_sampler_matches_kron_single_chunk():
+    factors = _inf_factors(n=2, m=3, r_a=2, r_g=3)
+    expected = _kron_pre_sampler(*factors)
+    assert torch.allclose(INF.pre_sampler(*factors), expected, rtol=1e-8, atol=1e-10)
+
+
+def _loop_dim_reduction(frst_eigvecs, scnd_eigvecs, lambda_vec, rank):
+    """The original loop over the `rank` largest eigenvalues with one-based flat indices."""
+    if rank >= lambda_vec.shape[0]:
+        return frst_eigvecs, scnd_eigvecs, lambda_vec
+    m = scnd_eigvecs.shape[1]
+    idx_top_l = (torch.argsort(-torch.abs(lambda_vec)) + 1)[0:rank]
+    idx_left, idx_right = list(), list()
+    for z in range(rank):
+        i = int((idx_top_l[z] - 1.) / m + 1.)
+        idx_left.append(i)
+        idx_right.append(idx_top_l[z] - (m * (i - 1)))
+    idx_left = torch.unique(torch.tensor(idx_left))
+    idx_right = torch.unique(torch.tensor(idx_right))
+    idx_top_lm = [m * (left - 1) + right for left in idx_left for right in idx_right]
+    return (frst_eigvecs[:, [idx - 1 for idx in idx_left]], scnd_eigvecs[:, [idx - 1 for idx in idx_right]],
+            lambda_vec[[idx - 1 for idx in idx_top_lm]])
+
+
+def _loop_diagonal_accumulator(xxt_eigvecs, ggt_eigvecs, lambda_vec):
+    """The original loop forming one row of the Kronecker product at a time."""
+    n, m = xxt_eigvecs.shape[0], ggt_eigvecs.shape[0]
+    diag_vec = torch.zeros(n * m, dtype=lambda_vec.dtype)
+    for i in range(n):
+        diag_vec[i * m:(i + 1) * m] = (torch.kron(xxt_eigvecs[i, :].unsqueeze(0), ggt_eigvecs) ** 2) @ lambda_vec
+    return diag_vec
+
+
+def test_dim_reduction_matches_loop():
+    torch.manual_seed(3)
+    frst_eigvecs, scnd_eigvecs = _orthonormal(6, 6), _orthonormal(5, 5)
+    lambda_vec = torch.randn(30, dtype=torch.float64)
+    for rank in [1, 4, 7, 29, 30, 100]:
+        reduced = INF._dim_reduction(frst_eigvecs, scnd_eigvecs, lambda_vec, rank)
+        expected = _loop_dim_reduction(frst_eigvecs, scnd_eigvecs, lambda_vec, rank)
+        for value, reference in zip(reduced, expected):
+            assert torch.equal(value, reference)
+
+
+def test_diagonal_accumulator_matches_loop_and_kron():
+    frst_eigvecs, scnd_eigvecs, reg_lambda, _ = _inf_factors()
+    diagonal = INF._diagonal_accumulator(frst_eigvecs, scnd_eigvecs, reg_lambda)
+    assert torch.allclose(diagonal, _loop_diagonal_accumulator(frst_eigvecs, scnd_eigvecs, reg_lambda))
+    V = torch.kron(frst_eigvecs, scnd_eigvecs)
+    assert torch.allclose(diagonal, (V @ torch.diag(reg_lambda) @ V.t()).diagonal())
+
+
+def _inf_square_root(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample):
+    """The explicit linear map L = C - C^2 V P V^T C, with V = U_A kron U_G, applied to standard normal noise."""
+    correction = torch.diag(reg_inv_correction)
+    V = torch.kron(frst_eigvecs, scnd_eigvecs)
+    return correction - correction ** 2 @ V @ pre_sample @ V.t() @ correction
+
+
+def test_sampler_matches_explicit_square_root():
+    frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction = _inf_factors()
+    pre_sample = INF.pre_sampler(frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction)
+    root = _inf_square_root(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample)
+
+    torch.manual_seed(1)
+    samples = INF.sampler(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample, samples=4)
+    torch.manual_seed(1)
+    X = torch.randn(4, root.shape[0], dtype=torch.float64)
+    assert samples.shape == X.shape
+    assert torch.allclose(samples, X @ root.t())
+
+    torch.manual_seed(2)
+    sample = INF.sampler(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample)
+    torch.manual_seed(2)
+    assert torch.allclose(sample, root @ torch.randn(1, root.shape[0], dtype=torch.float64)[0])
+
+
+def test_sampler_covariance_matches_sigma_product():
+    # A non-square layer with 6 inputs and 5 outputs
+    frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction = _inf_factors()
+    n, m = frst_eigvecs.shape[0], scnd_eigvecs.shape[0]
+    pre_sample = INF.pre_sampler(frst_eigvecs, scnd_eigvecs, reg_lambda, reg_inv_correction)
+    root = _inf_square_root(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample)
+
+    curvature = INF.__new__(INF)
+    curvature.inv_state = {'layer': (frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample)}
+    # The Jacobians of all n * m (in-major) coordinates, of shape (n * m, out, in)
+    basis = torch.eye(n * m, dtype=torch.float64).reshape(n * m, n, m).transpose(1, 2)
+    product = curvature._sigma_product('layer', basis).transpose(1, 2).reshape(n * m, n * m)
+    assert torch.allclose(product, root @ root.t())
+
+    torch.manual_seed(3)
+    samples = INF.sampler(frst_eigvecs, scnd_eigvecs, reg_inv_correction, pre_sample, samples=50000)
+    empirical = samples.t() @ samples / samples.shape[0]
+    assert torch.allclose(empirical, product, atol=0.05 * product.abs().max().item())
+
+
+def _spd(size: int) -> torch.Tensor:
+    torch.manual_seed(3)
+    matrix = torch.randn(size, size, dtype=torch.float64)
+    return matrix @ matrix.t() + size * torch.eye(size, dtype=torch.float64)
+
+
+def test_packed_cholesky_solve_matches_cholesky_solve():
+    matrix = _spd(13)
+    rhs = torch.randn(13, 3, dtype=torch.float64)
+    expected = torch.cholesky_solve(rhs, torch.linalg.cholesky(matrix))
+    for tile_size in [1, 4, 13, 32]:
+        factor = PackedCholesky(pack(matrix, tile_size), tile_size=tile_size)
+        assert torch.allclose(factor.solve(rhs), expected)
+
+
+def test_packed_cholesky_sample_matches_triangular_solve():
+    matrix = _spd(13)
+    rhs = torch.randn(13, 3, dtype=torch.float64)
+    upper = torch.linalg.cholesky(matrix).t()
+    expected = torch.triangular_solve(rhs, upper, upper=True)[0]
+    original = rhs.clone()
+    factor = PackedCholesky(pack(matrix, 5), tile_size=5)
+    assert torch.allclose(factor.sample(rhs), expected)
+    # The right-hand side is not overwritten
+    assert torch.equal(rhs, original)
+
+
+def _mlp() -> nn.Module:
+    torch.manual_seed(4)
+    return nn.Sequential(nn.Linear(5, 4), nn.ReLU(), nn.Linear(4, 3)).double()
+
+
+def _fit(curvature, model: nn.Module, batches: int = 6, seed: int = 5):
+    """Updates `curvature` with the gradients of random classification batches."""
+    torch.manual_seed(seed)
+    for _ in range(batches):
+        inputs = torch.randn(8, model[0].in_features, dtype=torch.float64)
+        labels = torch.randint(model[-1].out_features, (8,))
+        model.zero_grad(set_to_none=False)
+        F.cross_entropy(model(inputs), labels).backward()
+        curvature.update(batch_size=8)
+
+
+def _check_kernel_samples(curvature, layer):
+    """Compares the empirical covariance of each block of the samples of `layer` with the regularized inverse."""
+    weight_blocks, bias_block = curvature.state[layer]
+    samples = curvature.sample(layer, 20000)
+    assert samples.shape == (20000, 3, 5)
+    draws = [samples[:, index, :4] for index in range(3)] + [samples[..., -1]]
+    for block, draw in zip(list(weight_blocks) + [bias_block], draws):
+        expected = torch.inverse(10. * block + 0.5 * torch.eye(block.shape[0], dtype=torch.float64))
+        empirical = draw.t() @ draw / draw.shape[0]
+        assert torch.allclose(empirical, expected, atol=0.05 * expected.abs().max().item())
+
+
+def test_kernel_block_diagonal_eigen_path_matches_cholesky():
+    model = _mlp()
+    curvature = KernelBlockDiagonal(model, 'Linear')
+    _fit(curvature, model)
+    layer = model[2]
+    jacobians = {layer: torch.randn(7, 3, 3, 5, dtype=torch.float64)}
+
+    curvature.invert(0.5, 10.)
+    variance = curvature.predictive_variance(jacobians)
+    _check_kernel_samples(curvature, layer)
+
+    curvature.inv_state.clear()
+    curvature.eigendecompose()
+    curvature.invert(0.5, 10.)
+    assert isinstance(curvature.inv_state[layer][1], tuple)
+    assert torch.allclose(curvature.predictive_variance(jacobians), variance)
+    _check_kernel_samples(curvature, layer)
+
+
+def _assert_close(first, second):
+    if isinstance(first, dict):
+        assert first.keys() == second.keys()
+        for key in first:
+            _assert_close(first[key], second[key])
+    elif isinstance(first, (list, tuple)):
+        assert len(first) == len(second)
+        for a, b in zip(first, second):
+            _assert_close(a, b)
+    elif isinstance(first, torch.Tensor):
+        assert torch.allclose(first, second)
+    else:
+        assert first == second
+
+
+def _accumulated(curvature):
+    state_dict = curvature.state_dict()
+    return {attr: state_dict[attr] for attr in curvature._accumulators + ['samples']}
+
+
+def test_merge_and_load_state_dict_match_single_instance():
+    model = _mlp()
+    kfac = KFAC(model)
+    _fit(kfac, model)
+    factories = [lambda m: Diagonal(m),
+                 lambda m: BlockDiagonal(m),
+                 lambda m: BlockDiagonal(m, packed=True),
+                 lambda m: KernelBlockDiagonal(m),
+                 lambda m: KFAC(m),
+                 lambda m: KFAC(m).mixed_precision(torch.float32, 'kahan', reference=True),
+                 lambda m: EFB(m, kfac.state),
+                 lambda m: DenseCurvature(m, panel_size=4),
+                 lambda m: DenseCurvature(m, panel_size=4, packed=True)]
+    for factory in factories:
+        single, first, second = factory(model), factory(model), factory(model)
+        _fit(single, model, batches=3, seed=6)
+        _fit(single, model, batches=3, seed=7)
+        _fit(first, model, batches=3, seed=6)
+        _fit(second, model, batches=3, seed=7)
+        expected = _accumulated(single)
+
+        merged = factory(model)
+        merged.merge(first)
+        merged.merge(second.state_dict())
+        _assert_close(_accumulated(merged), expected)
+
+        # States are keyed by module names, s.t. they load into a copy of the model
+        copied = copy.deepcopy(model)
+        loaded = factory(copied)
+        loaded.load_state_dict(merged.state_dict())
+        modules = list(copied.modules())
+        assert all(isinstance(key, str) or any(key is module for module in modules) for key in loaded.state)
+        _assert_close(_accumulated(loaded), expected)
+
+        # Later updates of an instance do not modify the states merged into it
+        snapshot = copy.deepcopy(_accumulated(second))
+        fresh = factory(model)
+        fresh.merge(second)
+        _fit(fresh, model, batches=2, seed=8)
+        _assert_close(_accumulated(second), snapshot)
+
+
+def test_low_rank_diagonal_merge_matches_single_instance():
+    model = _mlp()
+    torch.manual_seed(9)
+    data = [(torch.randn(8, 5, dtype=torch.float64), None) for _ in range(4)]
+    size = sum(param.numel() for param in model.parameters())
+
+    def dense(curvature):
+        eigvals, eigvecs, residual = curvature.state['lowrank']
+        return eigvecs @ torch.diag(eigvals) @ eigvecs.t() + torch.diag(residual)
+
+    # At full rank and without diagonal probes the estimate is exact
+    single, first, second = [LowRankDiagonal(model, rank=size, oversampling=0, probes=0) for _ in range(3)]
+    single.update(data)
+    first.update(data[:2])
+    second.update(data[2:])
+    first.merge(second)
+    assert first.samples == single.samples == 32
+    assert torch.allclose(dense(first), dense(single), atol=1e-8)
+
+    # Truncation moves the mass of the dropped eigenpairs to the diagonal
+    first, second = [LowRankDiagonal(model, rank=3, oversampling=10, probes=0) for _ in range(2)]
+    first.update(data[:2])
+    second.update(data[2:])
+    diagonal = dense(first).diagonal() + dense(second).diagonal()
+    first.merge(second.state_dict())
+    assert first.state['lowrank'][0].shape == (3,)
+    assert torch.allclose(dense(first).diagonal(), diagonal, atol=1e-8)
+
+
+def test_mixed_precision_kahan_beats_naive_sum_and_drift_reports_it():
+    model = _mlp().float()
+    naive = KFAC(model)
+    compensated = KFAC(model).mixed_precision(torch.float32, 'kahan', reference=True)
+    torch.manual_seed(10)
+    for _ in range(5000):
+        inputs = torch.randn(4, 5)
+        labels = torch.randint(3, (4,))
+        model.zero_grad(set_to_none=False)
+        F.cross_entropy(model(inputs), labels).backward()
+        naive.update(batch_size=4)
+        compensated.update(batch_size=4)
+
+    names = {module: name for name, module in model.named_modules()}
+    drift = compensated.drift()
+    for layer, reference in compensated.reference.items():
+        for index, ref in enumerate(reference):
+            naive_error = ((naive.state[layer][index].double() - ref).norm() / ref.norm()).item()
+            kahan_error = ((compensated.state[layer][index].double() - ref).norm() / ref.norm()).item()
+            assert abs(drift[f'{names[layer]}.{index}'] - kahan_error) < 1e-12
+            assert kahan_error < naive_error / 10
+
+
+def test_remove_detaches_hooks_and_keeps_state():
+    model = _mlp()
+    curvature = KFAC(model)
+    _fit(curvature, model)
+    curvature.remove()
+    assert not curvature.hooks and not curvature.record
+    assert all(not layer._forward_pre_hooks and not layer._backward_hooks for layer in model.modules())
+    model(torch.randn(2, 5, dtype=torch.float64)).sum().backward()
+    assert not curvature.record
+    curvature.invert(1., 48)
+    assert curvature.sample(model[0]).shape == (4, 6)
@@ -0,0 +1,73 @@
+"""Tests of the batched per-example Jacobians against one `torch.autograd.grad` call per example and output."""
+
+import torch
+from torch import nn
+
+from models.jacobians import Jacobian, flatten, unflatten
+
+
+def _model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(2, 3, 3, padding=1, stride=2), nn.ReLU(), nn.Flatten(),
+                         nn.Linear(12, 4, bias=False), nn.Tanh(), nn.Linear(4, 3)).double().eval()
+
+
+def _loop_jacobian(model, inputs, layer):
+    """The Jacobians of shape (batch, C, out, in) of `layer`, computed one example and output at a time."""
+    parameters = [layer.weight] + ([layer.bias] if layer.bias is not None else [])
+    jacobians = list()
+    for example in inputs:
+        outputs = model(example.unsqueeze(0))[0]
+        rows = list()
+        for output in outputs:
+            grads = torch.autograd.grad(output, parameters, retain_graph=True)
+            row = grads[0].reshape(grads[0].shape[0], -1)
+            rows.append(torch.cat([row, grads[1].unsqueeze(1)], dim=1) if len(grads) > 1 else row)
+        jacobians.append(torch.stack(rows))
+    return torch.stack(jacobians)
+
+
+def test_jacobian_matches_loop():
+    model = _model()
+    inputs = torch.randn(5, 2, 4, 4, dtype=torch.float64)
+    jacobian = Jacobian(model)
+    outputs, jacobians = jacobian(inputs)
+    jacobian.remove()
+    assert torch.allclose(outputs, model(inputs))
+    assert list(jacobians) == [model[0], model[3], model[5]]
+    for layer, value in jacobians.items():
+        assert value.shape[:2] == (5, 3)
+        assert torch.allclose(value, _loop_jacobian(model, inputs, layer))
+
+
+def test_jacobian_layer_names_and_argmax():
+    model = _model()
+    inputs = torch.randn(5, 2, 4, 4, dtype=torch.float64)
+    jacobian = Jacobian(model, layer_names=['0', '5'])
+    outputs, jacobians = jacobian(inputs, argmax=True)
+    jacobian.remove()
+    assert list(jacobians) == [model[0], model[5]]
+    index = outputs.argmax(dim=1)
+    for layer, value in jacobians.items():
+        expected = _loop_jacobian(model, inputs, layer)[torch.arange(5), index]
+        assert torch.allclose(value[:, 0], expected)
+
+    jacobian = Jacobian(model, layer_types='Conv2d')
+    assert list(jacobian(inputs)[1]) == [model[0]]
+    jacobian.remove()
+    assert not model[0]._forward_hooks
+
+
+def test_flatten_follows_parameter_order():
+    model = _model()
+    layers = [model[0], model[3], model[5]]
+    jacobians = {layer: torch.cat([layer.weight.reshape(layer.weight.shape[0], -1)] +
+                                  ([layer.bias.unsqueeze(1)] if layer.bias is not None else []), dim=1)
+                 for layer in layers}
+    flat = flatten(jacobians)
+    assert torch.equal(flat, torch.cat([param.reshape(-1) for param in model.parameters()]))
+    start = 0
+    for layer in layers:
+        size = sum(param.numel() for param in layer.parameters())
+        assert torch.equal(unflatten(flat[start:start + size], layer), jacobians[layer])
+        start += size
@@ -0,0 +1,81 @@
+"""Tests of the matrix-free GGN products against the explicitly formed :math:`J^T\\Lambda J` of a tiny MLP."""
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from models.operators import GGN, ggn_matmat, randomized_eigh, conjugate_gradient
+
+
+def _model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(3, 4), nn.Tanh(), nn.Linear(4, 3)).double()
+
+
+def _explicit_ggn(model, inputs, likelihood):
+    parameters = list(model.parameters())
+    outputs = model(inputs)
+    rows = list()
+    for n in range(outputs.shape[0]):
+        jacobian = list()
+        for c in range(outputs.shape[1]):
+            grads = torch.autograd.grad(outputs[n, c], parameters, retain_graph=True)
+            jacobian.append(torch.cat([grad.reshape(-1) for grad in grads]))
+        jacobian = torch.stack(jacobian)
+        if likelihood == 'classification':
+            p = F.softmax(outputs[n].detach(), dim=0)
+            hessian = torch.diag(p) - torch.ger(p, p)
+        else:
+            hessian = torch.eye(outputs.shape[1], dtype=outputs.dtype)
+        rows.append(jacobian.t() @ hessian @ jacobian)
+    return sum(rows)
+
+
+def test_ggn_matmat_matches_explicit():
+    model = _model()
+    inputs = torch.randn(5, 3, dtype=torch.float64)
+    size = sum(param.numel() for param in model.parameters())
+    matrix = torch.randn(size, 2, dtype=torch.float64)
+    for likelihood in ['classification', 'regression']:
+        expected = _explicit_ggn(model, inputs, likelihood) @ matrix
+        product = ggn_matmat(model, list(model.parameters()), inputs, matrix, likelihood)
+        assert torch.allclose(product, expected)
+
+
+def test_operator_sums_over_batches():
+    model = _model()
+    data = [(torch.randn(4, 3, dtype=torch.float64), None) for _ in range(3)]
+    inputs = torch.cat([batch for batch, _ in data])
+    explicit = _explicit_ggn(model, inputs, 'classification')
+    operator = GGN(model, data)
+    vector = torch.randn(operator.size, dtype=torch.float64)
+    assert operator.shape == explicit.shape
+    assert torch.allclose(operator @ vector, explicit @ vector)
+    assert operator.samples == 12
+    first = _explicit_ggn(model, data[0][0], 'classification')
+    assert torch.allclose(GGN(model, data, batches=1) @ vector, first @ vector)
+
+
+def test_randomized_eigh_is_exact_at_full_rank():
+    model = _model()
+    data = [(torch.randn(8, 3, dtype=torch.float64), None)]
+    explicit = _explicit_ggn(model, data[0][0], 'classification')
+    operator = GGN(model, data)
+    eigvals, eigvecs, diagonal = randomized_eigh(operator, operator.size, oversampling=0, probes=4)
+    assert torch.allclose(eigvals, torch.linalg.eigvalsh(explicit).clamp(min=0), atol=1e-8)
+    assert torch.allclose(eigvecs @ torch.diag(eigvals) @ eigvecs.t(), explicit, atol=1e-8)
+    assert diagonal.shape == (operator.size,)
+
+
+def test_conjugate_gradient_matches_solve():
+    model = _model()
+    data = [(torch.randn(8, 3, dtype=torch.float64), None)]
+    explicit = _explicit_ggn(model, data[0][0], 'regression')
+    operator = GGN(model, data, likelihood='regression')
+    rhs = torch.randn(operator.size, 2, dtype=torch.float64)
+    precision = 2. * explicit + 0.5 * torch.eye(operator.size, dtype=torch.float64)
+    expected = torch.linalg.solve(precision, rhs)
+    solution = conjugate_gradient(operator, rhs, add=0.5, multiply=2., tol=1e-12, max_iter=200)
+    assert torch.allclose(solution, expected, atol=1e-8)
+    solution = conjugate_gradient(operator, rhs[:, 0], add=0.5, multiply=2., tol=1e-12, max_iter=200)
+    assert torch.allclose(solution, expected[:, 0], atol=1e-8)
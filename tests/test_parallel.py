@@ -0,0 +1,71 @@
+"""Tests of the multiprocess accumulation against a single-process accumulation over the same batches."""
+
+import copy
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset, TensorDataset
+
+from models.curvatures import Diagonal, KFAC, DenseCurvature
+from models import parallel
+
+
+def _step(curvature, images, labels):
+    """The empirical Fisher, which is deterministic in contrast to `parallel.mc_fisher_step`."""
+    loss = F.cross_entropy(curvature.model(images), labels)
+    curvature.model.zero_grad(set_to_none=False)
+    loss.backward()
+    curvature.update(batch_size=images.size(0))
+
+
+def _setup():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(5, 4), nn.ReLU(), nn.Linear(4, 3)).double()
+    dataset = TensorDataset(torch.randn(40, 5, dtype=torch.float64), torch.randint(3, (40,)))
+    return model, dataset
+
+
+def _sequential(curvature, dataset, workers, batch_size):
+    """Accumulates over the same shards and batch boundaries as `parallel.accumulate`, in a single process."""
+    for indices in torch.arange(len(dataset)).chunk(workers):
+        for images, labels in DataLoader(Subset(dataset, indices.tolist()), batch_size=batch_size):
+            _step(curvature, images, labels)
+
+
+def _assert_states_close(first, second):
+    assert first.keys() == second.keys()
+    for key in first:
+        a, b = first[key], second[key]
+        if isinstance(a, (list, tuple)):
+            for x, y in zip(a, b):
+                assert torch.allclose(x, y)
+        else:
+            assert torch.allclose(a, b)
+
+
+def test_accumulate_matches_single_process():
+    for cls in [Diagonal, KFAC]:
+        model, dataset = _setup()
+        expected = cls(copy.deepcopy(model))
+        _sequential(expected, dataset, workers=2, batch_size=8)
+
+        curvature = cls(model)
+        samples = parallel.accumulate(curvature, dataset, _step, workers=2, batch_size=8, cpus=2)
+        assert samples == curvature.samples == expected.samples == len(dataset)
+        _assert_states_close(curvature.state_dict()['state'], expected.state_dict()['state'])
+
+
+def test_accumulate_flushes_buffered_rows_once():
+    model, dataset = _setup()
+    images, labels = dataset[:4]
+    expected = DenseCurvature(copy.deepcopy(model))
+    _step(expected, images, labels)
+    _sequential(expected, dataset, workers=2, batch_size=8)
+
+    curvature = DenseCurvature(model)
+    # A buffered, not yet flushed row in the parent
+    _step(curvature, images, labels)
+    assert curvature.rows == 1
+    parallel.accumulate(curvature, dataset, _step, workers=2, batch_size=8, cpus=2)
+    assert torch.allclose(curvature.matrix(), expected.matrix())
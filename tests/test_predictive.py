@@ -0,0 +1,57 @@
+"""Tests of the batched evaluation of weight samples against a loop over models with replaced weights."""
+
+import copy
+
+import torch
+from torch import nn
+
+from models.curvatures import Curvature
+from models.predictive import batched_weights, posterior_predictive
+
+
+def _model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(2, 3, 3, padding=1), nn.ReLU(), nn.Conv2d(3, 2, 2, stride=2, bias=False),
+                         nn.Flatten(), nn.Linear(8, 5), nn.Tanh(), nn.Linear(5, 3, bias=False)).double().eval()
+
+
+def _offsets(layers, samples):
+    """Random weight offsets of shape (S, out, in), bias as last column if present."""
+    torch.manual_seed(1)
+    offsets = dict()
+    for layer in layers:
+        columns = layer.weight[0].numel() + (1 if layer.bias is not None else 0)
+        offsets[layer] = 0.1 * torch.randn(samples, layer.weight.shape[0], columns, dtype=torch.float64)
+    return offsets
+
+
+def _loop(model, offsets, inputs, samples):
+    """Evaluates one copy of the model per sample, with its weights replaced as in `Curvature.sample_and_replace`."""
+    outputs = list()
+    for s in range(samples):
+        replaced = copy.deepcopy(model)
+        modules = dict(model.named_modules())
+        for name, layer in replaced.named_modules():
+            if name and modules[name] in offsets:
+                Curvature._replace(offsets[modules[name]][s], layer.weight, layer.bias)
+        outputs.append(replaced(inputs))
+    return torch.stack(outputs)
+
+
+def test_posterior_predictive_matches_loop():
+    model = _model()
+    inputs = torch.randn(4, 2, 4, 4, dtype=torch.float64)
+    parameters = [param.clone() for param in model.parameters()]
+    for layers in [[model[0], model[2], model[4], model[6]], [model[4]], [model[0]]]:
+        offsets = _offsets(layers, 3)
+        outputs = posterior_predictive(model, offsets, inputs)
+        assert outputs.shape == (3, 4, 3)
+        assert torch.allclose(outputs, _loop(model, offsets, inputs, 3))
+
+    # The parameters and the forward functions are restored
+    assert all(torch.equal(param, original) for param, original in zip(model.parameters(), parameters))
+    assert all('forward' not in vars(layer) for layer in model)
+    with torch.no_grad():
+        with batched_weights(_offsets([model[4]], 2)):
+            model(inputs.repeat(2, 1, 1, 1))
+    assert 'forward' not in vars(model[4])
@@ -0,0 +1,51 @@
+"""Round-trip tests of the tiled, memory-mapped `HessianStore` against dense tensors."""
+
+import torch
+
+from models.storage import HessianStore, abs_sum
+
+
+def _symmetric(size: int) -> torch.Tensor:
+    torch.manual_seed(0)
+    matrix = torch.randn(size, size, dtype=torch.float64)
+    return matrix + matrix.t()
+
+
+def test_store_round_trip(tmp_path):
+    matrix = _symmetric(10)
+    filename = str(tmp_path / 'H.bin')
+    # 3 x 3 tiles of size 4, the last row and column of tiles being ragged
+    HessianStore.from_tensor(filename, matrix, tile_size=4, dtype=torch.float64)
+    store = HessianStore(filename)
+    assert store.shape == (10, 10)
+    assert store.dtype == torch.float64
+    assert torch.equal(store[:, :], matrix)
+    for rows, cols in [(slice(2, 9), slice(3, 7)), (slice(0, 4), slice(4, 8)), (slice(7, 10), slice(0, 2)),
+                       (slice(5, 6), slice(None)), (slice(-3, None), slice(-5, -1))]:
+        assert torch.equal(store[rows, cols], matrix[rows, cols])
+    for i in range(store.tiles):
+        for j in range(store.tiles):
+            assert torch.equal(store.tile(i, j), matrix[store._range(i), store._range(j)])
+    assert torch.equal(store.diagonal(), matrix.diagonal())
+    assert abs(store.abs_sum() - matrix.abs().sum().item()) < 1e-9
+    assert abs(abs_sum(store) - abs_sum(matrix)) < 1e-9
+
+
+def test_store_from_upper_triangle(tmp_path):
+    matrix = _symmetric(9)
+    # Only the upper triangle is valid, as in the state of `DenseCurvature`
+    upper = matrix.triu() + torch.randn(9, 9, dtype=torch.float64).tril(diagonal=-1)
+    store = HessianStore.from_tensor(str(tmp_path / 'H.bin'), upper, tile_size=4, dtype=torch.float32, upper=True,
+                                     scale=0.5)
+    assert store.dtype == torch.float32
+    assert torch.allclose(store[:, :], (0.5 * matrix).float())
+
+
+def test_store_write(tmp_path):
+    matrix = _symmetric(6)
+    store = HessianStore.create(str(tmp_path / 'H.bin'), 6, tile_size=4, dtype=torch.float64)
+    assert torch.equal(store[:, :], torch.zeros(6, 6, dtype=torch.float64))
+    for i, j, rows, cols in store.indices():
+        store.write(i, j, matrix[rows, cols])
+    store.data.flush()
+    assert torch.equal(HessianStore(str(tmp_path / 'H.bin'))[:, :], matrix)
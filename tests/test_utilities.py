@@ -0,0 +1,78 @@
+"""Tests of the packed upper-triangular storage against dense matrices."""
+
+import torch
+
+from models.utilities import pack, unpack, packed_rows, packed_diagonal, packed_size, packed_syrk, kahan_add
+
+
+def _symmetric(size: int) -> torch.Tensor:
+    torch.manual_seed(0)
+    matrix = torch.randn(size, size, dtype=torch.float64)
+    return matrix + matrix.t()
+
+
+def test_pack_unpack_roundtrip():
+    matrix = _symmetric(11)
+    for tile_size in [1, 3, 11, 16]:
+        packed = pack(matrix, tile_size)
+        assert packed.numel() == 11 * 12 // 2
+        assert packed_size(packed.numel()) == 11
+        assert torch.equal(unpack(packed, 11, tile_size), matrix)
+
+
+def test_packed_rows_and_diagonal():
+    matrix = _symmetric(11)
+    packed = pack(matrix)
+    assert torch.equal(packed[packed_diagonal(11)], matrix.diagonal())
+    assert torch.equal(packed_rows(packed, 11, 4, 7), matrix[4:7, 4:].triu())
+
+
+def test_packed_syrk_matches_dense():
+    torch.manual_seed(1)
+    panel = torch.randn(5, 11, dtype=torch.float64)
+    expected = pack(panel.t() @ panel)
+    for tile_size in [1, 4, 11]:
+        packed = torch.zeros(11 * 12 // 2, dtype=torch.float64)
+        packed_syrk(packed, panel, tile_size)
+        packed_syrk(packed, panel, tile_size)
+        assert torch.allclose(packed, 2 * expected)
+
+
+def test_packed_syrk_compensated_matches_plain():
+    torch.manual_seed(2)
+    panel = torch.randn(5, 11, dtype=torch.float64)
+    plain = torch.zeros(11 * 12 // 2, dtype=torch.float64)
+    compensated, compensation = torch.zeros_like(plain), torch.zeros_like(plain)
+    for _ in range(3):
+        packed_syrk(plain, panel, 4)
+        packed_syrk(compensated, panel, 4, compensation)
+    assert torch.allclose(compensated, plain)
+
+
+def test_kahan_add_beats_naive_float32_sum():
+    torch.manual_seed(3)
+    values = torch.rand(20000, 7, dtype=torch.float64) + 0.5
+    expected = values.sum(dim=0)
+    naive = torch.zeros(7, dtype=torch.float32)
+    total, error = torch.zeros_like(naive), torch.zeros_like(naive)
+    for value in values.float():
+        naive += value
+        kahan_add(total, value.clone(), error)
+    naive_error = ((naive.double() - expected) / expected).abs().max()
+    kahan_error = ((total.double() - expected) / expected).abs().max()
+    assert kahan_error < 1e-6 < naive_error
+    assert kahan_error < naive_error / 100
+
+
+def test_packed_syrk_compensated_beats_naive_float32_sum():
+    torch.manual_seed(4)
+    panels = torch.randn(5000, 3, 6, dtype=torch.float64)
+    expected = pack(torch.einsum('bki,bkj->ij', panels, panels))
+    naive = torch.zeros(6 * 7 // 2, dtype=torch.float32)
+    compensated, compensation = torch.zeros_like(naive), torch.zeros_like(naive)
+    for panel in panels.float():
+        packed_syrk(naive, panel, 4)
+        packed_syrk(compensated, panel, 4, compensation)
+    naive_error = (naive.double() - expected).norm() / expected.norm()
+    kahan_error = (compensated.double() - expected).norm() / expected.norm()
+    assert kahan_error < naive_error / 10